@@ -256,14 +256,19 @@ def cli_alf_convert(ctx, subdirs, out_dir):
 @phycli.command('extract-waveforms')
 @click.argument('params-path', type=click.Path(exists=True))
 @click.argument('n_spikes_per_cluster', type=int, default=500)
-@click.option('--nc', type=int, default=16)
+@click.option('--nc', type=int, default=16, help='number of channels per spike')
+@click.option('--n-jobs', type=int, default=None, help='number of processes')
+@click.option('--overwrite', is_flag=True, help='restart an interrupted extraction')
 @click.pass_context
 def template_extract_waveforms(
-        ctx, params_path, n_spikes_per_cluster, nc=None):  # pragma: no cover
-    """Extract spike waveforms."""
+        ctx, params_path, n_spikes_per_cluster, nc=None, n_jobs=None,
+        overwrite=False):  # pragma: no cover
+    """Extract a subset of spike waveforms of all clusters from the raw data."""
     from phylib.io.model import load_model
+    from .template.extract import extract_spike_waveforms
 
     model = load_model(params_path)
-    model.save_spikes_subset_waveforms(
-        max_n_spikes_per_template=n_spikes_per_cluster, max_n_channels=nc)
+    extract_spike_waveforms(
+        model, n_spikes_per_cluster=n_spikes_per_cluster, max_n_channels=nc, n_jobs=n_jobs,
+        overwrite=overwrite)
     model.close()
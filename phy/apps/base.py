@@ -7,6 +7,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import inspect
 import logging
@@ -15,7 +16,7 @@ from pathlib import Path
 import shutil
 
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, sosfilt_zi
 
 from phylib import _add_log_file
 from phylib.io.array import SpikeSelector, _flatten
@@ -23,20 +24,24 @@ from phylib.stats import correlograms, firing_rate
 from phylib.utils import Bunch, emit, connect, unconnect
 from phylib.utils._misc import write_tsv
 
+from phy.cluster._channel_index import ChannelClusterIndex
+from phy.cluster._template_counts import ClusterTemplateCounts
+from phy.cluster._trace_cache import TraceCache
+from phy.cluster._trace_lod import TracePyramid
 from phy.cluster._utils import RotatingProperty
 from phy.cluster.supervisor import Supervisor
 from phy.cluster.views.base import ManualClusteringView, BaseColorView
 from phy.cluster.views import (
     WaveformView, FeatureView, TraceView, TraceImageView, CorrelogramView, AmplitudeView,
     ScatterView, ProbeView, RasterView, TemplateView, ISIView, FiringRateView, ClusterScatterView,
-    PeristimHistView, select_traces)
-from phy.cluster.views.trace import _iter_spike_waveforms
+    PeristimHistView)
+from phy.cluster.views.trace import _get_spike_waveforms
 from phy.gui import GUI
 from phy.gui.gui import _prompt_save
 from phy.gui.qt import AsyncCaller
 from phy.gui.state import _gui_state_path
 from phy.gui.widgets import IPythonView, Barrier
-from phy.utils.context import Context, _cache_methods
+from phy.utils.context import Context, _cache_methods, merge_sum, merge_weighted_mean
 from phy.utils.plugin import attach_plugins
 
 from plugins.graph_view import GraphViewPlugin, UpdateGraphViewBtnPlugin
@@ -82,25 +87,94 @@ class StatusBarHandler(logging.Handler):
 # Raw data filtering
 #--------------------------------------------------------------------------
 
+class SOSFilter(object):
+    """Zero-phase IIR filter with second-order sections, computed in float32.
+
+    The filter is applied forward and then backward, with steady-state initial conditions to
+    limit the edge transients, and in parallel across blocks of channels.
+
+    The trace views filter every raw data chunk with `filter_chunk()`, before centring it. Each
+    chunk is filtered independently from its own padding (50 ms on each side), so that the
+    filtered chunks do not depend on the order in which they are loaded.
+
+    Constructor
+    -----------
+
+    sos : array-like
+        The `(n_sections, 6)` second-order sections, as returned by `scipy.signal.butter()`.
+    n_threads : int
+        Number of threads used to filter the channel blocks in parallel.
+
+    """
+
+    channel_block_size = 32
+    n_threads = min(4, os.cpu_count() or 1)
+
+    def __init__(self, sos, n_threads=None):
+        self.sos = np.asarray(sos, dtype=np.float32)
+        self._zi = sosfilt_zi(sos).astype(np.float32)  # shape: (n_sections, 2)
+        if n_threads is not None:
+            self.n_threads = n_threads
+        # The filter may be called from several threads at once, so the executor is created
+        # here rather than on first use. Its threads are only started when needed.
+        self._executor = (
+            ThreadPoolExecutor(max_workers=self.n_threads) if self.n_threads > 1 else None)
+
+    def _filter_block(self, x):
+        """Filter a `(n_samples, n_columns)` block forward and backward."""
+        y = sosfilt(self.sos, x, axis=0, zi=self._zi[..., np.newaxis] * x[0])[0]
+        y = y[::-1]
+        y = sosfilt(self.sos, y, axis=0, zi=self._zi[..., np.newaxis] * y[0])[0]
+        return y[::-1]
+
+    def _filter(self, x):
+        """Filter a `(n_samples, n_columns)` float32 array in parallel across column blocks."""
+        n_cols = x.shape[1]
+        bs = self.channel_block_size
+        if self._executor is None or n_cols <= bs:
+            return self._filter_block(x)
+        slices = [slice(k, min(k + bs, n_cols)) for k in range(0, n_cols, bs)]
+        return np.concatenate(
+            list(self._executor.map(lambda s: self._filter_block(x[:, s]), slices)), axis=1)
+
+    def __call__(self, arr, axis=0):
+        """Filter an array along a given axis."""
+        arr = np.asarray(arr)
+        x = np.moveaxis(arr, axis, 0)
+        shape = x.shape
+        x = np.ascontiguousarray(
+            x.reshape((shape[0], int(np.prod(shape[1:])))), dtype=np.float32)
+        if x.shape[0] == 0 or x.shape[1] == 0:
+            return arr.astype(np.float32)
+        y = self._filter(x)
+        return np.moveaxis(y.reshape(shape), 0, axis)
+
+    def filter_chunk(self, arr):
+        """Filter a padded `(n_samples, n_channels)` chunk of raw data, before it is centred."""
+        x = np.ascontiguousarray(arr, dtype=np.float32)
+        if x.shape[0] == 0 or x.shape[1] == 0:
+            return x
+        return self._filter(x)
+
+
 class RawDataFilter(RotatingProperty):
     def __init__(self):
         super(RawDataFilter, self).__init__()
         self.add('raw', lambda x, axis=None: x)
 
     def add_default_filter(self, sample_rate):
-        b, a = butter(3, 150.0 / sample_rate * 2.0, 'high')
-
-        @self.add_filter
-        def high_pass(arr, axis=0):
-            arr = lfilter(b, a, arr, axis=axis)
-            arr = np.flip(arr, axis=axis)
-            arr = lfilter(b, a, arr, axis=axis)
-            arr = np.flip(arr, axis=axis)
-            return arr
+        sos = butter(3, 150.0 / sample_rate * 2.0, 'high', output='sos')
+        self.add_filter(SOSFilter(sos), name='high_pass')
         self.set('high_pass')
 
     def add_filter(self, fun=None, name=None):
-        """Add a raw data filter."""
+        """Add a raw data filter.
+
+        The filter is a function `(arr, axis=0) => arr`. A filter object may also implement
+        `filter_chunk(arr) => arr` (see `SOSFilter`), in which case the trace views filter every
+        raw data chunk from its own padding, before centring it.
+
+        """
         if fun is None:  # pragma: no cover
             return partial(self.add_filter, name=name)
         name = name or fun.__name__
@@ -153,6 +227,15 @@ class WaveformMixin(object):
         '_get_mean_waveforms',
     )
 
+    _memcached_per_cluster = (
+        ('_get_mean_waveforms', '_merge_mean_waveforms'),
+    )
+
+    _prefetched = (
+        '_get_waveforms',
+        '_get_mean_waveforms',
+    )
+
     def get_spike_raw_amplitudes(self, spike_ids, channel_id=None, **kwargs):
         """Return the maximum amplitude of the raw waveforms on the best channel of
         the first selected cluster.
@@ -232,6 +315,14 @@ class WaveformMixin(object):
         b['alpha'] = 1.
         return b
 
+    def _merge_mean_waveforms(self, cluster_id, values, weights):
+        """Derive the mean waveform of a merged cluster from the mean waveforms of the merged
+        clusters, if they are all on the best channels of the merged cluster."""
+        channel_ids = self.get_best_channels(cluster_id)
+        if not np.array_equal(values[0].channel_ids, channel_ids):
+            return
+        return merge_weighted_mean(cluster_id, values, weights)
+
     def _set_view_creator(self):
         super(WaveformMixin, self)._set_view_creator()
         self.view_creator['WaveformView'] = self.create_waveform_view
@@ -295,6 +386,10 @@ class FeatureMixin(object):
         'get_spike_feature_amplitudes',
     )
 
+    _prefetched = (
+        '_get_features',
+    )
+
     def get_spike_feature_amplitudes(
             self, spike_ids, channel_id=None, channel_ids=None, pc=None, **kwargs):
         """Return the features for the specified channel and PC."""
@@ -465,12 +560,20 @@ class TemplateMixin(object):
     _memcached = (
         '_get_template_waveforms',
         'get_mean_spike_template_amplitudes',
-        'get_template_counts',
-        'get_template_for_cluster',
         'get_template_amplitude',
         'get_cluster_amplitude',
     )
 
+    _memcached_per_cluster = (
+        ('_get_template_waveforms', None),
+        ('get_mean_spike_template_amplitudes', None),
+    )
+
+    _prefetched = (
+        '_get_template_waveforms',
+        'get_amplitudes',
+    )
+
     def __init__(self, *args, **kwargs):
         super(TemplateMixin, self).__init__(*args, **kwargs)
 
@@ -485,19 +588,42 @@ class TemplateMixin(object):
         spike_ids = self._get_amplitude_spike_ids(cluster_id, load_all=load_all)
         return self.model.amplitudes[spike_ids]
 
+    def _set_supervisor(self):
+        super(TemplateMixin, self)._set_supervisor()
+
+        # Number of spikes of every template in every cluster, updated after every clustering
+        # action before the views are updated.
+        self.template_counts = ClusterTemplateCounts(
+            spike_templates=self.model.spike_templates,
+            spike_clusters=self.supervisor.clustering.spike_clusters,
+            n_templates=self.model.n_templates,
+            spikes_per_cluster=lambda cluster_id: (
+                self.supervisor.clustering.spikes_per_cluster[cluster_id]),
+        )
+
+        @connect(sender=self.supervisor)
+        def on_cluster(sender, up):
+            self.template_counts.update(up)
+
+        # The best channels of a cluster are those of its best template, so that the channel
+        # index gets the best templates of all clusters at once from the template counts.
+        self.channel_index.best_templates = self.template_counts.best_templates
+        self.channel_index.template_channels = self._get_template_channels
+
+    def _get_template_channels(self, template_id):
+        """Return the best channels of a template."""
+        template = self.model.get_template(template_id)
+        if not template:  # pragma: no cover
+            return [0]
+        return template.channel_ids
+
     def get_template_counts(self, cluster_id):
         """Return a histogram of the number of spikes in each template for a given cluster."""
-        spike_ids = self.supervisor.clustering.spikes_per_cluster[cluster_id]
-        st = self.model.spike_templates[spike_ids]
-        return np.bincount(st, minlength=self.model.n_templates)
+        return self.template_counts.counts(cluster_id)
 
     def get_template_for_cluster(self, cluster_id):
         """Return the largest template associated to a cluster."""
-        spike_ids = self.supervisor.clustering.spikes_per_cluster[cluster_id]
-        st = self.model.spike_templates[spike_ids]
-        template_ids, counts = np.unique(st, return_counts=True)
-        ind = np.argmax(counts)
-        return template_ids[ind]
+        return self.template_counts.best_template(cluster_id)
 
     def get_template_amplitude(self, template_id):
         """Return the maximum amplitude of a template's waveforms across all channels."""
@@ -606,14 +732,52 @@ class TraceMixin(object):
     _new_views = ('TraceView', 'TraceImageView')
     waveform_duration = 1.0  # in milliseconds
 
-    def _get_traces(self, interval, show_all_spikes=False):
-        """Get traces and spike waveforms."""
-        traces_interval = select_traces(
-            self.model.traces, interval, sample_rate=self.model.sample_rate)
-        # Filter the loaded traces.
-        traces_interval = self.raw_data_filter.apply(traces_interval, axis=0)
+    # Maximum size of the filtered raw data chunks kept in memory for the trace views.
+    trace_cache_max_bytes = 512 * 1024 ** 2
+
+    @property
+    def trace_cache(self):
+        """Cache of the filtered raw data chunks, created on first use."""
+        if getattr(self, '_trace_cache', None) is None:
+            self._trace_cache = TraceCache(
+                traces=self.model.traces,
+                sample_rate=self.model.sample_rate,
+                raw_data_filter=self.raw_data_filter,
+                max_bytes=self.trace_cache_max_bytes,
+                enable_threading=self._enable_threading,
+            )
+        return self._trace_cache
+
+    @property
+    def trace_pyramid(self):
+        """Min/max envelopes of the filtered raw data, stored in the cache directory and
+        computed on first use."""
+        if getattr(self, '_trace_pyramid', None) is None:
+            self._trace_pyramid = TracePyramid(
+                trace_cache=self.trace_cache, cache_dir=self.cache_dir / 'trace_envelopes',
+                fingerprint=self._get_raw_data_fingerprint())
+        return self._trace_pyramid
+
+    def _get_raw_data_fingerprint(self):
+        """Return a string identifying the raw data files, used to validate the trace
+        envelopes stored in the cache directory."""
+        paths = [
+            Path(path) for path in (getattr(self.model, 'dat_path', None) or ())
+            if isinstance(path, (str, Path))]
+        return ';'.join(
+            '%s:%d:%d' % (path.name, path.stat().st_size, path.stat().st_mtime_ns)
+            for path in paths if path.is_file())
+
+    def _get_traces(self, interval, show_all_spikes=False, n_pixels=None):
+        """Get traces and spike waveforms. If the interval contains much more samples than
+        `n_pixels`, return a min/max envelope of the traces instead, without the waveforms."""
+        envelope = self.trace_pyramid.get(interval, n_pixels) if n_pixels else None
+        if envelope is not None:
+            return Bunch(data=envelope.data, times=envelope.times, waveforms=[])
+        # Load the filtered and centred traces from the chunk cache.
+        traces_interval = self.trace_cache.get(interval)
         out = Bunch(data=traces_interval)
-        out.waveforms = list(_iter_spike_waveforms(
+        out.waveforms = _get_spike_waveforms(
             interval=interval,
             traces_interval=traces_interval,
             model=self.model,
@@ -621,7 +785,7 @@ class TraceMixin(object):
             n_samples_waveforms=int(round(1e-3 * self.waveform_duration * self.model.sample_rate)),
             get_best_channels=self.get_channel_amplitudes,
             show_all_spikes=show_all_spikes,
-        ))
+        )
         return out
 
     def _trace_spike_times(self):
@@ -648,9 +812,11 @@ class TraceMixin(object):
             channel_positions=self.model.channel_positions,
         )
 
-        # Update the get_traces() function with show_all_spikes.
+        # Update the get_traces() function with show_all_spikes and the view width.
         def _get_traces(interval):
-            return self._get_traces(interval, show_all_spikes=view.show_all_spikes)
+            return self._get_traces(
+                interval, show_all_spikes=view.show_all_spikes,
+                n_pixels=view.canvas.get_size()[0])
         view.traces = _get_traces
         view.ex_status = self.raw_data_filter.current
 
@@ -691,6 +857,10 @@ class TraceMixin(object):
             channel_positions=self.model.channel_positions,
         )
 
+        def _get_traces(interval):
+            return self._get_traces(interval, n_pixels=view.canvas.get_size()[0])
+        view.traces = _get_traces
+
         @connect
         def on_select_time(sender, time):
             view.go_to(time)
@@ -831,6 +1001,10 @@ class BaseController(object):
 
     n_spikes_correlograms = 100000
 
+    # Number of clusters likely to be selected next (most similar clusters and next best
+    # clusters) whose data is computed in the background after every selection.
+    n_prefetch_clusters = 3
+
     # Number of raw data chunks to keep when loading waveforms from raw data (mostly useful
     # when using compressed dataset, as random access triggers expensive decompression).
     n_chunks_kept = 20
@@ -848,8 +1022,20 @@ class BaseController(object):
         'get_best_channels',
         'get_channel_shank',
         'get_probe_depth',
-        'peak_channel_similarity',
     )
+    # Memcached methods taking a cluster id as first argument, with the function deriving the
+    # value of a merged cluster from the values of the merged clusters, or None. The entries of
+    # the deleted clusters are kept in the memcache, as undoing the action brings them back.
+    _memcached_per_cluster = (
+        ('get_mean_firing_rate', merge_sum),
+        ('get_best_channel', None),
+        ('get_best_channels', None),
+        ('get_channel_shank', None),
+        ('get_probe_depth', None),
+    )
+    # Cached methods taking a cluster id as single argument, called on the clusters likely to be
+    # selected next so that the views find their data in the cache.
+    _prefetched = ()
     # Methods that are cached on disk for performance.
     _cached = (
         '_get_correlograms',
@@ -1015,6 +1201,10 @@ class BaseController(object):
             self.cluster_metrics['sh'] = self.get_channel_shank
         self.cluster_metrics['depth'] = self.get_probe_depth
         self.cluster_metrics['fr'] = self.get_mean_firing_rate
+        # dictionary {name: function cluster_ids => values}, computing metrics of many clusters
+        # at once, used instead of the per-cluster functions to fill the cluster view
+        self.cluster_metrics_vectorized = {}
+        self.cluster_metrics_vectorized['fr'] = self.get_mean_firing_rates
 
     def _set_similarity_functions(self):
         """Set the `similarity_functions` dictionary that maps similarity names to functions
@@ -1025,6 +1215,16 @@ class BaseController(object):
         # Default similarity function name.
         self.similarity = list(self.similarity_functions.keys())[0]
 
+    def _get_data_fingerprint(self):
+        """Return a string identifying the data files, used to validate the snapshot of the
+        cluster metrics."""
+        files = sorted(
+            path for path in self.dir_path.iterdir()
+            if path.is_file() and path.suffix in ('.npy', '.py', '.kwik', '.kwx'))
+        return ';'.join(
+            '%s:%d:%d' % (path.name, path.stat().st_size, path.stat().st_mtime_ns)
+            for path in files)
+
     def _set_supervisor(self):
         """Create the Supervisor instance."""
         # Load the new cluster id.
@@ -1038,11 +1238,13 @@ class BaseController(object):
             spike_clusters=self.model.spike_clusters,
             cluster_groups=cluster_groups,
             cluster_metrics=self.cluster_metrics,
+            cluster_metrics_vectorized=self.cluster_metrics_vectorized,
             cluster_labels=self.model.metadata,
             similarity=self.similarity_functions[self.similarity],
             new_cluster_id=new_cluster_id,
             context=self.context,
-            triggers=self.trigger_model.get_triggers() if self.trigger_model else None
+            triggers=self.trigger_model.get_triggers() if self.trigger_model else None,
+            metrics_fingerprint=self._get_data_fingerprint,
         )
         # Load the non-group metadata from the model to the cluster_meta.
         for name in sorted(self.model.metadata):
@@ -1056,8 +1258,33 @@ class BaseController(object):
         # to the model's saving functions.
         connect(self.on_save_clustering, sender=supervisor)
 
+        self._connect_supervisor(supervisor)
         self.supervisor = supervisor
 
+    def _connect_supervisor(self, supervisor):
+        """Set up the prefetch of the data of the next clusters, create the index of the
+        clusters on every channel, used by the peak channel similarity and the amplitudes, and
+        update it and the memcache after every clustering action.
+
+        This must be called by all controllers once the Supervisor instance has been created.
+
+        """
+        # Prefetch the data of the next clusters in the background, only with threading.
+        supervisor.prefetcher.n_clusters = (
+            self.n_prefetch_clusters if self._enable_threading else 0)
+        for name in _concatenate_parents_attributes(self.__class__, '_prefetched'):
+            supervisor.prefetcher.add(getattr(self, name))
+
+        self.channel_index = ChannelClusterIndex(
+            best_channels=self.get_best_channels,
+            cluster_ids=lambda: supervisor.clustering.cluster_ids)
+
+        # Update the memcache after every clustering action, before the views are updated.
+        @connect(sender=supervisor)
+        def on_cluster(sender, up):
+            self.context.update_memcache(up)
+            self.channel_index.update(up)
+
     def _set_selector(self):
         """Set the Selector instance."""
 
@@ -1082,7 +1309,9 @@ class BaseController(object):
         if not os.environ.get('PHY_DISABLE_CACHE', False):
             memcached = _concatenate_parents_attributes(self.__class__, '_memcached')
             cached = _concatenate_parents_attributes(self.__class__, '_cached')
-            _cache_methods(self, memcached, cached)
+            per_cluster = dict(
+                _concatenate_parents_attributes(self.__class__, '_memcached_per_cluster'))
+            _cache_methods(self, memcached, cached, per_cluster=per_cluster)
 
     def _get_channel_labels(self, channel_ids=None):
         """Return the labels of a list of channels."""
@@ -1210,6 +1439,10 @@ class BaseController(object):
         """Return the mean firing rate of a cluster."""
         return self.supervisor.n_spikes(cluster_id) / max(1, self.model.duration)
 
+    def get_mean_firing_rates(self, cluster_ids):
+        """Return the mean firing rates of some clusters."""
+        return self.supervisor.get_spike_counts(cluster_ids) / max(1, self.model.duration)
+
     def get_best_channel(self, cluster_id):
         """Return the best channel id of a given cluster. This is the first channel returned
         by `get_best_channels()`."""
@@ -1247,9 +1480,7 @@ class BaseController(object):
 
     def get_clusters_on_channel(self, channel_id):
         """Return all clusters which have the specified channel among their best channels."""
-        return [
-            cluster_id for cluster_id in self.supervisor.clustering.cluster_ids
-            if channel_id in self.get_best_channels(cluster_id)]
+        return self.channel_index.clusters_on_channel(channel_id)
 
     # Default similarity functions
     # -------------------------------------------------------------------------
@@ -1270,9 +1501,7 @@ class BaseController(object):
 
         """
         ch = self.get_best_channel(cluster_id)
-        return [
-            (other, 1.) for other in self.supervisor.clustering.cluster_ids
-            if ch in self.get_best_channels(other)]
+        return [(other, 1.) for other in self.channel_index.clusters_on_channel(ch)]
 
     # Public spike methods
     # -------------------------------------------------------------------------
@@ -1825,13 +2054,18 @@ class BaseController(object):
             for param in self._state_params:
                 gui.state[param] = getattr(self, param, None)
 
-            # Save the memcache.
+            # Save the memcache and the cluster metrics.
             gui.state['GUI_VERSION'] = self.gui_version
             self.context.save_memcache()
+            self.supervisor.save_metrics_snapshot()
 
             # Remove the status bar handler when closing the GUI.
             logging.getLogger('phy').removeHandler(handler)
 
+        # The cluster metrics loaded from the snapshot are recomputed between the GUI events.
+        if self.supervisor.metrics.from_snapshot:
+            self.supervisor.refresh_metrics(enable_threading=self._enable_threading)
+
         try:
             emit('gui_ready', self, gui)
         except Exception as e:  # pragma: no cover
@@ -143,15 +143,19 @@ class KwikController(WaveformMixin, FeatureMixin, TraceMixin, BaseController):
             spike_clusters=self.model.spike_clusters,
             cluster_groups=cluster_groups,
             cluster_metrics=self.cluster_metrics,
+            cluster_metrics_vectorized=self.cluster_metrics_vectorized,
             similarity=self.similarity_functions[self.similarity],
             new_cluster_id=new_cluster_id,
             context=self.context,
+            metrics_fingerprint=self._get_data_fingerprint,
         )
 
         # Connect the `save_clustering` event raised by the supervisor when saving
         # to the model's saving functions.
         connect(self.on_save_clustering, sender=supervisor)
 
+        self._connect_supervisor(supervisor)
+
         @connect(sender=supervisor)
         def on_attach_gui(sender):
             @supervisor.actions.add(shortcut='shift+ctrl+k', set_busy=True)
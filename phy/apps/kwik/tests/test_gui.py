@@ -60,6 +60,37 @@ class KwikControllerTests(BaseControllerTests, unittest.TestCase):
         views = self.gui.list_views(WaveformView)
         return views[0] if views else None
 
+    def test_kwik_channel_index(self):
+        self.next_best()
+        cluster_id = self.selected[0]
+        channel_id = self.controller.get_best_channels(cluster_id)[0]
+        self.assertIn(cluster_id, self.controller.get_clusters_on_channel(channel_id))
+        self.assertTrue(self.controller.peak_channel_similarity(cluster_id))
+
+    def test_kwik_memcache_update(self):
+        context = self.controller.context
+        update_memcache = context.update_memcache
+        updates = []
+
+        def _update(up):
+            updates.append(up)
+            update_memcache(up)
+
+        context.update_memcache = _update
+        try:
+            self.next()
+            self.merge()
+        finally:
+            del context.update_memcache
+        # The memcache is updated after the clustering action.
+        self.assertIn('merge', [up.description for up in updates])
+
+    def test_kwik_prefetcher(self):
+        # The prefetcher is disabled without threading, but the getters are registered.
+        prefetcher = self.supervisor.prefetcher
+        self.assertEqual(prefetcher.n_clusters, 0)
+        self.assertTrue(prefetcher._functions)
+
     def test_kwik_snippets(self):
         self.key('Down')
         self.key('Space')
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Offline extraction of a subset of raw spike waveforms for the template GUI."""
+
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import os
+import time
+
+import numpy as np
+
+from phylib.io.array import SpikeSelector, _spikes_per_cluster
+from phylib.io.traces import get_ephys_reader
+
+from phy.cluster._trace_cache import _split_chunk_bounds
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Chunk extraction
+#------------------------------------------------------------------------------
+
+# Raw data reader opened once in every worker process.
+_worker_traces = None
+
+
+def _open_traces(reader_kwargs):
+    """Open the raw data, as done by the template model."""
+    reader_kwargs = dict(reader_kwargs)
+    channel_map = reader_kwargs.pop('channel_map', None)
+    traces = get_ephys_reader(reader_kwargs.pop('dat_path'), **reader_kwargs)
+    if channel_map is not None:
+        traces = traces[:, channel_map]
+    return traces
+
+
+def _init_worker(reader_kwargs):
+    global _worker_traces
+    _worker_traces = _open_traces(reader_kwargs)
+
+
+def _extract_chunk(traces, i0, i1, spike_samples, spike_channels, n_samples_waveforms):
+    """Extract the waveforms of the spikes within a chunk `[i0, i1)`, reading the raw data once.
+
+    Return an `(n_spikes, n_samples_waveforms, n_channels_loc)` array. The missing channels
+    (-1 in `spike_channels`) and the samples outside of the recording are set to 0.
+
+    """
+    n_samples, n_channels = traces.shape
+    nsw = n_samples_waveforms
+    a = nsw // 2
+    ns, nc = spike_channels.shape
+    # Load the chunk with the margins needed by the spikes at the chunk boundaries.
+    t0, t1 = i0 - a, i1 + nsw - a
+    block = np.zeros((t1 - t0, n_channels), dtype=traces.dtype)
+    block[max(0, t0) - t0:min(n_samples, t1) - t0] = traces[max(0, t0):min(n_samples, t1)]
+    rows = (spike_samples.astype(np.int64) - a - t0)[:, np.newaxis] + np.arange(nsw)
+    channels = np.asarray(spike_channels, dtype=np.int64)
+    out = block[rows[:, :, np.newaxis], channels[:, np.newaxis, :]]
+    out[np.broadcast_to((channels < 0)[:, np.newaxis, :], out.shape)] = 0
+    assert out.shape == (ns, nsw, nc)
+    return out
+
+
+def _extract_chunk_worker(i0, i1, spike_samples, spike_channels, n_samples_waveforms):
+    return _extract_chunk(
+        _worker_traces, i0, i1, spike_samples, spike_channels, n_samples_waveforms)
+
+
+#------------------------------------------------------------------------------
+# Waveform extraction
+#------------------------------------------------------------------------------
+
+def _paths(dir_path):
+    stem = '_phy_spikes_subset'
+    return (
+        dir_path / (stem + '.spikes.npy'),
+        dir_path / (stem + '.channels.npy'),
+        dir_path / (stem + '.waveforms.npy'),
+        # Waveforms being extracted, and the chunks already extracted, used for resuming.
+        dir_path / (stem + '.waveforms.partial.npy'),
+        dir_path / (stem + '.progress.npy'),
+    )
+
+
+def _select_spikes(model, n_spikes_per_cluster, max_n_channels):
+    """Select a subset of spikes evenly spread in time in every cluster, and the best channels
+    of their templates."""
+    spike_clusters = getattr(model, 'spike_clusters', None)
+    if spike_clusters is None:  # pragma: no cover
+        spike_clusters = model.spike_templates
+    spc = _spikes_per_cluster(spike_clusters)
+    selector = SpikeSelector(
+        get_spikes_per_cluster=lambda cl: spc.get(cl, np.array([], dtype=np.int64)),
+        spike_times=model.spike_samples, chunk_bounds=model.traces.chunk_bounds,
+        n_chunks_kept=len(model.traces.chunk_bounds))
+    spike_ids = np.unique(selector(n_spikes_per_cluster, sorted(spc), sample_evenly=True))
+
+    nc = max(max_n_channels or model.n_closest_channels, model.n_closest_channels)
+    best_channels = np.array([
+        model._template_n_channels(t, nc) for t in range(model.n_templates)], dtype=np.int32)
+    spike_channels = best_channels[model.spike_templates[spike_ids], :]
+    assert spike_channels.shape == (len(spike_ids), nc)
+    return spike_ids, spike_channels
+
+
+def extract_spike_waveforms(
+        model, n_spikes_per_cluster=500, max_n_channels=16, n_jobs=None, overwrite=False,
+        chunk_duration=10., reader_kwargs=None):
+    """Extract a subset of raw spike waveforms for all clusters, chunk by chunk and in parallel,
+    and save them in the `_phy_spikes_subset.*` files loaded by the template model.
+
+    The extraction can be resumed after an interruption: the waveforms are written in a
+    temporary file which is renamed once all chunks have been extracted.
+
+    Parameters
+    ----------
+
+    model : TemplateModel
+        The template model, with raw data.
+    n_spikes_per_cluster : int
+        Maximum number of spikes per cluster, evenly spread in time.
+    max_n_channels : int
+        Number of best channels of every spike template to extract.
+    n_jobs : int
+        Number of worker processes. Extract in the current process if 1.
+    overwrite : boolean
+        Whether to start over instead of resuming an interrupted extraction.
+    chunk_duration : float
+        Maximum duration of the raw data chunks processed by a single task, in seconds. The
+        chunks of the raw data reader (compression chunks with mtscomp) are never merged.
+    reader_kwargs : dict
+        Keyword arguments to open the raw data in the worker processes. By default, they are
+        obtained from the model.
+
+    Returns
+    -------
+
+    n_spikes : int
+        Number of extracted spikes.
+
+    """
+    if model.traces is None:
+        logger.warning(
+            "Spike waveforms could not be extracted as the raw data file is not available.")
+        return 0
+    n_jobs = n_jobs or os.cpu_count() or 1
+    traces = model.traces
+    nsw = model.n_samples_waveforms
+    path_spikes, path_channels, path, path_partial, path_progress = _paths(model.dir_path)
+    chunk_bounds = _split_chunk_bounds(
+        traces.chunk_bounds, max(1, int(chunk_duration * model.sample_rate)))
+    n_chunks = len(chunk_bounds) - 1
+
+    if not overwrite and path.exists() and path_spikes.exists() and path_channels.exists():
+        logger.info("Spike waveforms already extracted in `%s`.", path)
+        if model.spike_waveforms is None:
+            model.spike_waveforms = model._load_spike_waveforms()
+        return len(np.load(str(path_spikes)))
+
+    # Resume an interrupted extraction, if any.
+    resume = (
+        not overwrite and path_partial.exists() and path_progress.exists() and
+        path_spikes.exists() and path_channels.exists())
+    if resume:
+        spike_ids = np.load(str(path_spikes))
+        spike_channels = np.load(str(path_channels))
+        waveforms = np.lib.format.open_memmap(str(path_partial), mode='r+')
+        done = np.load(str(path_progress))
+        resume = (
+            done.shape == (n_chunks,) and waveforms.shape[0] == len(spike_ids) and
+            waveforms.shape[1:] == (nsw, spike_channels.shape[1]))
+    if resume:
+        logger.info("Resuming the waveform extraction, %d/%d chunks done.", done.sum(), n_chunks)
+    else:
+        # The previous waveforms are obsolete once the spike selection changes.
+        if path.exists():
+            path.unlink()
+        spike_ids, spike_channels = _select_spikes(model, n_spikes_per_cluster, max_n_channels)
+        np.save(str(path_spikes), spike_ids)
+        np.save(str(path_channels), spike_channels)
+        waveforms = np.lib.format.open_memmap(
+            str(path_partial), mode='w+', dtype=traces.dtype,
+            shape=(len(spike_ids), nsw, spike_channels.shape[1]))
+        done = np.zeros(n_chunks, dtype=bool)
+        np.save(str(path_progress), done)
+
+    # Spikes in every chunk.
+    spike_samples = model.spike_samples[spike_ids]
+    bounds = np.searchsorted(spike_samples, chunk_bounds)
+    done[bounds[:-1] == bounds[1:]] = True
+    todo = np.nonzero(~done)[0]
+    n_spikes = int(np.sum(bounds[todo + 1] - bounds[todo]))
+    logger.info(
+        "Extracting %d spike waveforms in %d chunks with %d process(es).",
+        n_spikes, len(todo), n_jobs)
+
+    def _tasks():
+        for chunk in todo:
+            s0, s1 = bounds[chunk], bounds[chunk + 1]
+            yield chunk, (
+                chunk_bounds[chunk], chunk_bounds[chunk + 1],
+                spike_samples[s0:s1], spike_channels[s0:s1], nsw)
+
+    def _save_progress():
+        waveforms.flush()
+        np.save(str(path_progress), done)
+
+    t0 = time.perf_counter()
+    n_extracted = 0
+    last_save = t0
+
+    def _store(chunk, w):
+        nonlocal n_extracted, last_save
+        waveforms[bounds[chunk]:bounds[chunk + 1]] = w
+        done[chunk] = True
+        n_extracted += len(w)
+        now = time.perf_counter()
+        if now - last_save > 5:
+            _save_progress()
+            last_save = now
+            logger.info(
+                "%d/%d spikes extracted (%.0f spikes/s).",
+                n_extracted, n_spikes, n_extracted / (now - t0))
+
+    try:
+        if n_jobs <= 1:
+            for chunk, args in _tasks():
+                _store(chunk, _extract_chunk(traces, *args))
+        else:
+            reader_kwargs = reader_kwargs or dict(
+                dat_path=model.dat_path, n_channels_dat=model.n_channels_dat,
+                dtype=model.dtype, offset=model.offset, sample_rate=model.sample_rate,
+                channel_map=model.channel_mapping)
+            with ProcessPoolExecutor(
+                    max_workers=n_jobs, initializer=_init_worker,
+                    initargs=(reader_kwargs,)) as executor:
+                futures = {
+                    executor.submit(_extract_chunk_worker, *args): chunk
+                    for chunk, args in _tasks()}
+                for future in as_completed(futures):
+                    _store(futures[future], future.result())
+    finally:
+        _save_progress()
+
+    # All chunks have been extracted.
+    waveforms = None  # close the memory-mapped file before renaming it
+    os.replace(str(path_partial), str(path))
+    path_progress.unlink()
+    duration = time.perf_counter() - t0
+    logger.info(
+        "Extracted %d spike waveforms in %.1f s (%.0f spikes/s).",
+        n_extracted, duration, n_extracted / max(duration, 1e-9))
+    model.spike_waveforms = model._load_spike_waveforms()
+    return len(spike_ids)
@@ -8,7 +8,6 @@
 #------------------------------------------------------------------------------
 
 import logging
-from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
@@ -24,6 +23,7 @@ from phylib.utils import Bunch, connect
 from phy.cluster.views import ScatterView
 from phy.gui import create_app, run_app
 from ..base import WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin, BaseController
+from .extract import extract_spike_waveforms
 
 logger = logging.getLogger(__name__)
 
@@ -164,11 +164,7 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
 
     def get_best_channels(self, cluster_id):
         """Return the best channels of a given cluster."""
-        template_id = self.get_template_for_cluster(cluster_id)
-        template = self.model.get_template(template_id)
-        if not template:  # pragma: no cover
-            return [0]
-        return template.channel_ids
+        return self._get_template_channels(self.get_template_for_cluster(cluster_id))
 
     def get_channel_amplitudes(self, cluster_id):
         """Return the channel amplitudes of the best channels of a given cluster."""
@@ -183,20 +179,20 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
     def template_similarity(self, cluster_id):
         """Return the list of similar clusters to a given cluster."""
         # Templates of the cluster.
-        temp_i = np.nonzero(self.get_template_counts(cluster_id))[0]
+        temp_i = self.template_counts.templates(cluster_id)
         # The similarity of the cluster with each template.
         sims = np.max(self.model.similar_templates[temp_i, :], axis=0)
-
-        def _sim_ij(cj):
-            # Templates of the cluster.
-            if cj < self.model.n_templates:
-                return float(sims[cj])
-            temp_j = np.nonzero(self.get_template_counts(cj))[0]
-            return float(np.max(sims[temp_j]))
-
-        out = [(cj, _sim_ij(cj)) for cj in self.supervisor.clustering.cluster_ids]
+        # The similarity with every cluster is the maximum similarity with its templates,
+        # computed for all clusters at once from the sparse cluster x template matrix, which
+        # is only rebuilt after a clustering action.
+        cluster_ids = np.asarray(self.supervisor.clustering.cluster_ids)
+        out = self.template_counts.max_per_cluster(sims, cluster_ids)
+        # Original clusters are identified with their template.
+        orig = cluster_ids < self.model.n_templates
+        out[orig] = sims[cluster_ids[orig]]
         # NOTE: hard-limit to 100 for performance reasons.
-        return sorted(out, key=itemgetter(1), reverse=True)[:100]
+        best = np.argsort(-out, kind='stable')[:100]
+        return [(int(cluster_ids[i]), float(out[i])) for i in best]
 
     def get_template_amplitude(self, template_id):
         """Return the maximum amplitude of a template's waveforms across all channels."""
@@ -227,8 +223,7 @@ def template_gui(params_path, **kwargs):  # pragma: no cover
     # Automatically export spike waveforms when using compressed raw ephys.
     if model.spike_waveforms is None and isinstance(model.traces, MtscompEphysReader):
         # TODO: customizable values below.
-        model.save_spikes_subset_waveforms(
-            max_n_spikes_per_template=500, max_n_channels=16)
+        extract_spike_waveforms(model, n_spikes_per_cluster=500, max_n_channels=16)
 
     create_app()
     controller = TemplateController(model=model, dir_path=dir_path, 
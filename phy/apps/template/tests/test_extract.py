@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Testing the offline waveform extraction."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from phylib.io.traces import extract_waveforms, get_ephys_reader
+from phylib.utils import Bunch
+
+from .. import extract
+from ..extract import extract_spike_waveforms
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+class _MockModel(object):
+    sample_rate = 10000.
+    n_samples_waveforms = 20
+    n_closest_channels = 3
+    n_templates = 4
+    n_channels_dat = 8
+    dtype = np.int16
+    offset = 0
+    spike_waveforms = None
+
+    def __init__(self, dir_path, n_spikes=1000):
+        self.dir_path = dir_path
+        arr = (100 * np.random.randn(55000, self.n_channels_dat)).astype(np.int16)
+        arr.tofile(str(dir_path / 'raw.bin'))
+        self.dat_path = [dir_path / 'raw.bin']
+        self.channel_mapping = np.arange(self.n_channels_dat)[::-1].copy()
+        self.traces = get_ephys_reader(
+            self.dat_path, n_channels_dat=self.n_channels_dat, dtype=self.dtype,
+            sample_rate=self.sample_rate)[:, self.channel_mapping]
+        self.spike_samples = np.sort(np.random.randint(0, arr.shape[0], n_spikes))
+        self.spike_templates = np.random.randint(0, self.n_templates, n_spikes)
+        self.spike_clusters = self.spike_templates.copy()
+
+    def _template_n_channels(self, template_id, n_channels):
+        return ([template_id, template_id + 1] + [-1] * n_channels)[:n_channels]
+
+    def _load_spike_waveforms(self):
+        path = str(self.dir_path / '_phy_spikes_subset.%s.npy')
+        return Bunch(
+            waveforms=np.load(path % 'waveforms', mmap_mode='r'),
+            spike_ids=np.load(path % 'spikes'),
+            spike_channels=np.load(path % 'channels'),
+        )
+
+
+def _check_waveforms(model):
+    sw = model.spike_waveforms
+    for i, spike_id in enumerate(sw.spike_ids):
+        channel_ids = sw.spike_channels[i]
+        expected = extract_waveforms(
+            model.traces, model.spike_samples[[spike_id]], channel_ids,
+            n_samples_waveforms=model.n_samples_waveforms)[0]
+        expected[:, channel_ids < 0] = 0
+        ae(sw.waveforms[i], expected)
+
+
+def test_extract_spike_waveforms(tempdir):
+    model = _MockModel(tempdir)
+    n = extract_spike_waveforms(
+        model, n_spikes_per_cluster=50, max_n_channels=4, n_jobs=2, chunk_duration=2.)
+    assert n == 200
+    assert model.spike_waveforms.waveforms.shape == (200, 20, 4)
+    # Spikes are evenly spread in time within every cluster.
+    spike_ids = model.spike_waveforms.spike_ids
+    assert np.all(np.bincount(model.spike_clusters[spike_ids]) == 50)
+    _check_waveforms(model)
+    assert not (tempdir / '_phy_spikes_subset.progress.npy').exists()
+
+    # Already extracted.
+    assert extract_spike_waveforms(model, n_jobs=1) == 200
+
+
+def test_extract_spike_waveforms_resume(tempdir, monkeypatch):
+    model = _MockModel(tempdir)
+    _extract_chunk = extract._extract_chunk
+
+    def _interrupted(traces, i0, *args):
+        if i0 >= 20000:
+            raise KeyboardInterrupt()
+        return _extract_chunk(traces, i0, *args)
+
+    monkeypatch.setattr(extract, '_extract_chunk', _interrupted)
+    with raises(KeyboardInterrupt):
+        extract_spike_waveforms(model, n_jobs=1, chunk_duration=2.)
+    ae(np.load(str(tempdir / '_phy_spikes_subset.progress.npy')), [True, True, False])
+    assert not (tempdir / '_phy_spikes_subset.waveforms.npy').exists()
+
+    # Resume the extraction.
+    monkeypatch.setattr(extract, '_extract_chunk', _extract_chunk)
+    extract_spike_waveforms(model, n_jobs=1, chunk_duration=2.)
+    _check_waveforms(model)
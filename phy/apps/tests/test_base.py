@@ -6,6 +6,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from concurrent.futures import ThreadPoolExecutor
 from itertools import cycle, islice
 import logging
 import os
@@ -16,6 +17,7 @@ import unittest
 
 import numpy as np
 from pytestqt.plugin import QtBot
+from scipy.signal import butter, sosfiltfilt
 
 from phylib.io.mock import (
     artificial_features, artificial_traces, artificial_spike_clusters, artificial_spike_samples,
@@ -24,13 +26,16 @@ from phylib.io.mock import (
 
 from phylib.utils import connect, unconnect, Bunch, reset, emit
 
+from phy.cluster._trace_cache import TraceCache
 from phy.cluster.views import (
     WaveformView, FeatureView, AmplitudeView, TraceView, TemplateView,
 )
 from phy.gui.qt import Debouncer, create_app
 from phy.gui.widgets import Barrier
 from phy.plot.tests import mouse_click
-from ..base import BaseController, WaveformMixin, FeatureMixin, TraceMixin, TemplateMixin
+from ..base import (
+    BaseController, WaveformMixin, FeatureMixin, TraceMixin, TemplateMixin, SOSFilter,
+    RawDataFilter)
 
 logger = logging.getLogger(__name__)
 
@@ -560,3 +565,66 @@ class MockControllerFullTests(MinimalControllerTests, unittest.TestCase):
     def test_z5_select(self):
         self.next_best()
         self.next()
+
+
+#------------------------------------------------------------------------------
+# Raw data filter tests
+#------------------------------------------------------------------------------
+
+def test_sos_filter():
+    sos = butter(3, 150. / 25000 * 2, 'high', output='sos')
+    x = np.random.randn(20000, 70).cumsum(axis=0)
+
+    f = SOSFilter(sos, n_threads=3)
+    y = f(x, axis=0)
+    assert y.dtype == np.float32
+    assert y.shape == x.shape
+    # Same result as the zero-phase filter, away from the edges.
+    y_ = sosfiltfilt(sos, x, axis=0)
+    assert np.allclose(y[2000:-2000], y_[2000:-2000], atol=1e-2)
+    # Same result without threads.
+    assert np.allclose(SOSFilter(sos, n_threads=1)(x), y)
+
+    # Filtering along another axis.
+    w = np.random.randn(5, 80, 7)
+    assert np.allclose(f(w, axis=1)[2, :, 3], f(w[2, :, 3], axis=0))
+    assert f(np.zeros((0, 3))).shape == (0, 3)
+
+
+def test_sos_filter_chunks():
+    sos = butter(3, 150. / 25000 * 2, 'high', output='sos')
+    x = np.random.randn(11000, 40).cumsum(axis=0)
+    f = SOSFilter(sos)
+
+    # Every chunk is filtered from its own padding of 1000 samples on each side.
+    y = f(x)
+    y0 = f.filter_chunk(x[:6000])
+    y1 = f.filter_chunk(x[4000:])
+    assert y0.dtype == np.float32
+    assert np.allclose(y0[:5000], y[:5000], atol=1e-3)
+    assert np.allclose(y1[1000:6000], y[5000:10000], atol=1e-3)
+    assert f.filter_chunk(np.zeros((0, 3))).shape == (0, 3)
+
+
+def test_sos_filter_trace_cache():
+    sos = butter(3, 150. / 25000 * 2, 'high', output='sos')
+    x = np.random.randn(50000, 40).cumsum(axis=0)
+    f = RawDataFilter()
+    f.add_filter(SOSFilter(sos, n_threads=2), name='high_pass')
+    f.set('high_pass')
+
+    def _load(order):
+        c = TraceCache(traces=x, sample_rate=25000., raw_data_filter=f, chunk_duration=.4,
+                       enable_threading=False)
+        return [c.get_chunk(chunk_idx) for chunk_idx in order]
+
+    # The filtered chunks do not depend on the order in which they are loaded.
+    chunks = _load(range(5))
+    for chunk_idx, chunk in zip((4, 2, 0, 3, 1), _load((4, 2, 0, 3, 1))):
+        assert np.array_equal(chunk, chunks[chunk_idx])
+
+    # Concurrent calls of the same filter.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        ys = list(executor.map(lambda _: f.get('high_pass')(x[:5000]), range(8)))
+    for y in ys:
+        assert np.array_equal(y, ys[0])
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Inverted index from channels to the clusters having them among their best channels."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+from threading import RLock
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Channel cluster index
+#------------------------------------------------------------------------------
+
+class ChannelClusterIndex(object):
+    """Map every channel to the clusters which have it among their best channels, updated
+    incrementally after every clustering action.
+
+    The index is built at the first lookup from the best channels of all clusters. After a
+    clustering action, the deleted clusters are removed from the index, and the best channels
+    of the added clusters are only requested at the next lookup, so that the index does not
+    depend on the order in which the clustering event handlers are called.
+
+    When the best channels of a cluster are those of its best template, `best_templates` and
+    `template_channels` can be given instead of `best_channels`: the best templates of many
+    clusters are then obtained at once, and the channels of every template are only requested
+    once.
+
+    The index may be used from several threads: it is built in local dictionaries which are
+    only published once complete, and the lookups and updates are protected by a lock.
+
+    Constructor
+    -----------
+
+    best_channels : function
+        Function `cluster_id => channel_ids` returning the best channels of a cluster.
+    cluster_ids : function
+        Function returning the list of all current cluster ids.
+    best_templates : function
+        Function `cluster_ids => template_ids` returning the best template of many clusters.
+    template_channels : function
+        Function `template_id => channel_ids` returning the best channels of a template.
+
+    """
+
+    def __init__(
+            self, best_channels=None, cluster_ids=None, best_templates=None,
+            template_channels=None):
+        self.best_channels = best_channels
+        self.cluster_ids = cluster_ids
+        self.best_templates = best_templates
+        self.template_channels = template_channels
+        # cluster_id => array of channel ids
+        self._channels = None
+        # channel_id => set of cluster ids
+        self._clusters = {}
+        # template_id => array of channel ids
+        self._template_channels = {}
+        # Added clusters not indexed yet.
+        self._pending = set()
+        self._lock = RLock()
+
+    def _get_best_channels(self, cluster_ids):
+        """Return the best channels of some clusters."""
+        if self.best_templates is None or self.template_channels is None:
+            return [
+                np.asarray(self.best_channels(cluster_id), dtype=np.int64).ravel()
+                for cluster_id in cluster_ids]
+        template_ids = np.asarray(self.best_templates(cluster_ids), dtype=np.int64)
+        for template_id in np.unique(template_ids).tolist():
+            if template_id not in self._template_channels:
+                self._template_channels[template_id] = np.asarray(
+                    self.template_channels(template_id), dtype=np.int64).ravel()
+        return [self._template_channels[template_id] for template_id in template_ids.tolist()]
+
+    def _add(self, cluster_ids, channels, clusters):
+        """Index the best channels of some clusters in the given dictionaries."""
+        best = self._get_best_channels(cluster_ids)
+        for cluster_id, channel_ids in zip(cluster_ids, best):
+            channels[cluster_id] = channel_ids
+        if not best:
+            return
+        # Group the (channel, cluster) pairs by channel in one shot.
+        ch = np.concatenate(best)
+        cl = np.repeat(np.asarray(cluster_ids, dtype=np.int64), [len(c) for c in best])
+        order = np.argsort(ch, kind='stable')
+        ch, cl = ch[order], cl[order]
+        split = np.nonzero(np.diff(ch))[0] + 1
+        for channel_id, cls in zip(ch[np.r_[0, split]], np.split(cl, split)):
+            clusters.setdefault(int(channel_id), set()).update(cls.tolist())
+
+    def _remove(self, cluster_id):
+        for channel_id in self._channels.pop(cluster_id, ()):
+            clusters = self._clusters.get(int(channel_id), None)
+            if clusters is not None:
+                clusters.discard(cluster_id)
+
+    def _ensure_built(self):
+        with self._lock:
+            if self._channels is None:
+                cluster_ids = [int(c) for c in self.cluster_ids()]
+                channels, clusters = {}, {}
+                self._add(cluster_ids, channels, clusters)
+                self._clusters = clusters
+                self._channels = channels
+                self._pending.clear()
+                logger.log(5, "Built the channel index of %d clusters.", len(cluster_ids))
+            elif self._pending:
+                self._add(sorted(self._pending), self._channels, self._clusters)
+                self._pending.clear()
+
+    def update(self, up):
+        """Update the index after a clustering action, using an `UpdateInfo` instance."""
+        if up.description not in ('merge', 'assign'):
+            return
+        with self._lock:
+            if self._channels is None:
+                return
+            for cluster_id in up.deleted:
+                self._pending.discard(cluster_id)
+                self._remove(cluster_id)
+            self._pending.update(up.added)
+
+    def clusters_on_channel(self, channel_id):
+        """Return the sorted clusters having a given channel among their best channels."""
+        with self._lock:
+            self._ensure_built()
+            return sorted(self._clusters.get(int(channel_id), ()))
+
+    def channels(self, cluster_id):
+        """Return the indexed best channels of a cluster."""
+        with self._lock:
+            self._ensure_built()
+            return self._channels[cluster_id]
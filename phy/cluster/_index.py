@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental index of the spikes belonging to every cluster."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from phylib.utils._misc import save_json, load_json
+from phylib.utils._types import _as_array
+from phylib.io.array import _unique, _spikes_per_cluster
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# ClusterIndex class
+#------------------------------------------------------------------------------
+
+class ClusterIndex(object):
+    """Index of the spikes belonging to every cluster, updated incrementally.
+
+    The index holds the sorted array of non-empty cluster ids, the sorted spike ids of every
+    cluster, and the number of spikes in every cluster. Clustering actions only remove
+    clusters and add new ones, so that the index is updated by dropping the entries of the
+    removed clusters and inserting the entries of the new clusters. The cost of an update
+    therefore scales with the size of the affected clusters, and not with the total number
+    of spikes.
+
+    Constructor
+    -----------
+
+    spike_clusters : array-like
+        Spike-cluster assignments, giving the cluster id of every spike.
+    spikes_per_cluster : dict
+        Optional precomputed dictionary `{cluster_id: spike_ids}`. It is only used if it is
+        coherent with `spike_clusters`, otherwise it is recomputed.
+
+    """
+
+    def __init__(self, spike_clusters=None, spikes_per_cluster=None):
+        self._spikes_per_cluster = {}
+        self._cluster_ids = np.array([], dtype=np.int64)
+        self._spike_counts = np.array([], dtype=np.int64)
+        if spike_clusters is not None:
+            self.rebuild(spike_clusters, spikes_per_cluster=spikes_per_cluster)
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the ids of all non-empty clusters."""
+        return self._cluster_ids
+
+    @property
+    def spikes_per_cluster(self):
+        """A dictionary {cluster_id: spike_ids}."""
+        return self._spikes_per_cluster
+
+    @property
+    def spike_counts(self):
+        """Number of spikes in every cluster, in the same order as `cluster_ids`."""
+        return self._spike_counts
+
+    def spike_count(self, cluster_id):
+        """Number of spikes in a given cluster."""
+        return len(self._spikes_per_cluster.get(cluster_id, ()))
+
+    def spikes_in_clusters(self, cluster_ids):
+        """Return the sorted array of spike ids belonging to a list of clusters."""
+        spc = self._spikes_per_cluster
+        arrs = [spc[clu] for clu in cluster_ids if clu in spc]
+        if not arrs:
+            return np.array([], dtype=np.int64)
+        if len(arrs) == 1:
+            return _as_array(arrs[0])
+        return np.sort(np.concatenate(arrs))
+
+    def rebuild(self, spike_clusters, spikes_per_cluster=None):
+        """Rebuild the whole index from a spike_clusters array.
+
+        This operation is linear in the number of spikes. The `spikes_per_cluster` dictionary
+        is recomputed if the one passed is missing some clusters.
+
+        """
+        cluster_ids = _unique(spike_clusters)
+        spc = dict(spikes_per_cluster or {})
+        # If spikes_per_cluster is invalid, recompute the entire
+        # spikes_per_cluster array.
+        if not np.all(np.isin(cluster_ids, sorted(spc))):
+            logger.debug("Recompute spikes_per_cluster manually: this might take a while.")
+            spc = _spikes_per_cluster(_as_array(spike_clusters))
+        self._spikes_per_cluster = spc
+        self._cluster_ids = cluster_ids.astype(np.int64)
+        self._spike_counts = np.array(
+            [len(spc[clu]) for clu in cluster_ids], dtype=np.int64)
+
+    def update(self, to_remove=None, to_add=None):
+        """Remove some clusters and add new ones.
+
+        Parameters
+        ----------
+
+        to_remove : array-like
+            List of cluster ids to remove from the index.
+        to_add : dict
+            Dictionary `{cluster_id: spike_ids}` of the clusters to add to the index. The spike
+            ids of every cluster are expected to be sorted.
+
+        """
+        to_remove = list(to_remove) if to_remove is not None else []
+        to_add = to_add or {}
+        spc = self._spikes_per_cluster
+        for clu in to_remove:
+            spc.pop(clu, None)
+        for clu, spk in to_add.items():
+            spc[clu] = _as_array(spk)
+        changed = np.array(sorted(set(to_remove) | set(to_add)), dtype=np.int64)
+        if not len(changed):
+            return
+        # Drop the entries of all changed clusters.
+        keep = ~np.isin(self._cluster_ids, changed)
+        cluster_ids = self._cluster_ids[keep]
+        spike_counts = self._spike_counts[keep]
+        # Insert the entries of the non-empty new clusters.
+        added = np.array(
+            sorted(clu for clu in to_add if clu >= 0 and len(spc[clu])), dtype=np.int64)
+        if len(added):
+            counts = np.array([len(spc[clu]) for clu in added], dtype=np.int64)
+            idx = np.searchsorted(cluster_ids, added)
+            cluster_ids = np.insert(cluster_ids, idx, added)
+            spike_counts = np.insert(spike_counts, idx, counts)
+        self._cluster_ids = cluster_ids
+        self._spike_counts = spike_counts
+
+
+#------------------------------------------------------------------------------
+# On-disk storage of spikes_per_cluster
+#------------------------------------------------------------------------------
+
+def _spike_clusters_hash(spike_clusters):
+    """Return a hash of the contents of a spike_clusters array."""
+    arr = np.ascontiguousarray(spike_clusters, dtype=np.int64)
+    return hashlib.sha1(memoryview(arr).cast('B')).hexdigest()
+
+
+class SpikesPerClusterStore(object):
+    """Compact, memory-mapped on-disk storage of a spikes_per_cluster dictionary.
+
+    The store is a directory containing:
+
+    * `header.json`: format version, number of spikes, hash of the spike_clusters array the
+      store corresponds to, and names of the cluster table and of the segment files.
+    * `clusters_<gen>.npy`: a `(n_clusters, 4)` int64 table with, for every cluster, its id,
+      the segment containing its spikes, and the start and stop offsets within the segment.
+    * `spikes_<k>.bin`: flat int64 buffers with the sorted spike ids of successive clusters.
+
+    Loading memory-maps the segments, so that the spikes of a cluster are only read from disk
+    when they are accessed. Since cluster ids are never reused, saving only appends the
+    spikes of the clusters that are not in the store yet, in a new segment. The segments are
+    compacted when more than `compact_ratio` of their spikes belong to deleted clusters.
+
+    Constructor
+    -----------
+
+    path : str or Path
+        Path to the store directory.
+
+    """
+
+    version = 1
+    compact_ratio = .5
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._header = None
+        # Mapping {cluster_id: (segment, start, stop)} of the clusters saved in the store.
+        self._table = {}
+
+    def _read_header(self):
+        path = self.path / 'header.json'
+        if not path.exists():
+            return
+        try:
+            header = load_json(path)
+        except Exception as e:  # pragma: no cover
+            logger.debug("Unable to read `%s`: %s.", path, str(e))
+            return
+        if header.get('version', None) != self.version:
+            logger.debug("Discard spikes_per_cluster store with a different version.")
+            return
+        return header
+
+    def _read_table(self, header):
+        table = np.load(self.path / header['table'])
+        return {
+            int(clu): (int(seg), int(start), int(stop))
+            for clu, seg, start, stop in table}
+
+    def load(self, spike_clusters, digest=None):
+        """Load the spikes_per_cluster dictionary, if the store matches the spike_clusters array.
+
+        The spike ids of every cluster are read-only memory-mapped arrays. Return None if the
+        store does not exist or is invalid. The hash of the spike_clusters array may be passed
+        as `digest` if it is already known.
+
+        """
+        header = self._read_header()
+        if header is None:
+            return
+        if (header['n_spikes'] != len(spike_clusters) or
+                header['hash'] != (digest or _spike_clusters_hash(spike_clusters))):
+            logger.debug("The spikes_per_cluster store is outdated, discarding it.")
+            return
+        try:
+            table = self._read_table(header)
+            segments = [
+                np.memmap(self.path / name, dtype=np.int64, mode='r')
+                for name in header['segments']]
+        except Exception as e:  # pragma: no cover
+            logger.debug("Unable to load the spikes_per_cluster store: %s.", str(e))
+            return
+        self._header = header
+        self._table = table
+        logger.debug("Loaded spikes_per_cluster store with %d clusters.", len(table))
+        return {
+            clu: segments[seg][start:stop] for clu, (seg, start, stop) in table.items()}
+
+    def _write_segment(self, name, cluster_ids, spikes_per_cluster, segment):
+        """Write the spikes of some clusters in a new segment file and return their entries."""
+        entries = {}
+        offset = 0
+        with open(str(self.path / name), 'wb') as f:
+            for clu in cluster_ids:
+                spikes = np.ascontiguousarray(spikes_per_cluster[clu], dtype=np.int64)
+                f.write(spikes.tobytes())
+                entries[clu] = (segment, offset, offset + len(spikes))
+                offset += len(spikes)
+        return entries
+
+    def _remove_unused_files(self, header):
+        used = set(header['segments']) | {header['table'], 'header.json'}
+        for path in self.path.iterdir():
+            if path.name not in used:
+                try:
+                    path.unlink()
+                except OSError:  # pragma: no cover
+                    # NOTE: on Windows, memory-mapped files cannot be deleted, they will be
+                    # deleted at the next compaction.
+                    logger.debug("Unable to delete `%s`.", path)
+
+    def save(self, spike_clusters, spikes_per_cluster, digest=None):
+        """Save the spikes_per_cluster dictionary corresponding to a spike_clusters array.
+
+        Only the clusters that are not in the store yet are written to disk. The hash of the
+        spike_clusters array may be passed as `digest` if it is already known.
+
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        # NOTE: the existing segments are only reused if the store has been validated by a
+        # previous call to load() or save(), otherwise they are discarded.
+        header = self._header or {'segments': [], 'gen': 0}
+        if not self._header:
+            self._table = {}
+        spc = spikes_per_cluster
+        cluster_ids = sorted(spc)
+        table = {
+            clu: self._table[clu] for clu in cluster_ids
+            if clu in self._table and self._table[clu][2] - self._table[clu][1] == len(spc[clu])}
+        new_clusters = [clu for clu in cluster_ids if clu not in table]
+        segments = list(header['segments'])
+        # Use a new generation number so that the files of the previous generation are never
+        # overwritten.
+        old = self._read_header()
+        gen = max(header['gen'], old['gen'] if old else 0) + 1
+
+        n_live = sum(stop - start for (_, start, stop) in table.values())
+        n_total = sum(
+            (self.path / name).stat().st_size // 8 for name in segments
+            if (self.path / name).exists())
+        if n_total and n_live < (1 - self.compact_ratio) * n_total:
+            # Compaction: rewrite all clusters in a single segment.
+            logger.debug("Compact the spikes_per_cluster store.")
+            segments, table, new_clusters = [], {}, cluster_ids
+
+        new_spikes = sum(len(spc[clu]) for clu in new_clusters)
+        if new_spikes:
+            name = 'spikes_%d.bin' % gen
+            table.update(self._write_segment(name, new_clusters, spc, len(segments)))
+            segments.append(name)
+
+        # Save the cluster table.
+        arr = np.array(
+            [(clu,) + table[clu] for clu in cluster_ids], dtype=np.int64).reshape((-1, 4))
+        table_name = 'clusters_%d.npy' % gen
+        np.save(self.path / table_name, arr)
+
+        # The header is written last and atomically: it switches to the new table and segments.
+        header = {
+            'version': self.version,
+            'n_spikes': len(spike_clusters),
+            'hash': digest or _spike_clusters_hash(spike_clusters),
+            'table': table_name,
+            'segments': segments,
+            'gen': gen,
+        }
+        save_json(self.path / 'header.json', header)
+        self._header = header
+        self._table = table
+        logger.debug(
+            "Saved spikes_per_cluster store with %d new clusters (%d spikes).",
+            len(new_clusters), new_spikes)
+        self._remove_unused_files(header)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""Columnar table of cluster metrics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+from pickle import dump, load
+
+import numpy as np
+
+from phylib.utils import Bunch
+from ._index import _spike_clusters_hash
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Cluster metrics
+#------------------------------------------------------------------------------
+
+def _to_column(values):
+    """Convert a list of values returned by a per-cluster metric function into a column."""
+    out = np.empty(len(values), dtype=object)
+    out[:] = values
+    return out
+
+
+def _same_value(a, b):
+    """Compare two metric values, NaN values being considered equal."""
+    return a == b or (a != a and b != b)
+
+
+def _function_name(f):
+    return '%s.%s' % (getattr(f, '__module__', ''), getattr(f, '__qualname__', repr(f)))
+
+
+def metrics_fingerprint(
+        spike_clusters, metrics=None, vectorized=None, extra='', digest=None):
+    """Return a fingerprint of the data the cluster metrics are computed from: the
+    spike_clusters array, the names and functions of the metrics, and an extra string
+    identifying the other data files. The hash of the spike_clusters array may be passed as
+    `digest` if it is already known."""
+    digest = digest or _spike_clusters_hash(spike_clusters)
+    h = hashlib.sha1(digest.encode('utf-8'))
+    for functions in (metrics or {}, vectorized or {}):
+        for name in sorted(functions):
+            h.update(('%s:%s;' % (name, _function_name(functions[name]))).encode('utf-8'))
+    h.update(str(extra).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ClusterMetrics(object):
+    """Table of cluster metrics, with one array per metric and one row per cluster, updated
+    incrementally after every clustering action.
+
+    A metric is either a vectorized function `cluster_ids => values` computing the metric of many
+    clusters at once, or a function `cluster_id => value` called on every cluster. The table is
+    computed at the first access. After a clustering action, the rows of the deleted clusters
+    are removed, and only the rows of the added clusters are computed, at the next access.
+
+    The table can be saved to and loaded from a snapshot file, so that it is not recomputed
+    at every launch. A snapshot is only loaded if its fingerprint matches the fingerprint of
+    the current data (see `metrics_fingerprint()`).
+
+    Constructor
+    -----------
+
+    metrics : dict
+        Maps a metric name to a function `cluster_id => value`.
+    vectorized : dict
+        Maps a metric name to a function `cluster_ids => values`, used instead of the
+        per-cluster function when both are specified.
+    cluster_ids : function
+        Function returning the sorted list of all current cluster ids.
+
+    """
+
+    # Version of the snapshot file format.
+    snapshot_version = 1
+
+    def __init__(self, metrics=None, vectorized=None, cluster_ids=None):
+        self.metrics = metrics if metrics is not None else {}
+        self.vectorized = vectorized if vectorized is not None else {}
+        self.cluster_ids = cluster_ids
+        # Sorted cluster ids of the rows of the table.
+        self._ids = None
+        # metric name => column array
+        self._columns = {}
+        # Added clusters not in the table yet.
+        self._pending = set()
+        # Whether the table has been loaded from a snapshot and not recomputed since.
+        self.from_snapshot = False
+
+    @property
+    def names(self):
+        """Names of all metrics."""
+        return list(self.metrics) + [name for name in self.vectorized if name not in self.metrics]
+
+    def _compute(self, name, cluster_ids):
+        """Compute a metric on some clusters."""
+        f = self.vectorized.get(name, None)
+        if f is not None:
+            out = np.asarray(f(np.asarray(cluster_ids, dtype=np.int64)))
+            assert out.shape == (len(cluster_ids),)
+            return out
+        f = self.metrics[name]
+        return _to_column([f(cluster_id) for cluster_id in cluster_ids])
+
+    def _ensure_built(self):
+        if self._ids is None:
+            self._ids = np.asarray(self.cluster_ids(), dtype=np.int64)
+            self._columns = {}
+            self._pending.clear()
+            logger.log(5, "Built the metrics table of %d clusters.", len(self._ids))
+        elif self._pending:
+            added = np.array(sorted(self._pending), dtype=np.int64)
+            ids = np.concatenate((self._ids, added))
+            order = np.argsort(ids, kind='stable')
+            self._ids = ids[order]
+            for name, column in self._columns.items():
+                self._columns[name] = np.concatenate(
+                    (column, self._compute(name, added)))[order]
+            self._pending.clear()
+        # Compute the metrics which have been added after the table was built.
+        for name in self.names:
+            if name not in self._columns:
+                self._columns[name] = self._compute(name, self._ids)
+
+    def update(self, up):
+        """Update the table after a clustering action, using an `UpdateInfo` instance."""
+        if self._ids is None or up.description not in ('merge', 'assign'):
+            return
+        self._pending.difference_update(up.deleted)
+        keep = ~np.isin(self._ids, up.deleted)
+        self._ids = self._ids[keep]
+        self._columns = {name: column[keep] for name, column in self._columns.items()}
+        self._pending.update(up.added)
+        logger.log(
+            5, "Updated the metrics table with %d deleted and %d added clusters.",
+            len(up.deleted), len(up.added))
+
+    def column(self, name, cluster_ids=None):
+        """Return the values of a metric for some clusters, or all clusters."""
+        self._ensure_built()
+        if cluster_ids is None:
+            return self._columns[name]
+        return self._columns[name][self._rows(cluster_ids)]
+
+    def _rows(self, cluster_ids):
+        rows = np.searchsorted(self._ids, cluster_ids)
+        assert np.all(self._ids[np.clip(rows, 0, len(self._ids) - 1)] == cluster_ids)
+        return rows
+
+    def get(self, cluster_id):
+        """Return a dictionary with the metrics of a cluster."""
+        self._ensure_built()
+        i = np.searchsorted(self._ids, cluster_id)
+        if i == len(self._ids) or self._ids[i] != cluster_id:
+            # The cluster is not in the table, the metrics are computed on the fly.
+            return {
+                name: self._compute(name, [cluster_id]).tolist()[0] for name in self.names}
+        return {name: self._columns[name][i:i + 1].tolist()[0] for name in self.names}
+
+    def rows(self, cluster_ids=None):
+        """Return a list of dictionaries with the metrics of some clusters, or all clusters."""
+        self._ensure_built()
+        rows = slice(None, None) if cluster_ids is None else self._rows(cluster_ids)
+        ids = self._ids[rows].tolist()
+        names = self.names
+        columns = [self._columns[name][rows].tolist() for name in names]
+        values = zip(*columns) if columns else [()] * len(ids)
+        return [dict(id=cluster_id, **dict(zip(names, v))) for cluster_id, v in zip(ids, values)]
+
+    # Snapshot
+    # -------------------------------------------------------------------------
+
+    def save(self, path, fingerprint):
+        """Save the full table in a snapshot file, with the fingerprint of the current data."""
+        self._ensure_built()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            'version': self.snapshot_version, 'fingerprint': fingerprint,
+            'ids': self._ids, 'columns': self._columns}
+        # Write to a temporary file first so that an interrupted save does not leave a
+        # corrupted snapshot.
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(str(tmp_path), 'wb') as fd:
+            dump(data, fd)
+        os.replace(str(tmp_path), str(path))
+        logger.debug("Saved the cluster metrics snapshot of %d clusters.", len(self._ids))
+
+    def load(self, path, fingerprint):
+        """Load the table from a snapshot file in a single read, if the snapshot matches the
+        fingerprint of the current data. Return whether the snapshot has been loaded."""
+        path = Path(path)
+        if not path.exists():
+            return False
+        try:
+            with open(str(path), 'rb') as fd:
+                data = load(fd)
+        except Exception as e:
+            logger.debug("Unable to read the cluster metrics snapshot: %s.", str(e))
+            return False
+        if (data.get('version', None) != self.snapshot_version or
+                data.get('fingerprint', None) != fingerprint):
+            logger.debug("The cluster metrics snapshot is outdated, discarding it.")
+            return False
+        self._ids = data['ids']
+        self._columns = data['columns']
+        self._pending.clear()
+        self.from_snapshot = True
+        logger.debug("Loaded the cluster metrics snapshot of %d clusters.", len(self._ids))
+        return True
+
+    def iter_compute(self, batch_size=None):
+        """Compute the full table by batches of `batch_size` clusters, without modifying the
+        current table.
+
+        This generator yields None after every batch, and finally the table to pass to
+        `set_table()`, so that the computation can be interleaved with the GUI events. The
+        vectorized metrics are computed at once in the last step.
+
+        """
+        ids = np.asarray(self.cluster_ids(), dtype=np.int64)
+        batch_size = batch_size or max(1, len(ids))
+        names = self.names
+        values = {name: [] for name in names if name not in self.vectorized}
+        for i in range(0, len(ids), batch_size):
+            for name in values:
+                f = self.metrics[name]
+                values[name].extend(f(cluster_id) for cluster_id in ids[i:i + batch_size])
+            yield
+        columns = {
+            name: _to_column(values[name]) if name in values else self._compute(name, ids)
+            for name in names}
+        yield Bunch(ids=ids, columns=columns)
+
+    def compute(self):
+        """Compute the full table, without modifying the current table.
+
+        The result should be passed to `set_table()`.
+
+        """
+        for table in self.iter_compute():
+            pass
+        return table
+
+    def set_table(self, table):
+        """Replace the table by a table returned by `compute()`, and return the ids of the
+        clusters with changed metrics.
+
+        Return None if the clusters have changed since the table was computed.
+
+        """
+        self._ensure_built()
+        if not np.array_equal(self._ids, table.ids):
+            logger.debug("The clusters have changed since the metrics were computed.")
+            return
+        changed = np.zeros(len(self._ids), dtype=bool)
+        for name, column in table.columns.items():
+            old = self._columns.get(name, None)
+            if old is None or old.shape != column.shape:
+                changed[:] = True
+                continue
+            changed |= np.array(
+                [not _same_value(a, b) for a, b in zip(old.tolist(), column.tolist())],
+                dtype=bool)
+        self._columns = dict(table.columns)
+        self.from_snapshot = False
+        return self._ids[changed].tolist()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Background prefetch of the data of the clusters that are likely to be selected next."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+from phy.gui.qt import thread_pool, Worker
+from phy.utils.context import _nbytes
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Prefetcher class
+#------------------------------------------------------------------------------
+
+class Prefetcher(object):
+    """Call cached data getters in the background on the clusters that are likely to be selected
+    next, so that the views find their data in the cache when these clusters are selected.
+
+    Every call to `prefetch()` cancels the pending prefetch, so that only the candidates of the
+    latest selection are processed. The candidates are processed in order, and a prefetch stops
+    once the data returned by the getters exceeds `max_bytes`.
+
+    The getters are called from the Qt thread pool, concurrently with the GUI thread, so they
+    must be thread-safe. This is the case of the functions memcached by the `Context`, whose
+    memcache is protected by a lock.
+
+    Constructor
+    -----------
+
+    n_clusters : int
+        Maximum number of candidate clusters to prefetch after every selection. Prefetching is
+        disabled when it is 0.
+    max_bytes : int
+        Maximum size of the data computed by a single prefetch.
+    enable_threading : boolean
+        Whether to prefetch in the Qt thread pool, or synchronously (used in tests).
+
+    """
+
+    n_clusters = 3
+    max_bytes = 256 * 1024 ** 2
+    # Priority of the prefetch tasks in the thread pool, lower than the view updates.
+    priority = -1
+
+    def __init__(self, n_clusters=None, max_bytes=None, enable_threading=True):
+        if n_clusters is not None:
+            self.n_clusters = n_clusters
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._enable_threading = enable_threading
+        self._functions = []
+        # Incremented at every prefetch or cancellation, so that the running prefetch stops.
+        self._generation = 0
+
+    @property
+    def functions(self):
+        """List of the data getters to prefetch."""
+        return self._functions
+
+    def add(self, f):
+        """Add a data getter `cluster_id => data` to call on the candidate clusters. The
+        function should be cached, otherwise the prefetch is useless."""
+        self._functions.append(f)
+
+    def cancel(self):
+        """Cancel the pending prefetch."""
+        self._generation += 1
+
+    def prefetch(self, cluster_ids, exclude=()):
+        """Cancel the pending prefetch and prefetch the data of some clusters.
+
+        Parameters
+        ----------
+
+        cluster_ids : list
+            Candidate cluster ids, ordered by decreasing likelihood of being selected next.
+            Only the first `n_clusters` clusters are prefetched.
+        exclude : list
+            Cluster ids to skip, typically the clusters currently selected, since the views
+            are already computing their data.
+
+        """
+        self.cancel()
+        if not self.n_clusters or not self._functions:
+            return
+        exclude = set(exclude)
+        candidates = []
+        for cluster_id in cluster_ids:
+            if cluster_id not in exclude and cluster_id not in candidates:
+                candidates.append(cluster_id)
+        candidates = candidates[:self.n_clusters]
+        if not candidates:
+            return
+        logger.log(5, "Prefetch clusters %s.", candidates)
+        generation = self._generation
+        if not self._enable_threading:
+            return self._run(candidates, generation)
+        thread_pool().start(Worker(self._run, candidates, generation), self.priority)
+
+    def _run(self, cluster_ids, generation):
+        """Call all data getters on the clusters, until the prefetch is cancelled or the size
+        limit is reached. Return the number of successful calls."""
+        n = 0
+        nbytes = 0
+        for cluster_id in cluster_ids:
+            for f in self._functions:
+                if generation != self._generation:
+                    logger.log(5, "Prefetch of clusters %s cancelled.", cluster_ids)
+                    return n
+                if nbytes > self.max_bytes:
+                    logger.debug("Prefetch size limit reached.")
+                    return n
+                try:
+                    nbytes += _nbytes(f(cluster_id))
+                    n += 1
+                except Exception as e:
+                    # The cluster may have been deleted in the meantime.
+                    logger.debug("Unable to prefetch cluster %s: %s.", cluster_id, str(e))
+        return n
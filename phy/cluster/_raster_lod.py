@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Per-cluster spike density in time bins, for zoomed-out raster views."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+from phylib.utils import Bunch
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _bin_counts(
+        spike_times, spike_clusters, cluster_ids, interval, n_bins, chunk_size=1 << 22):
+    """Return the `(n_clusters, n_bins)` spike counts of some clusters in consecutive time bins
+    of an interval. The spike times must be sorted. The spikes are processed by chunks so that
+    the temporary arrays remain small."""
+    cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+    counts = np.zeros((len(cluster_ids), n_bins), dtype=np.int64)
+    t0, t1 = interval
+    if not len(cluster_ids) or n_bins <= 0 or t1 <= t0:
+        return counts
+    # Rank of every cluster in cluster_ids, -1 for the other clusters (last item).
+    rank = -np.ones(cluster_ids.max() + 2, dtype=np.int64)
+    rank[cluster_ids] = np.arange(len(cluster_ids))
+    i0 = np.searchsorted(spike_times, t0, side='left')
+    i1 = np.searchsorted(spike_times, t1, side='right')
+    flat = counts.ravel()
+    for a in range(i0, i1, chunk_size):
+        b = min(a + chunk_size, i1)
+        r = rank[np.minimum(spike_clusters[a:b], len(rank) - 1)]
+        bins = ((spike_times[a:b] - t0) * (n_bins / (t1 - t0))).astype(np.int64)
+        np.clip(bins, 0, n_bins - 1, out=bins)
+        keep = r >= 0
+        flat += np.bincount(r[keep] * n_bins + bins[keep], minlength=flat.size)
+    return counts
+
+
+def _merge_bins(counts, factor):
+    """Sum groups of `factor` consecutive bins of a `(n_rows, n_bins)` array. The last group
+    may be incomplete."""
+    n_rows, n_bins = counts.shape
+    if factor == 1 or n_bins == 0:
+        return counts
+    n_full = n_bins // factor
+    out = counts[:, :n_full * factor].reshape((n_rows, n_full, factor)).sum(axis=2)
+    if n_bins > n_full * factor:
+        out = np.c_[out, counts[:, n_full * factor:].sum(axis=1)]
+    return out
+
+
+def _normalize_counts(counts, floor=.2):
+    """Normalize the spike counts of every row between `floor` and 1, the bins without spikes
+    remaining at 0 so that they are not displayed."""
+    counts = np.asarray(counts, dtype=np.float64)
+    if not counts.size:
+        return counts.astype(np.float32)
+    m = counts.max(axis=1, keepdims=True)
+    out = floor + (1 - floor) * counts / np.maximum(m, 1)
+    out[counts <= 0] = 0
+    return out.astype(np.float32)
+
+
+#------------------------------------------------------------------------------
+# Raster density
+#------------------------------------------------------------------------------
+
+class RasterDensity(object):
+    """Spike counts of every cluster in consecutive time bins, used to display the raster plot
+    of long recordings without sending every spike to the GPU.
+
+    The counts of every cluster over the whole recording, with `n_bins` bins, are computed by
+    chunks the first time the cluster is requested, and kept in memory. As a cluster id always
+    refers to the same set of spikes during a session (new clusters get new ids), the counts
+    remain valid after clustering actions, and only the counts of the new clusters need to be
+    computed.
+
+    Constructor
+    -----------
+
+    spike_times : array-like
+        An `(n_spikes,)` array with the sorted spike times, in seconds.
+    spike_clusters : array-like
+        An `(n_spikes,)` array with the spike-cluster assignments.
+    duration : float
+        The duration of the recording, in seconds.
+
+    """
+
+    n_bins = 4096
+    chunk_size = 1 << 22  # in spikes
+
+    def __init__(self, spike_times, spike_clusters, duration=None):
+        self.spike_times = spike_times
+        self.spike_clusters = spike_clusters
+        self.duration = duration if duration is not None else spike_times[-1]
+        # cluster_id => (n_bins,) array with the spike counts over the whole recording.
+        self._rows = {}
+
+    @property
+    def bin_duration(self):
+        """Duration of the bins of the cached counts, in seconds."""
+        return self.duration / self.n_bins
+
+    def _ensure_rows(self, cluster_ids):
+        """Compute the cached counts of the clusters that are not in the cache yet."""
+        missing = [int(c) for c in cluster_ids if int(c) not in self._rows]
+        if not missing:
+            return
+        logger.debug("Compute the spike density of %d clusters.", len(missing))
+        counts = _bin_counts(
+            self.spike_times, self.spike_clusters, missing, (0, self.duration), self.n_bins,
+            chunk_size=self.chunk_size)
+        self._rows.update(zip(missing, counts))
+
+    def get(self, cluster_ids, interval=None, n_bins=None):
+        """Return the spike counts of some clusters in an interval, with about `n_bins` bins.
+
+        Return a Bunch with `counts`, an `(n_clusters, n_bins)` array, and `interval`, the
+        interval actually covered by the bins. The cached counts are used when their bins are
+        smaller than the requested bins, otherwise the counts are computed from the spikes
+        in the interval.
+
+        """
+        t0, t1 = interval if interval is not None else (0, self.duration)
+        t0, t1 = max(0, t0), min(self.duration, t1)
+        n_bins = n_bins or self.n_bins
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        bd = self.bin_duration
+        if (t1 - t0) / n_bins >= bd:
+            # Coarse bins: merge the cached bins.
+            self._ensure_rows(cluster_ids)
+            b0 = min(int(np.floor(t0 / bd)), self.n_bins - 1)
+            b1 = max(int(np.ceil(t1 / bd)), b0 + 1)
+            # The bins are aligned on multiples of the merging factor so that the display does
+            # not flicker when panning.
+            factor = max(1, (b1 - b0) // n_bins)
+            b0 = (b0 // factor) * factor
+            b1 = -(-b1 // factor) * factor
+            counts = np.zeros((len(cluster_ids), b1 - b0), dtype=np.int64)
+            for i, c in enumerate(cluster_ids.tolist()):
+                row = self._rows[c][b0:b1]
+                counts[i, :len(row)] = row
+            return Bunch(counts=_merge_bins(counts, factor), interval=(b0 * bd, b1 * bd))
+        # Fine bins: count the spikes in the interval.
+        counts = _bin_counts(
+            self.spike_times, self.spike_clusters, cluster_ids, (t0, t1), n_bins,
+            chunk_size=self.chunk_size)
+        return Bunch(counts=counts, interval=(t0, t1))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""Sparse cluster x template spike count matrix."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Cluster template counts
+#------------------------------------------------------------------------------
+
+class ClusterTemplateCounts(object):
+    """Number of spikes of every template in every cluster, as a sparse matrix updated
+    incrementally after every clustering action.
+
+    Every row is stored as the sorted template ids of the cluster and the corresponding spike
+    counts, so that a clustering action only requires to count the templates of the new
+    clusters. Operations on many clusters at once use a CSR matrix built from these rows, which
+    is kept until the next clustering action.
+
+    The initial rows are counted by chunks of `chunk_size` spikes, so that the temporary arrays
+    do not scale with the total number of spikes.
+
+    Constructor
+    -----------
+
+    spike_templates : array-like
+        The template of every spike.
+    spike_clusters : array-like
+        The initial cluster of every spike.
+    n_templates : int
+        Number of templates.
+    spikes_per_cluster : function
+        Function `cluster_id => spike_ids` returning the spikes of the current clusters.
+
+    """
+
+    chunk_size = 2 ** 22  # number of spikes counted at once
+
+    def __init__(
+            self, spike_templates=None, spike_clusters=None, n_templates=None,
+            spikes_per_cluster=None):
+        self.spike_templates = np.asarray(spike_templates, dtype=np.int64)
+        self.n_templates = (
+            n_templates if n_templates is not None else int(self.spike_templates.max()) + 1)
+        self.spikes_per_cluster = spikes_per_cluster
+        # cluster_id => (template_ids, counts)
+        self._rows = {}
+        # (cluster_ids, matrix) of the last call to `matrix()`.
+        self._matrix = None
+        if spike_clusters is not None:
+            self._set_rows(np.asarray(spike_clusters))
+
+    def _set_rows(self, spike_clusters):
+        """Count all templates of all clusters, by chunks of spikes."""
+        n = len(spike_clusters)
+        if not n:
+            return
+        # Every (cluster, template) pair is encoded as `cluster * n_templates + template`.
+        keys, counts = [], []
+        for i in range(0, n, self.chunk_size):
+            k = spike_clusters[i:i + self.chunk_size].astype(np.int64) * self.n_templates
+            k += self.spike_templates[i:i + self.chunk_size]
+            k, c = np.unique(k, return_counts=True)
+            keys.append(k)
+            counts.append(c)
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+        # The keys are sorted by cluster, and by template within every cluster.
+        clusters, templates = np.divmod(keys, self.n_templates)
+        bounds = np.r_[0, np.flatnonzero(np.diff(clusters)) + 1, len(keys)]
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            self._rows[int(clusters[i])] = (templates[i:j], counts[i:j])
+
+    def _compute_row(self, cluster_id):
+        spike_ids = self.spikes_per_cluster(cluster_id)
+        return np.unique(self.spike_templates[spike_ids], return_counts=True)
+
+    def _row(self, cluster_id):
+        row = self._rows.get(cluster_id, None)
+        if row is None:
+            row = self._rows[cluster_id] = self._compute_row(cluster_id)
+        return row
+
+    def update(self, up):
+        """Update the counts after a clustering action, using an `UpdateInfo` instance."""
+        if up.description not in ('merge', 'assign'):
+            return
+        self._matrix = None
+        for cluster_id in up.deleted:
+            self._rows.pop(cluster_id, None)
+        for cluster_id in up.added:
+            self._rows[cluster_id] = self._compute_row(cluster_id)
+        logger.log(
+            5, "Updated the template counts of %d deleted and %d added clusters.",
+            len(up.deleted), len(up.added))
+
+    def matrix(self, cluster_ids):
+        """Return the `(n_clusters, n_templates)` CSR count matrix of some clusters.
+
+        The matrix of the last requested clusters is kept until the next clustering action, and
+        should not be modified.
+
+        """
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        cached = self._matrix
+        if cached is not None and np.array_equal(cached[0], cluster_ids):
+            return cached[1]
+        rows = [self._row(int(cluster_id)) for cluster_id in cluster_ids]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(r[0]) for r in rows])
+        indices = np.concatenate([r[0] for r in rows]) if rows else np.zeros(0, dtype=np.int64)
+        data = np.concatenate([r[1] for r in rows]) if rows else np.zeros(0, dtype=np.int64)
+        m = csr_matrix((data, indices, indptr), shape=(len(rows), self.n_templates))
+        self._matrix = (cluster_ids.copy(), m)
+        return m
+
+    def counts(self, cluster_id):
+        """Return the number of spikes of every template in a cluster."""
+        template_ids, counts = self._row(cluster_id)
+        out = np.zeros(self.n_templates, dtype=np.int64)
+        out[template_ids] = counts
+        return out
+
+    def templates(self, cluster_id):
+        """Return the templates with at least one spike in a cluster."""
+        return self._row(cluster_id)[0]
+
+    def best_template(self, cluster_id):
+        """Return the template with the most spikes in a cluster."""
+        template_ids, counts = self._row(cluster_id)
+        return template_ids[np.argmax(counts)]
+
+    def best_templates(self, cluster_ids):
+        """Return the template with the most spikes in every cluster, the smallest template id
+        in case of a tie, or -1 for empty clusters."""
+        m = self.matrix(cluster_ids)
+        out = np.full(len(cluster_ids), -1, dtype=np.int64)
+        sizes = np.diff(m.indptr)
+        rows = np.repeat(np.arange(len(cluster_ids)), sizes)
+        # Sort the entries by row, by decreasing count, and by template id.
+        order = np.lexsort((m.indices, -m.data, rows))
+        nonempty = sizes > 0
+        out[nonempty] = m.indices[order[m.indptr[:-1][nonempty]]]
+        return out
+
+    def max_per_cluster(self, values, cluster_ids):
+        """Return, for every cluster, the maximum of a `(n_templates,)` array over the templates
+        of the cluster. Empty clusters get -inf."""
+        m = self.matrix(cluster_ids)
+        out = np.full(len(cluster_ids), -np.inf)
+        nonempty = np.diff(m.indptr) > 0
+        if np.any(nonempty):
+            values = np.asarray(values)[m.indices]
+            out[nonempty] = np.maximum.reduceat(values, m.indptr[:-1][nonempty])
+        return out
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""Cache of filtered raw data chunks for the trace views."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import logging
+from threading import Lock
+
+import numpy as np
+
+from phy.gui.qt import thread_pool, Worker
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Trace cache
+#------------------------------------------------------------------------------
+
+def _regular_chunk_bounds(n_samples, chunk_size):
+    """Return the bounds of regular chunks of a given size."""
+    assert chunk_size > 0
+    bounds = list(range(0, n_samples, chunk_size)) + [n_samples]
+    return np.array(bounds, dtype=np.int64)
+
+
+def _split_chunk_bounds(chunk_bounds, max_size):
+    """Split the raw data chunks so that no chunk is larger than `max_size` samples."""
+    out = [int(chunk_bounds[0])]
+    for i0, i1 in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        n = max(1, -(-(int(i1) - int(i0)) // max_size))
+        out.extend(np.linspace(i0, i1, n + 1).astype(np.int64)[1:].tolist())
+    return np.array(out, dtype=np.int64)
+
+
+class TraceCache(object):
+    """LRU cache of filtered and median-centred raw data chunks, with asynchronous read-ahead
+    in the panning direction.
+
+    The chunks are aligned on the chunks of the raw data reader (which correspond to the
+    compression chunks with mtscomp), so that every chunk is decompressed only once. The reader
+    chunks longer than `chunk_duration` (for example the 10-minute chunks of flat binary files)
+    are split so that a request never reads and filters much more than the displayed interval.
+    Every chunk is loaded with some padding on both sides before being filtered, so that the
+    filter edge effects do not appear at the chunk boundaries. Requesting an interval then
+    amounts to concatenating the relevant parts of the cached chunks.
+
+    Every chunk is centred with the median of its own samples, so that the unfiltered traces
+    may show small steps at the chunk boundaries when the baseline drifts. The median is
+    computed on the padded chunk before filtering, and on the chunk after filtering with a
+    chunked filter, whose output has no baseline.
+
+    Constructor
+    -----------
+
+    traces : array-like
+        The `(n_samples, n_channels)` raw data.
+    sample_rate : float
+        The sampling rate, in Hz.
+    raw_data_filter : RawDataFilter
+        The object with a `current` filter name and a `get(name)` method returning the filter
+        function `(arr, axis=None) => arr`, or a filter object implementing
+        `filter_chunk(arr) => arr`, which is applied to the padded chunk before it is
+        centred. The chunks are cached per filter name.
+    chunk_bounds : array-like
+        The chunk bounds, in samples. By default, the chunk bounds of the traces if available,
+        or regular chunks of `chunk_duration` seconds. The chunks longer than `chunk_duration`
+        are split.
+    chunk_duration : float
+        Maximum duration of the chunks, in seconds.
+    max_bytes : int
+        Maximum size of the cached chunks.
+    n_read_ahead : int
+        Number of chunks to load in the background in the panning direction.
+    enable_threading : boolean
+        Whether to read ahead in the Qt thread pool. Read-ahead is disabled otherwise.
+
+    """
+
+    chunk_duration = 1.  # maximum chunk duration, in seconds
+    padding_duration = .05  # in seconds
+    max_bytes = 512 * 1024 ** 2
+    n_read_ahead = 1
+    # Priority of the read-ahead tasks in the thread pool, lower than the view updates.
+    priority = -1
+
+    def __init__(
+            self, traces=None, sample_rate=None, raw_data_filter=None, chunk_bounds=None,
+            chunk_duration=None, max_bytes=None, n_read_ahead=None, enable_threading=True):
+        assert traces is not None
+        assert sample_rate > 0
+        self.traces = traces
+        self.sample_rate = sample_rate
+        self.raw_data_filter = raw_data_filter
+        self.n_samples = traces.shape[0]
+        if chunk_bounds is None:
+            chunk_bounds = getattr(traces, 'chunk_bounds', None)
+        if chunk_duration is not None:
+            self.chunk_duration = chunk_duration
+        chunk_size = max(1, int(round(self.chunk_duration * sample_rate)))
+        if chunk_bounds is None or len(chunk_bounds) < 2:
+            chunk_bounds = _regular_chunk_bounds(self.n_samples, chunk_size)
+        self.chunk_bounds = _split_chunk_bounds(chunk_bounds, chunk_size)
+        assert self.chunk_bounds[-1] == self.n_samples
+        self.n_chunks = len(self.chunk_bounds) - 1
+        self.padding = int(round(self.padding_duration * sample_rate))
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if n_read_ahead is not None:
+            self.n_read_ahead = n_read_ahead
+        self._enable_threading = enable_threading
+
+        # (chunk_idx, filter_name) => array.
+        self._chunks = OrderedDict()
+        self._nbytes = 0
+        # Last chunk loaded with `cache=False`, so that consecutive uncached requests
+        # overlapping the same chunk do not read and filter it again: (key, array).
+        self._uncached = None
+        # Keys being loaded in the background.
+        self._loading = set()
+        self._lock = Lock()
+        # The raw data readers are not thread-safe.
+        self._read_lock = Lock()
+        self._last_start = None
+
+    @property
+    def filter_name(self):
+        """Name of the current raw data filter."""
+        return getattr(self.raw_data_filter, 'current', None)
+
+    @property
+    def nbytes(self):
+        """Total size of the cached chunks."""
+        return self._nbytes
+
+    def __contains__(self, key):
+        return key in self._chunks
+
+    def clear(self):
+        """Clear the cache, for example after a filter has been modified."""
+        with self._lock:
+            self._chunks.clear()
+            self._uncached = None
+            self._nbytes = 0
+
+    def _get_filter(self, filter_name):
+        # NOTE: do not use `raw_data_filter.apply()` which changes the current filter, as this
+        # method may be called in the background.
+        return self.raw_data_filter.get(filter_name) if self.raw_data_filter else None
+
+    def _load_chunk(self, chunk_idx, filter_name):
+        """Read, centre and filter a chunk, with padding on both sides.
+
+        A filter implementing `filter_chunk()` is applied before centring the chunk. Every chunk
+        is filtered from its own padding, so that a chunk does not depend on the order in which
+        the chunks are loaded.
+
+        """
+        fun = self._get_filter(filter_name)
+        i, j = self.chunk_bounds[chunk_idx:chunk_idx + 2]
+        i0 = max(0, i - self.padding)
+        j0 = min(self.n_samples, j + self.padding)
+        with self._read_lock:
+            arr = np.asarray(self.traces[i0:j0])
+        if hasattr(fun, 'filter_chunk'):
+            arr = fun.filter_chunk(arr)
+            arr = arr[i - i0:j - i0]
+            arr = arr - np.median(arr, axis=0)
+        else:
+            arr = arr - np.median(arr, axis=0)
+            arr = fun(arr, axis=0) if fun else arr
+            arr = arr[i - i0:j - i0]
+        return np.ascontiguousarray(arr, dtype=np.float32)
+
+    def _add(self, key, arr):
+        """Add a chunk to the cache and evict the least recently used chunks if needed."""
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = arr
+            self._nbytes += arr.nbytes
+            # Always keep the chunk that was just added.
+            while self._nbytes > self.max_bytes and len(self._chunks) > 1:
+                _, evicted = self._chunks.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def get_chunk(self, chunk_idx, filter_name=None, cache=True):
+        """Return a filtered chunk, from the cache if possible. If `cache` is False, a chunk
+        that is not already cached is not added to the cache, only the last such chunk is
+        kept."""
+        filter_name = filter_name if filter_name is not None else self.filter_name
+        key = (chunk_idx, filter_name)
+        with self._lock:
+            arr = self._chunks.get(key, None)
+            if arr is not None:
+                self._chunks.move_to_end(key)
+                return arr
+            uncached = self._uncached
+        if uncached is not None and uncached[0] == key:
+            return uncached[1]
+        arr = self._load_chunk(chunk_idx, filter_name)
+        if cache:
+            self._add(key, arr)
+        else:
+            with self._lock:
+                self._uncached = (key, arr)
+        return arr
+
+    def _chunk_range(self, i, j):
+        """Return the indices of the first and last chunks overlapping [i, j)."""
+        first = int(np.searchsorted(self.chunk_bounds, i, 'right') - 1)
+        last = int(np.searchsorted(self.chunk_bounds, max(i, j - 1), 'right') - 1)
+        return max(0, first), min(self.n_chunks - 1, last)
+
+    def get_samples(self, i, j, filter_name=None, cache=True):
+        """Return the filtered traces between two samples."""
+        i, j = max(0, int(i)), min(self.n_samples, int(j))
+        if j <= i:
+            return np.zeros((0, self.traces.shape[1]), dtype=np.float32)
+        first, last = self._chunk_range(i, j)
+        parts = []
+        for chunk_idx in range(first, last + 1):
+            a, b = self.chunk_bounds[chunk_idx:chunk_idx + 2]
+            arr = self.get_chunk(chunk_idx, filter_name, cache=cache)
+            parts.append(arr[max(i, a) - a:min(j, b) - a])
+        return parts[0].copy() if len(parts) == 1 else np.concatenate(parts, axis=0)
+
+    def get(self, interval):
+        """Return the filtered traces in an interval (in seconds)."""
+        start, end = interval
+        i, j = int(round(self.sample_rate * start)), int(round(self.sample_rate * end))
+        i, j = max(0, i), min(self.n_samples, j)
+        filter_name = self.filter_name
+        out = self.get_samples(i, j, filter_name)
+        if j > i:
+            self._read_ahead(i, *self._chunk_range(i, j), filter_name)
+        return out
+
+    def _read_ahead(self, i, first, last, filter_name):
+        """Load the next chunks in the panning direction in the background."""
+        last_start, self._last_start = self._last_start, i
+        if not self._enable_threading or not self.n_read_ahead or last_start is None:
+            return
+        if i == last_start:
+            return
+        if i > last_start:
+            chunks = range(last + 1, min(self.n_chunks, last + 1 + self.n_read_ahead))
+        else:
+            chunks = range(first - 1, max(-1, first - 1 - self.n_read_ahead), -1)
+        for chunk_idx in chunks:
+            key = (chunk_idx, filter_name)
+            with self._lock:
+                if key in self._chunks or key in self._loading:
+                    continue
+                self._loading.add(key)
+            logger.log(5, "Read ahead chunk %d.", chunk_idx)
+            thread_pool().start(Worker(self._load_ahead, key), self.priority)
+
+    def _load_ahead(self, key):
+        try:
+            self._add(key, self._load_chunk(*key))
+        except Exception as e:  # pragma: no cover
+            logger.debug("Unable to read ahead chunk %d: %s.", key[0], str(e))
+        finally:
+            with self._lock:
+                self._loading.discard(key)
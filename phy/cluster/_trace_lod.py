@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+"""Multi-resolution min/max envelope of the raw data, for zoomed-out trace views."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import hashlib
+import logging
+from pathlib import Path
+import re
+from threading import Lock
+
+import numpy as np
+from phylib.utils import Bunch
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _reduce_envelope(env, factor):
+    """Merge groups of `factor` consecutive bins of a `(n_bins, 2, n_channels)` min/max
+    envelope. The last group may be incomplete."""
+    n_bins = env.shape[0]
+    if factor == 1 or n_bins == 0:
+        return env
+    n_out = -(-n_bins // factor)
+    n_full = n_bins // factor
+    out = np.empty((n_out,) + env.shape[1:], dtype=env.dtype)
+    full = env[:n_full * factor].reshape((n_full, factor) + env.shape[1:])
+    out[:n_full, 0] = full[:, :, 0].min(axis=1)
+    out[:n_full, 1] = full[:, :, 1].max(axis=1)
+    if n_out > n_full:
+        out[-1, 0] = env[n_full * factor:, 0].min(axis=0)
+        out[-1, 1] = env[n_full * factor:, 1].max(axis=0)
+    return out
+
+
+def _sample_envelope(arr, factor):
+    """Return the `(n_bins, 2, n_channels)` min/max envelope of a `(n_samples, n_channels)`
+    array, with bins of `factor` samples."""
+    return _reduce_envelope(np.stack((arr, arr), axis=1), factor)
+
+
+def _interleave_envelope(env, t0, bin_duration):
+    """Convert a min/max envelope into a `(2 * n_bins, n_channels)` array with alternating
+    minima and maxima, along with the corresponding times, so that it can be drawn as a
+    single line per channel."""
+    n_bins, _, n_channels = env.shape
+    data = env.reshape((2 * n_bins, n_channels))
+    times = np.repeat(t0 + bin_duration * np.arange(n_bins), 2)
+    return data, times
+
+
+def _filter_fingerprint(fun):
+    """Return a string identifying a raw data filter and its parameters: the code of a filter
+    function, or the class and the array and scalar attributes of a filter object."""
+    if fun is None:
+        return 'None'
+    code = getattr(fun, '__code__', None)
+    if code is not None:
+        consts = tuple(c for c in code.co_consts if not hasattr(c, 'co_code'))
+        return '%s.%s:%s:%r' % (fun.__module__, fun.__qualname__, code.co_code.hex(), consts)
+    h = hashlib.sha1(('%s.%s' % (
+        type(fun).__module__, type(fun).__qualname__)).encode('utf-8'))
+    for name, value in sorted(getattr(fun, '__dict__', {}).items()):
+        if isinstance(value, np.ndarray):
+            h.update(name.encode('utf-8') + np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (bool, int, float, str)):
+            h.update(('%s:%r;' % (name, value)).encode('utf-8'))
+    return h.hexdigest()
+
+
+#------------------------------------------------------------------------------
+# Trace pyramid
+#------------------------------------------------------------------------------
+
+class TracePyramid(object):
+    """Pyramid of min/max envelopes of the filtered traces, used to display long intervals
+    with a number of points bounded by the width of the view in pixels.
+
+    Level `k` contains the minimum and maximum of every channel in consecutive bins of
+    `base_factor * level_factor ** k` samples. The levels are computed lazily, block by block,
+    the finest level from the raw data and the other levels from the level just below. When a
+    cache directory is given, the levels are stored in memory-mapped files that persist across
+    sessions. The file names contain a key computed from the data fingerprint, the shape of
+    the data, the chunking of the trace cache, and the filter parameters, so that the stale
+    envelopes are recomputed (and deleted) when any of them changes.
+
+    Constructor
+    -----------
+
+    trace_cache : TraceCache
+        The cache of the filtered raw data chunks.
+    cache_dir : str or Path
+        Directory where to store the envelopes, in memory if None.
+    fingerprint : str
+        A string identifying the raw data, for example the sizes and modification times of the
+        raw data files.
+
+    """
+
+    base_factor = 64
+    level_factor = 4
+    block_size = 1024  # in bins
+
+    def __init__(self, trace_cache=None, cache_dir=None, fingerprint=''):
+        self.trace_cache = trace_cache
+        self.fingerprint = fingerprint
+        self.n_samples = trace_cache.n_samples
+        self.n_channels = trace_cache.traces.shape[1]
+        self.sample_rate = trace_cache.sample_rate
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None and not self.cache_dir.exists():
+            self.cache_dir.mkdir(parents=True)
+        # Decimation factors of all levels, until a level fits in a single block.
+        self.factors = [self.base_factor]
+        while -(-self.n_samples // self.factors[-1]) > self.block_size:
+            self.factors.append(self.factors[-1] * self.level_factor)
+        # (filter_name, level) => (envelope, computed blocks).
+        self._levels = {}
+        self._lock = Lock()
+
+    @property
+    def n_levels(self):
+        """Number of levels in the pyramid."""
+        return len(self.factors)
+
+    def n_bins(self, level):
+        """Number of bins in a given level."""
+        return -(-self.n_samples // self.factors[level])
+
+    def _key(self, filter_name):
+        """Return a key identifying the data and the parameters an envelope is computed from."""
+        c = self.trace_cache
+        h = hashlib.sha1(str(self.fingerprint).encode('utf-8'))
+        h.update(('%d:%d:%r:%r:%d;' % (
+            self.n_samples, self.n_channels, self.sample_rate, c.chunk_duration,
+            c.padding)).encode('utf-8'))
+        h.update(_filter_fingerprint(c._get_filter(filter_name)).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def _prefix(self, filter_name, level):
+        name = re.sub(r'[^a-zA-Z0-9_\-]', '_', str(filter_name))
+        return 'envelope_%s_%d_' % (name, self.factors[level])
+
+    def _paths(self, filter_name, level):
+        stem = self._prefix(filter_name, level) + self._key(filter_name)
+        return self.cache_dir / (stem + '.npy'), self.cache_dir / (stem + '_blocks.npy')
+
+    def _remove_stale(self, filter_name, level):
+        """Delete the envelope files of a level computed from other data or parameters."""
+        paths = self._paths(filter_name, level)
+        prefix = self._prefix(filter_name, level)
+        for path in self.cache_dir.glob(prefix + '*.npy'):
+            if path not in paths and re.match(
+                    r'^[0-9a-f]{16}(_blocks)?\.npy$', path.name[len(prefix):]):
+                logger.debug("Delete the stale envelope `%s`.", path)
+                try:
+                    path.unlink()
+                except OSError as e:  # pragma: no cover
+                    logger.debug("Unable to delete `%s`: %s.", path, str(e))
+
+    def _open_level(self, filter_name, level):
+        """Return the envelope array and the boolean array of the computed blocks."""
+        key = (filter_name, level)
+        if key in self._levels:
+            return self._levels[key]
+        shape = (self.n_bins(level), 2, self.n_channels)
+        n_blocks = -(-shape[0] // self.block_size)
+        if self.cache_dir is None:
+            env, blocks = np.zeros(shape, dtype=np.float32), np.zeros(n_blocks, dtype=bool)
+        else:
+            path, blocks_path = self._paths(filter_name, level)
+            env = blocks = None
+            if path.exists() and blocks_path.exists():
+                try:
+                    env = np.lib.format.open_memmap(str(path), mode='r+')
+                    blocks = np.load(str(blocks_path))
+                except Exception as e:  # pragma: no cover
+                    logger.debug("Unable to open the envelope `%s`: %s.", path, str(e))
+            if env is None or env.shape != shape or blocks.shape != (n_blocks,):
+                logger.debug("Create the envelope `%s`.", path)
+                self._remove_stale(filter_name, level)
+                env = np.lib.format.open_memmap(
+                    str(path), mode='w+', dtype=np.float32, shape=shape)
+                blocks = np.zeros(n_blocks, dtype=bool)
+                np.save(str(blocks_path), blocks)
+        self._levels[key] = env, blocks
+        return env, blocks
+
+    def _compute_block(self, filter_name, level, block):
+        """Compute a block of a level."""
+        env, _ = self._open_level(filter_name, level)
+        b0 = block * self.block_size
+        b1 = min(b0 + self.block_size, env.shape[0])
+        if level == 0:
+            f = self.factors[0]
+            # The chunks are not added to the LRU cache of the views, but the trace cache keeps
+            # the last one, which is shared with the next block.
+            arr = self.trace_cache.get_samples(b0 * f, b1 * f, filter_name, cache=False)
+            env[b0:b1] = _sample_envelope(arr, f)
+        else:
+            r = self.level_factor
+            below = self._get_bins(filter_name, level - 1, b0 * r, b1 * r)
+            env[b0:b1] = _reduce_envelope(below, r)
+
+    def _get_bins(self, filter_name, level, b0, b1):
+        """Return the envelope between two bins of a level, computing the missing blocks."""
+        env, blocks = self._open_level(filter_name, level)
+        b0, b1 = max(0, b0), min(env.shape[0], b1)
+        todo = [
+            block for block in range(b0 // self.block_size, -(-b1 // self.block_size))
+            if not blocks[block]]
+        for block in todo:
+            logger.log(5, "Compute block %d of the envelope level %d.", block, level)
+            self._compute_block(filter_name, level, block)
+            blocks[block] = True
+        if todo and self.cache_dir is not None:
+            env.flush()
+            np.save(str(self._paths(filter_name, level)[1]), blocks)
+        return np.asarray(env[b0:b1])
+
+    def get_level(self, factor):
+        """Return the coarsest level whose factor does not exceed a given decimation factor,
+        or None if the factor is smaller than the finest level."""
+        levels = [k for k, f in enumerate(self.factors) if f <= factor]
+        return levels[-1] if levels else None
+
+    def get(self, interval, n_bins, filter_name=None):
+        """Return the envelope of the filtered traces in an interval, with at least `n_bins`
+        bins, or None if the raw data should be used instead.
+
+        Return a Bunch with `data`, a `(2 * n_bins, n_channels)` array with alternating minima
+        and maxima, and `times`, the corresponding times. The bins are aligned on multiples of
+        the decimation factor so that the display does not flicker when panning.
+
+        """
+        filter_name = filter_name if filter_name is not None else self.trace_cache.filter_name
+        start, end = interval
+        i, j = int(round(self.sample_rate * start)), int(round(self.sample_rate * end))
+        i, j = max(0, i), min(self.n_samples, j)
+        factor = (j - i) // max(1, n_bins)
+        level = self.get_level(factor)
+        if level is None:
+            return
+        f = self.factors[level]
+        # Further merge the bins of the level so that there are about n_bins bins.
+        r = max(1, factor // f)
+        b0, b1 = (i // (f * r)) * r, -(-j // (f * r)) * r
+        with self._lock:
+            env = self._get_bins(filter_name, level, b0, b1)
+        env = _reduce_envelope(env, r)
+        data, times = _interleave_envelope(
+            env, b0 * f / self.sample_rate, f * r / self.sample_rate)
+        return Bunch(data=data, times=times, factor=f * r)
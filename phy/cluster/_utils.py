@@ -67,6 +67,8 @@ class UpdateInfo(Bunch):
     deleted : list
         List of cluster ids that were deleted during the action. There are no modified clusters:
         every change triggers the deletion of and addition of clusters.
+    deleted_spike_counts : list
+        Number of spikes of every deleted cluster, in the same order as `deleted`.
     descendants : list
         List of pairs (old_cluster_id, new_cluster_id), used to track the history of
         the clusters.
@@ -86,6 +88,7 @@ class UpdateInfo(Bunch):
             spike_ids=[],
             added=[],
             deleted=[],
+            deleted_spike_counts=[],
             descendants=[],
             metadata_changed=[],
             metadata_value=None,
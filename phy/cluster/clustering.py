@@ -10,10 +10,12 @@ import logging
 
 import numpy as np
 
+from phylib.utils import Bunch
 from phylib.utils._types import _as_array, _is_array_like
 from phylib.io.array import _unique, _spikes_in_clusters, _spikes_per_cluster
 from ._utils import UpdateInfo
 from ._history import History
+from ._index import ClusterIndex
 from phylib.utils.event import emit
 
 logger = logging.getLogger(__name__)
@@ -23,15 +25,24 @@ logger = logging.getLogger(__name__)
 # Clustering class
 #------------------------------------------------------------------------------
 
-def _extend_spikes(spike_ids, spike_clusters):
+def _extend_spikes(spike_ids, spike_clusters, spikes_per_cluster=None):
     """Return all spikes belonging to the clusters containing the specified
-    spikes."""
+    spikes.
+
+    If a `spikes_per_cluster` dictionary is passed, it is used to avoid a scan of the whole
+    `spike_clusters` array.
+
+    """
     # We find the spikes belonging to modified clusters.
     # What are the old clusters that are modified by the assignment?
     old_spike_clusters = spike_clusters[spike_ids]
     unique_clusters = _unique(old_spike_clusters)
     # Now we take all spikes from these clusters.
-    changed_spike_ids = _spikes_in_clusters(spike_clusters, unique_clusters)
+    spc = spikes_per_cluster
+    if spc is not None and all(clu in spc for clu in unique_clusters):
+        changed_spike_ids = np.sort(np.concatenate([spc[clu] for clu in unique_clusters]))
+    else:
+        changed_spike_ids = _spikes_in_clusters(spike_clusters, unique_clusters)
     # These are the new spikes that need to be reassigned.
     extended_spike_ids = np.setdiff1d(changed_spike_ids, spike_ids, assume_unique=True)
     return extended_spike_ids
@@ -46,7 +57,9 @@ def _concatenate_spike_clusters(*pairs):
     return concat[:, 0].astype(np.int64), concat[:, 1].astype(np.int64)
 
 
-def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cluster_id):
+def _extend_assignment(
+        spike_ids, old_spike_clusters, spike_clusters_rel, new_cluster_id,
+        spikes_per_cluster=None):
     # 1. Add spikes that belong to modified clusters.
     # 2. Find new cluster ids for all changed clusters.
 
@@ -61,7 +74,8 @@ def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cl
     new_spike_clusters = (spike_clusters_rel + (new_cluster_id - spike_clusters_rel.min()))
 
     # We find the spikes belonging to modified clusters.
-    extended_spike_ids = _extend_spikes(spike_ids, old_spike_clusters)
+    extended_spike_ids = _extend_spikes(
+        spike_ids, old_spike_clusters, spikes_per_cluster=spikes_per_cluster)
     if len(extended_spike_ids) == 0:
         return spike_ids, new_spike_clusters
 
@@ -81,7 +95,8 @@ def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cl
 def _assign_update_info(spike_ids, old_spike_clusters, new_spike_clusters):
     old_clusters = _unique(old_spike_clusters)
     new_clusters = _unique(new_spike_clusters)
-    largest_old_cluster = np.bincount(old_spike_clusters).argmax()
+    counts = np.bincount(old_spike_clusters)
+    largest_old_cluster = counts.argmax()
     descendants = list(set(zip(old_spike_clusters, new_spike_clusters)))
     update_info = UpdateInfo(
         description='assign',
@@ -89,6 +104,7 @@ def _assign_update_info(spike_ids, old_spike_clusters, new_spike_clusters):
         spike_clusters=list(new_spike_clusters),
         added=list(new_clusters),
         deleted=list(old_clusters),
+        deleted_spike_counts=[int(counts[clu]) for clu in old_clusters],
         descendants=descendants,
         largest_old_cluster=int(largest_old_cluster),
     )
@@ -123,9 +139,11 @@ class Clustering(object):
     Notes
     -----
 
-    The undo stack works by keeping the list of all spike cluster changes
-    made successively. Undoing consists of reapplying all changes from the
-    original `spike_clusters` array, except the last one.
+    The undo stack keeps, for every action, a reversible delta: the previous cluster ids of the
+    spikes touched by the action, and the `spikes_per_cluster` entries that were removed and
+    added. Undoing and redoing an action consist of reapplying that delta in one direction or
+    the other, so that the cost only depends on the number of changed spikes, and not on the
+    length of the history or on the total number of spikes.
 
     UpdateInfo
     ----------
@@ -142,15 +160,15 @@ class Clustering(object):
     def __init__(self, spike_clusters, new_cluster_id=None,
                  spikes_per_cluster=None):
         super(Clustering, self).__init__()
-        self._undo_stack = History(base_item=(None, None, None))
+        self._undo_stack = History(base_item=(None, None, None, None))
         # Spike -> cluster mapping.
         self._spike_clusters = _as_array(spike_clusters)
-        self._spikes_per_cluster = {}
         self._n_spikes = len(self._spike_clusters)
         self._spike_ids = np.arange(self._n_spikes).astype(np.int64)
+        # Cluster -> spikes index, updated incrementally after every action.
         # We can pass the precomputed spikes_per_cluster dictionary for
         # performance reasons.
-        self._update_cluster_ids(to_add=spikes_per_cluster)
+        self._index = ClusterIndex(self._spike_clusters, spikes_per_cluster=spikes_per_cluster)
         self._new_cluster_id_0 = int(new_cluster_id or self._spike_clusters.max() + 1)
         self._new_cluster_id = self._new_cluster_id_0
         assert self._new_cluster_id >= 0
@@ -164,9 +182,10 @@ class Clustering(object):
         All changes are lost.
 
         """
-        self._undo_stack.clear()
+        self._undo_stack.clear((None, None, None, None))
         self._spike_clusters = self._spike_clusters_base
         self._new_cluster_id = self._new_cluster_id_0
+        self._update_cluster_ids()
 
     @property
     def spike_clusters(self):
@@ -176,12 +195,17 @@ class Clustering(object):
     @property
     def spikes_per_cluster(self):
         """A dictionary {cluster_id: spike_ids}."""
-        return self._spikes_per_cluster
+        return self._index.spikes_per_cluster
 
     @property
     def cluster_ids(self):
         """Ordered list of ids of all non-empty clusters."""
-        return self._cluster_ids
+        return self._index.cluster_ids
+
+    @property
+    def spike_counts(self):
+        """Number of spikes in every cluster, in the same order as `cluster_ids`."""
+        return self._index.spike_counts
 
     def new_cluster_id(self):
         """Generate a brand new cluster id.
@@ -214,33 +238,54 @@ class Clustering(object):
 
     def spikes_in_clusters(self, clusters):
         """Return the array of spike ids belonging to a list of clusters."""
-        return _spikes_in_clusters(self.spike_clusters, clusters)
+        return self._index.spikes_in_clusters(clusters)
 
     # Actions
     #--------------------------------------------------------------------------
 
     def _update_cluster_ids(self, to_remove=None, to_add=None):
-        # Update the list of non-empty cluster ids.
-        self._cluster_ids = _unique(self._spike_clusters)
-        # Clusters to remove.
-        if to_remove is not None:
-            for clu in to_remove:
-                self._spikes_per_cluster.pop(clu, None)
-        # Clusters to add.
-        if to_add:
-            for clu, spk in to_add.items():
-                self._spikes_per_cluster[clu] = spk
-        # If spikes_per_cluster is invalid, recompute the entire
-        # spikes_per_cluster array.
-        coherent = np.all(np.isin(self._cluster_ids, sorted(self._spikes_per_cluster)))
-        if not coherent:
-            logger.debug("Recompute spikes_per_cluster manually: this might take a while.")
-            sc = self._spike_clusters
-            self._spikes_per_cluster = _spikes_per_cluster(sc)
-
-    def _do_assign(self, spike_ids, new_spike_clusters):
+        if to_remove is None and to_add is None:
+            # Rebuild the whole index from the spike_clusters array. This is only needed when
+            # spike_clusters has been modified without going through the clustering actions.
+            self._index.rebuild(
+                self._spike_clusters, spikes_per_cluster=self._index.spikes_per_cluster)
+            return
+        # OPTIM: only update the entries of the clusters affected by the action.
+        self._index.update(to_remove=to_remove, to_add=to_add)
+
+    def _spc_entries(self, cluster_ids):
+        """Return the current spikes_per_cluster entries of some clusters."""
+        spc = self._index.spikes_per_cluster
+        return {clu: spc[clu] for clu in cluster_ids if clu in spc}
+
+    def _make_delta(self, spike_ids):
+        """Record the state of the spikes about to be modified by an action.
+
+        The returned delta is completed by `_complete_delta()` once the action has been made,
+        and is stored in the undo stack.
+
+        """
+        spike_ids = _as_array(spike_ids)
+        old_spike_clusters = self._spike_clusters[spike_ids]
+        return Bunch(
+            old_spike_clusters=old_spike_clusters,
+            spc_removed=self._spc_entries(_unique(old_spike_clusters)),
+            spc_added=None,
+        )
+
+    def _complete_delta(self, delta, up):
+        """Record the spikes_per_cluster entries added by an action."""
+        delta.spc_added = self._spc_entries(up.added)
+        return delta
+
+    def _do_assign(self, spike_ids, new_spike_clusters, spikes_per_cluster=None):
         """Make spike-cluster assignments after the spike selection has
-        been extended to full clusters."""
+        been extended to full clusters.
+
+        The `spikes_per_cluster` dictionary of the new clusters may be passed when it is known
+        in advance (undo and redo), otherwise it is computed from the assignment.
+
+        """
 
         # Ensure spike_clusters has the right shape.
         spike_ids = _as_array(spike_ids)
@@ -271,8 +316,9 @@ class Clustering(object):
         # We make the assignments.
         self._spike_clusters[spike_ids] = new_spike_clusters
         # OPTIM: we update spikes_per_cluster manually.
-        new_spc = _spikes_per_cluster(new_spike_clusters, spike_ids)
-        self._update_cluster_ids(to_remove=old_clusters, to_add=new_spc)
+        if spikes_per_cluster is None:
+            spikes_per_cluster = _spikes_per_cluster(new_spike_clusters, spike_ids)
+        self._update_cluster_ids(to_remove=old_clusters, to_add=spikes_per_cluster)
         up.all_cluster_ids = list(self.cluster_ids)
         return up
 
@@ -280,12 +326,15 @@ class Clustering(object):
 
         # Create the UpdateInfo instance here.
         descendants = [(cluster, to) for cluster in cluster_ids]
-        largest_old_cluster = np.bincount(self.spike_clusters[spike_ids]).argmax()
+        counts = np.bincount(self.spike_clusters[spike_ids])
+        largest_old_cluster = counts.argmax()
         up = UpdateInfo(
             description='merge',
             spike_ids=list(spike_ids),
             added=[to],
             deleted=list(cluster_ids),
+            deleted_spike_counts=[
+                int(counts[clu]) if clu < len(counts) else 0 for clu in cluster_ids],
             descendants=descendants,
             largest_old_cluster=largest_old_cluster,
         )
@@ -339,13 +388,14 @@ class Clustering(object):
         # cheaper operation.
 
         # Find all spikes in the specified clusters.
-        spike_ids = _spikes_in_clusters(self.spike_clusters, cluster_ids)
+        spike_ids = self.spikes_in_clusters(cluster_ids)
 
+        delta = self._make_delta(spike_ids)
         up = self._do_merge(spike_ids, cluster_ids, to)
         undo_state = emit('request_undo_state', self, up)
 
         # Add to stack.
-        self._undo_stack.add((spike_ids, [to], undo_state))
+        self._undo_stack.add((spike_ids, [to], undo_state, self._complete_delta(delta, up)))
 
         emit('cluster', self, up)
         return up
@@ -413,13 +463,16 @@ class Clustering(object):
         # belong to clusters affected by the operation, will be assigned
         # to brand new clusters.
         spike_ids, cluster_ids = _extend_assignment(
-            spike_ids, self._spike_clusters, spike_clusters_rel, self.new_cluster_id())
+            spike_ids, self._spike_clusters, spike_clusters_rel, self.new_cluster_id(),
+            spikes_per_cluster=self.spikes_per_cluster)
 
+        delta = self._make_delta(spike_ids)
         up = self._do_assign(spike_ids, cluster_ids)
         undo_state = emit('request_undo_state', self, up)
 
         # Add the assignment to the undo stack.
-        self._undo_stack.add((spike_ids, cluster_ids, undo_state))
+        self._undo_stack.add(
+            (spike_ids, cluster_ids, undo_state, self._complete_delta(delta, up)))
 
         emit('cluster', self, up)
         return up
@@ -462,22 +515,17 @@ class Clustering(object):
         up : UpdateInfo instance of the changes done by this operation.
 
         """
-        _, _, undo_state = self._undo_stack.back()
-
-        # Retrieve the initial spike_cluster structure.
-        spike_clusters_new = self._spike_clusters_base.copy()
-
-        # Loop over the history (except the last item because we undo).
-        for spike_ids, cluster_ids, _ in self._undo_stack:
-            # We update the spike clusters accordingly.
-            if spike_ids is not None:
-                spike_clusters_new[spike_ids] = cluster_ids
-
-        # What are the spikes affected by the last changes?
-        changed = np.nonzero(self._spike_clusters != spike_clusters_new)[0]
-        clusters_changed = spike_clusters_new[changed]
+        item = self._undo_stack.back()
+        if item is None:
+            # No undo has been performed: abort.
+            return
+        spike_ids, _, undo_state, delta = item
+        assert spike_ids is not None
 
-        up = self._do_assign(changed, clusters_changed)
+        # We restore the previous assignment of the spikes affected by the undone action,
+        # together with the spikes_per_cluster entries that it had removed.
+        up = self._do_assign(
+            spike_ids, delta.old_spike_clusters, spikes_per_cluster=delta.spc_removed)
         up.history = 'undo'
         # Add the undo_state object from the undone object.
         up.undo_state = undo_state
@@ -504,11 +552,11 @@ class Clustering(object):
         # It represents data associated to the state
         # *before* the action. What might be more useful would be the
         # undo_state object of the next item in the list (if it exists).
-        spike_ids, cluster_ids, undo_state = item
+        spike_ids, cluster_ids, undo_state, delta = item
         assert spike_ids is not None
 
         # We apply the new assignment.
-        up = self._do_assign(spike_ids, cluster_ids)
+        up = self._do_assign(spike_ids, cluster_ids, spikes_per_cluster=delta.spc_added)
         up.history = 'redo'
 
         emit('cluster', self, up)
@@ -9,18 +9,23 @@
 
 from functools import partial
 import inspect
+from itertools import zip_longest
 import logging
 
 import numpy as np
 
 from ._history import GlobalHistory
+from ._index import SpikesPerClusterStore, _spike_clusters_hash
+from ._metrics import ClusterMetrics, metrics_fingerprint
+from ._prefetch import Prefetcher
 from ._utils import create_cluster_meta
 from .clustering import Clustering
 
 from phylib.utils import Bunch, emit, connect, unconnect
 from phy.gui.actions import Actions
-from phy.gui.qt import _block, set_busy, _wait
-from phy.gui.widgets import Table, HTMLWidget, _uniq, Barrier
+from phy.gui.qt import _block, set_busy, _wait, AsyncCaller
+from phy.gui.table import NativeTable
+from phy.gui.widgets import _uniq, Barrier
 from phy.cluster.trigger_view import TriggerView
 
 logger = logging.getLogger(__name__)
@@ -258,23 +263,9 @@ class TaskLogger(object):
 # Cluster view and similarity view
 # -----------------------------------------------------------------------------
 
-_CLUSTER_VIEW_STYLES = '''
-table tr[data-group='good'] {
-    color: #86D16D;
-}
-
-table tr[data-group='mua'] {
-    color: #afafaf;
-}
-
-table tr[data-group='noise'] {
-    color: #777;
-}
-'''
-
-
-class ClusterView(Table):
-    """Display a table of all clusters with metrics and labels as columns. Derive from Table.
+class ClusterView(NativeTable):
+    """Display a table of all clusters with metrics and labels as columns. Derive from
+    NativeTable.
 
     Constructor
     -----------
@@ -292,13 +283,17 @@ class ClusterView(Table):
 
     _required_columns = ('n_spikes',)
     _view_name = 'cluster_view'
-    _styles = _CLUSTER_VIEW_STYLES
+    # Text color of the rows depending on the cluster group.
+    row_colors = {
+        'good': '#86D16D',
+        'mua': '#afafaf',
+        'noise': '#777',
+    }
 
     def __init__(self, *args, data=None, columns=(), sort=None):
         # NOTE: debounce select events.
-        HTMLWidget.__init__(
+        NativeTable.__init__(
             self, *args, title=self.__class__.__name__, debounce_events=('select',))
-        self._set_styles()
         self._reset_table(data=data, columns=columns, sort=sort)
 
     def _reset_table(self, data=None, columns=(), sort=None):
@@ -315,15 +310,10 @@ class ClusterView(Table):
             assert col in columns
         assert columns[0] == 'id'
 
-        # Allow to have <tr data_group="good"> etc. which allows for CSS styling.
-        value_names = columns + [{'data': ['group']}]
         # Default sort.
         sort = sort or ('n_spikes', 'desc')
-        self._init_table(columns=columns, value_names=value_names, data=data, sort=sort)
+        self._init_table(columns=columns, data=data, sort=sort)
 
-    def _set_styles(self):
-        self.builder.add_style(self._styles)
-    
     @property
     def state(self):
         """Return the cluster view state, with the current sort and selection."""
@@ -368,11 +358,6 @@ class SimilarityView(ClusterView):
     _required_columns = ('n_spikes', 'similarity')
     _view_name = 'similarity_view'
 
-    def set_selected_index_offset(self, n):
-        """Set the index of the selected cluster, used for correct coloring in the similarity
-        view."""
-        self.eval_js('table._setSelectedIndexOffset(%d);' % n)
-
     def reset(self, cluster_ids):
         """Recreate the similarity view, given the selected clusters in the cluster view."""
         if not len(cluster_ids):
@@ -568,6 +553,7 @@ class Supervisor(object):
     * Cluster selection.
     * Many manual clustering-related actions, snippets, shortcuts, etc.
     * Two HTML tables : `ClusterView` and `SimilarityView`.
+    * Background prefetch of the data of the clusters likely to be selected next.
 
     Constructor
     -----------
@@ -578,6 +564,9 @@ class Supervisor(object):
         Maps a cluster id to a group name (noise, mea, good, None for unsorted).
     cluster_metrics : dict
         Maps a metric name to a function `cluster_id => value`
+    cluster_metrics_vectorized : dict
+        Maps a metric name to a function `cluster_ids => values` computing the metric of many
+        clusters at once, used instead of the function in `cluster_metrics` when available
     similarity : function
         Maps a cluster id to a list of pairs `[(similar_cluster_id, similarity), ...]`
     new_cluster_id : function
@@ -587,6 +576,10 @@ class Supervisor(object):
         Initial sort as a pair `(column_name, order)` where `order` is either `asc` or `desc`
     context : Context
         Handles the cache.
+    metrics_fingerprint : function
+        Function returning a string identifying the data files the cluster metrics are
+        computed from, used to validate the snapshot of the cluster metrics table saved in
+        the cache directory.
 
     Events
     ------
@@ -607,10 +600,13 @@ class Supervisor(object):
 
     """
 
+    # Number of clusters whose metrics are refreshed between two GUI events.
+    metrics_batch_size = 50
+
     def __init__(
             self, spike_clusters=None, cluster_groups=None, cluster_metrics=None,
             cluster_labels=None, similarity=None, new_cluster_id=None, sort=None, context=None,
-            triggers=None):
+            triggers=None, cluster_metrics_vectorized=None, metrics_fingerprint=None):
         super(Supervisor, self).__init__()
         self.context = context
         self.similarity = similarity  # function cluster => [(cl, sim), ...]
@@ -624,6 +620,9 @@ class Supervisor(object):
         # This is a dict {name: func cluster_id => value}.
         self.cluster_metrics = cluster_metrics or {}
         self.cluster_metrics['n_spikes'] = self.n_spikes
+        # This is a dict {name: func cluster_ids => values}.
+        self.cluster_metrics_vectorized = cluster_metrics_vectorized or {}
+        self.cluster_metrics_vectorized['n_spikes'] = self.get_spike_counts
 
         # Cluster labels.
         # This is a dict {name: {cl: value}}
@@ -631,21 +630,40 @@ class Supervisor(object):
 
         self.columns = ['id']  # n_spikes comes from cluster_metrics
         self.columns += list(self.cluster_metrics.keys())
+        self.columns += [
+            name for name in self.cluster_metrics_vectorized if name not in self.columns]
         self.columns += [
             label for label in self.cluster_labels.keys()
             if label not in self.columns + ['group']]
 
         # Create Clustering and ClusterMeta.
-        # Load the cached spikes_per_cluster array.
-        spc = context.load('spikes_per_cluster') if context else None
+        # Hash of the spike_clusters array, used by the on-disk caches. It is computed at most
+        # once between two clustering actions.
+        self._spike_clusters_digest = _spike_clusters_hash(spike_clusters) if context else None
+        # Load the cached spikes_per_cluster array (memory-mapped).
+        self._spc_store = (
+            SpikesPerClusterStore(context.cache_dir / 'spikes_per_cluster') if context else None)
+        spc = (
+            self._spc_store.load(spike_clusters, digest=self._spike_clusters_digest)
+            if self._spc_store else None)
         self.clustering = Clustering(
             spike_clusters, spikes_per_cluster=spc, new_cluster_id=new_cluster_id)
         
         # Save trigger times reference
         self.triggers = triggers or {}  # Dictionary of trigger_id -> Dict
         
-        # Cache the spikes_per_cluster array.
-        self._save_spikes_per_cluster()
+        # Cache the spikes_per_cluster array, unless it has just been loaded from the cache.
+        if spc is None:
+            self._save_spikes_per_cluster()
+
+        # Columnar table of the cluster metrics, computed when the cluster view is created.
+        self.metrics = ClusterMetrics(
+            metrics=self.cluster_metrics, vectorized=self.cluster_metrics_vectorized,
+            cluster_ids=lambda: self.clustering.cluster_ids)
+        # Load the snapshot of the metrics table saved at the end of the previous session.
+        self._metrics_fingerprint = metrics_fingerprint
+        if context:
+            self.metrics.load(self._metrics_snapshot_path, self._get_metrics_fingerprint())
 
         # Create the ClusterMeta instance.
         self.cluster_meta = create_cluster_meta(cluster_groups or {})
@@ -671,12 +689,15 @@ class Supervisor(object):
         # Raise supervisor.cluster
         @connect(sender=self.clustering)
         def on_cluster(sender, up):
+            self._spike_clusters_digest = None
             # NOTE: update the cluster meta of new clusters, depending on the values of the
             # ancestor clusters. In case of a conflict between the values of the old clusters,
             # the largest cluster wins and its value is set to its descendants.
             if up.added:
                 self.cluster_meta.set_from_descendants(
                     up.descendants, largest_old_cluster=up.largest_old_cluster)
+            # The metrics of the added clusters are computed when they are first requested.
+            self.metrics.update(up)
             emit('cluster', self, up)
 
         @connect(sender=self.cluster_meta)  # noqa
@@ -685,16 +706,114 @@ class Supervisor(object):
 
         connect(self._save_new_cluster_id, event='cluster', sender=self)
 
+        # Prefetch of the data of the next clusters, the data getters are added by the
+        # controller.
+        self.prefetcher = Prefetcher()
+        # Ids of the clusters in the similarity view, in order.
+        self._similar_ids = []
+        # Incremented at every select event, used by the views to drop superseded selections.
+        self.select_generation = 0
+        # Selection generations that were superseded before some view could show them, since
+        # the views were last idle, and total number of such selections.
+        self._coalesced = set()
+        self._n_coalesced = 0
+        connect(lambda *args: self.prefetcher.cancel(), event='cluster', sender=self.clustering)
+        # Pending refresh of the cluster metrics, cancelled by any clustering action.
+        self._metrics_caller = None
+        connect(
+            lambda *args: self._cancel_metrics_refresh(), event='cluster', sender=self.clustering)
+
         self._is_busy = False
 
     # Internal methods
     # -------------------------------------------------------------------------
 
     def _save_spikes_per_cluster(self):
-        """Cache on the disk the dictionary with the spikes belonging to each cluster."""
+        """Cache on the disk the dictionary with the spikes belonging to each cluster.
+
+        Only the clusters that were not cached yet are written.
+
+        """
+        if not self._spc_store:
+            return
+        self._spc_store.save(
+            self.clustering.spike_clusters, self.clustering.spikes_per_cluster,
+            digest=self._get_spike_clusters_digest())
+
+    def _get_spike_clusters_digest(self):
+        """Return the hash of the current spike_clusters array."""
+        if self._spike_clusters_digest is None:
+            self._spike_clusters_digest = _spike_clusters_hash(self.clustering.spike_clusters)
+        return self._spike_clusters_digest
+
+    @property
+    def _metrics_snapshot_path(self):
+        return self.context.cache_dir / 'cluster_metrics.pkl'
+
+    def _get_metrics_fingerprint(self):
+        return metrics_fingerprint(
+            self.clustering.spike_clusters, metrics=self.cluster_metrics,
+            vectorized=self.cluster_metrics_vectorized,
+            extra=self._metrics_fingerprint() if self._metrics_fingerprint else '',
+            digest=self._get_spike_clusters_digest())
+
+    def save_metrics_snapshot(self):
+        """Save the cluster metrics table in the cache directory, so that it is loaded at once
+        at the next launch."""
         if not self.context:
             return
-        self.context.save('spikes_per_cluster', self.clustering.spikes_per_cluster, kind='pickle')
+        self.metrics.save(self._metrics_snapshot_path, self._get_metrics_fingerprint())
+
+    def refresh_metrics(self, enable_threading=True):
+        """Recompute all cluster metrics, update the clusters with changed metrics in the
+        cluster view, and save the snapshot again.
+
+        This is used to revalidate a table loaded from a snapshot. The metric functions access
+        the clustering and the memcache, so they are never called concurrently with a
+        clustering action: with threading, the metrics are computed in the GUI thread by
+        batches of `metrics_batch_size` clusters between the GUI events, and the refresh is
+        cancelled by any clustering action.
+
+        """
+        self._cancel_metrics_refresh()
+        if not enable_threading:
+            return self._on_metrics_computed(self.metrics.compute())
+        steps = self.metrics.iter_compute(self.metrics_batch_size)
+        caller = self._metrics_caller = AsyncCaller(delay=0)
+
+        def _step():
+            if caller is not self._metrics_caller:  # pragma: no cover
+                return
+            try:
+                table = next(steps)
+            except Exception as e:  # pragma: no cover
+                logger.warning("Unable to refresh the cluster metrics: %s.", str(e))
+                self._metrics_caller = None
+                return
+            if table is None:
+                caller.set(_step)
+                return
+            self._metrics_caller = None
+            self._on_metrics_computed(table)
+
+        caller.set(_step)
+
+    def _cancel_metrics_refresh(self):
+        caller, self._metrics_caller = self._metrics_caller, None
+        if caller is not None:
+            logger.log(5, "Cancel the refresh of the cluster metrics.")
+            caller.stop()
+
+    def _on_metrics_computed(self, table):
+        changed = self.metrics.set_table(table)
+        if changed is None:
+            return
+        logger.debug("Refreshed the cluster metrics, %d clusters changed.", len(changed))
+        if changed and getattr(self, 'cluster_view', None):
+            data = [self._add_cluster_meta(info) for info in self.metrics.rows(changed)]
+            self.cluster_view.change(data)
+        self.save_metrics_snapshot()
+        return changed
 
     def _log_action(self, sender, up):
         """Log the clustering action (merge, split)."""
@@ -734,10 +853,6 @@ class Supervisor(object):
         """Save the GUI state with the cluster view and similarity view."""
         gui.state.update_view_state(self.cluster_view, self.cluster_view.state)
 
-        # Clear temporary HTML files
-        self.cluster_view.clear_temporary_files()
-        self.similarity_view.clear_temporary_files()
-
     def _get_similar_clusters(self, sender, cluster_id):
         """Return the clusters similar to a given cluster."""
         sim = self.similarity(cluster_id) or []
@@ -752,14 +867,18 @@ class Supervisor(object):
         """Return the data associated to a given cluster."""
         out = {'id': cluster_id}
         # Cluster metrics.
-        for key, func in self.cluster_metrics.items():
-            out[key] = func(cluster_id)
-        # Cluster meta.
+        out.update(self.metrics.get(cluster_id))
+        self._add_cluster_meta(out)
+        return {k: v for k, v in out.items() if k not in exclude}
+
+    def _add_cluster_meta(self, info):
+        """Add the cluster meta of a cluster to its data dictionary."""
+        cluster_id = info['id']
         for key in self.cluster_meta.fields:
             # includes group
-            out[key] = self.cluster_meta.get(key, cluster_id)
-        out['is_masked'] = _is_group_masked(out.get('group', None))
-        return {k: v for k, v in out.items() if k not in exclude}
+            info[key] = self.cluster_meta.get(key, cluster_id)
+        info['is_masked'] = _is_group_masked(info.get('group', None))
+        return info
     
     def get_trigger_info(self, trigger_id):
         """Return the data associated to a given trigger."""
@@ -815,7 +934,7 @@ class Supervisor(object):
     def _clusters_added(self, cluster_ids):
         """Update the cluster and similarity views when new clusters are created."""
         logger.log(5, "Clusters added: %s", cluster_ids)
-        data = [self.get_cluster_info(cluster_id) for cluster_id in cluster_ids]
+        data = [self._add_cluster_meta(info) for info in self.metrics.rows(cluster_ids)]
         self.cluster_view.add(data)
         self.similarity_view.add(data)
 
@@ -847,15 +966,19 @@ class Supervisor(object):
         logger.debug("Clusters selected: %s (%s)", cluster_ids, next_cluster)
         self.task_logger.log(self.cluster_view, 'select', cluster_ids, output=obj)
         # Update the similarity view when the cluster view selection changes.
-        self.similarity_view.reset(cluster_ids)
+        similar = self.similarity_view.reset(cluster_ids)
+        self._similar_ids = [
+            cl['id'] for cl in (similar[0] if similar else []) if cl['id'] not in cluster_ids]
         self.similarity_view.set_selected_index_offset(len(self.selected_clusters))
         # Emit supervisor.select event unless update_views is False. This happens after
         # a merge event, where the views should not be updated after the first cluster_view.select
         # event, but instead after the second similarity_view.select event.
         if kwargs.pop('update_views', True):
+            self.select_generation += 1
             emit('select', self, self.selected, **kwargs)
         if cluster_ids:
             self.cluster_view.scroll_to(cluster_ids[-1])
+            self._prefetch_next(self._similar_ids, after=cluster_ids[-1])
         self.cluster_view.dock.set_status('clusters: %s' % ', '.join(map(str, cluster_ids)))
 
     def _similar_selected(self, sender, obj):
@@ -868,9 +991,14 @@ class Supervisor(object):
         kwargs = obj.get('kwargs', {})
         logger.debug("Similar clusters selected: %s (%s)", similar, next_similar)
         self.task_logger.log(self.similarity_view, 'select', similar, output=obj)
+        self.select_generation += 1
         emit('select', self, self.selected, **kwargs)
         if similar:
             self.similarity_view.scroll_to(similar[-1])
+            # Prefetch the next clusters in the similarity view.
+            if similar[-1] in self._similar_ids:
+                i = self._similar_ids.index(similar[-1])
+                self.prefetcher.prefetch(self._similar_ids[i + 1:], exclude=self.selected)
         self.similarity_view.dock.set_status('similar clusters: %s' % ', '.join(map(str, similar)))
 
     def _triggers_selected(self, sender, obj):
@@ -885,6 +1013,27 @@ class Supervisor(object):
         self.trigger_view.dock.set_status('triggers: %s' % ', '.join(map(str, trigger_ids)))
         emit('select_triggers', self, trigger_ids)
 
+    def _prefetch_next(self, similar, after=None):
+        """Prefetch the data of the clusters that are likely to be selected next: the most
+        similar clusters and the next best clusters in the cluster view after a given
+        cluster."""
+        if not self.prefetcher.n_clusters or not self.prefetcher.functions:
+            return
+        n = self.prefetcher.n_clusters
+
+        def _callback(ids):
+            ids = list(ids or [])
+            i = ids.index(after) + 1 if after in ids else 0
+            best = [
+                cl for cl in ids[i:]
+                if not _is_group_masked(self.cluster_meta.get('group', cl))][:n]
+            # Interleave the candidates of the `next` and `next_best` actions.
+            candidates = [cl for pair in zip_longest(similar[:n], best) for cl in pair]
+            self.prefetcher.prefetch(
+                [cl for cl in candidates if cl is not None], exclude=self.selected)
+
+        self.cluster_view.get_ids(callback=_callback)
+
     def _on_action(self, sender, name, *args):
         """Called when an action is triggered: enqueue and process the task."""
         assert sender == self.action_creator
@@ -953,8 +1102,9 @@ class Supervisor(object):
         self.cluster_view.sort_by(column, sort_dir=sort_dir)
 
     def filter(self, text):
-        """Filter the clusters using a Javascript expression on the column names."""
-        self.cluster_view.filter(text)
+        """Filter the clusters using a Python expression on the column names, and return the
+        ids of the shown clusters."""
+        return self.cluster_view.filter(text)
 
     def clear_filter(self):
         self.cluster_view.filter('')
@@ -965,7 +1115,7 @@ class Supervisor(object):
     @property
     def cluster_info(self):
         """The cluster view table as a list of per-cluster dictionaries."""
-        return [self.get_cluster_info(cluster_id) for cluster_id in self.clustering.cluster_ids]
+        return [self._add_cluster_meta(info) for info in self.metrics.rows()]
 
     @property
     def shown_cluster_ids(self):
@@ -1028,10 +1178,22 @@ class Supervisor(object):
         def on_is_busy(sender, is_busy):
             self._busy[sender] = is_busy
             self._set_busy(any(self._busy.values()))
+            # Show the number of coalesced selections once all views have been updated with
+            # the latest selection, and forget their generations.
+            if not self._is_busy and self._coalesced:
+                n = len(self._coalesced)
+                self._n_coalesced += n
+                self._coalesced.clear()
+                gui.status_message = '%d selection%s coalesced' % (n, 's' if n > 1 else '')
+
+        @connect
+        def on_select_coalesced(sender, generation):
+            self._coalesced.add(generation)
 
         @connect(sender=gui)
         def on_close(e):
             unconnect(on_is_busy, self)
+            unconnect(on_select_coalesced, self)
 
         @connect(sender=self.cluster_view)
         def on_ready(sender):
@@ -1040,6 +1202,12 @@ class Supervisor(object):
             if selected:  # pragma: no cover
                 self.cluster_view.select(selected)
 
+    @property
+    def n_coalesced_selections(self):
+        """Number of selections that were superseded by a more recent selection before
+        at least one of the views had been updated."""
+        return self._n_coalesced + len(self._coalesced)
+
     @property
     def selected_clusters(self):
         """Selected clusters in the cluster view only."""
@@ -1065,6 +1233,18 @@ class Supervisor(object):
         """Number of spikes in a given cluster."""
         return len(self.clustering.spikes_per_cluster.get(cluster_id, []))
 
+    def get_spike_counts(self, cluster_ids):
+        """Number of spikes in some clusters."""
+        ids = np.asarray(self.clustering.cluster_ids, dtype=np.int64)
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        out = np.zeros(len(cluster_ids), dtype=np.int64)
+        if not len(ids):
+            return out
+        i = np.clip(np.searchsorted(ids, cluster_ids), 0, len(ids) - 1)
+        found = ids[i] == cluster_ids
+        out[found] = np.asarray(self.clustering.spike_counts)[i[found]]
+        return out
+
     # Clustering actions
     # -------------------------------------------------------------------------
 
@@ -1144,8 +1324,8 @@ class Supervisor(object):
     # Wizard actions
     # -------------------------------------------------------------------------
 
-    # There are callbacks because these functions call Javascript functions that return
-    # asynchronously in Qt5.
+    # There are callbacks so that the task logger can chain the actions following these
+    # functions.
 
     def reset_wizard(self, callback=None):
         """Reset the wizard."""
@@ -1214,8 +1394,9 @@ class Supervisor(object):
             (field, self.get_labels(field)) for field in self.cluster_meta.fields
             if field not in ('next_cluster')]
         emit('save_clustering', self, spike_clusters, groups, *labels)
-        # Cache the spikes_per_cluster array.
+        # Cache the spikes_per_cluster array and the cluster metrics.
         self._save_spikes_per_cluster()
+        self.save_metrics_snapshot()
         self._is_dirty = False
 
     def block(self):
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Test channel cluster index."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from threading import Thread
+import time
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.utils import connect
+from ..clustering import Clustering
+from .._channel_index import ChannelClusterIndex
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_channel_index_1():
+    best_channels = {0: [2, 3], 1: [3, 4, 5], 2: [0], 4: [5, 3]}
+    index = ChannelClusterIndex(
+        best_channels=best_channels.__getitem__, cluster_ids=lambda: sorted(best_channels))
+
+    assert index.clusters_on_channel(3) == [0, 1, 4]
+    assert index.clusters_on_channel(0) == [2]
+    assert index.clusters_on_channel(1) == []
+    ae(index.channels(4), [5, 3])
+
+
+def test_channel_index_clustering():
+    n_spikes, n_clusters, n_channels = 1000, 20, 10
+    clustering = Clustering(np.random.randint(0, n_clusters, n_spikes))
+    n_calls = []
+
+    def best_channels(cluster_id):
+        n_calls.append(cluster_id)
+        spike_ids = clustering.spikes_per_cluster[cluster_id]
+        return np.unique(spike_ids[:3] % n_channels)
+
+    index = ChannelClusterIndex(
+        best_channels=best_channels, cluster_ids=lambda: clustering.cluster_ids)
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        index.update(up)
+
+    def _check():
+        for channel_id in range(n_channels):
+            assert index.clusters_on_channel(channel_id) == [
+                cluster_id for cluster_id in clustering.cluster_ids
+                if channel_id in best_channels(cluster_id)]
+
+    # The index is built lazily.
+    assert not n_calls
+    index.clusters_on_channel(0)
+    assert len(n_calls) == n_clusters
+    _check()
+
+    clustering.merge([2, 3, 5])
+    del n_calls[:]
+    index.clusters_on_channel(0)
+    # Only the new cluster is indexed.
+    assert n_calls == [n_clusters]
+    _check()
+
+    clustering.split(np.arange(0, n_spikes, 3))
+    _check()
+
+    clustering.undo()
+    _check()
+
+    clustering.undo()
+    _check()
+
+    clustering.redo()
+    _check()
+
+
+def test_channel_index_templates():
+    spike_templates = np.random.randint(0, 5, 1000)
+    clustering = Clustering(spike_templates.copy())
+    template_channels = {0: [0, 1], 1: [1, 2], 2: [2, 3], 3: [3, 4], 4: [4, 0]}
+    n_calls = []
+
+    def best_templates(cluster_ids):
+        return [np.bincount(spike_templates[clustering.spikes_per_cluster[cluster_id]]).argmax()
+                for cluster_id in cluster_ids]
+
+    def get_template_channels(template_id):
+        n_calls.append(template_id)
+        return template_channels[template_id]
+
+    index = ChannelClusterIndex(
+        cluster_ids=lambda: clustering.cluster_ids, best_templates=best_templates,
+        template_channels=get_template_channels)
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        index.update(up)
+
+    assert index.clusters_on_channel(1) == [0, 1]
+    assert sorted(n_calls) == [0, 1, 2, 3, 4]
+
+    # The channels of the templates are only requested once.
+    up = clustering.merge([1, 3])
+    new, = up.added
+    ae(index.channels(new), template_channels[best_templates([new])[0]])
+    assert len(n_calls) == 5
+
+
+def test_channel_index_threads():
+    best_channels = {cluster_id: [cluster_id % 4] for cluster_id in range(40)}
+
+    def slow_best_channels(cluster_id):
+        time.sleep(.001)
+        return best_channels[cluster_id]
+
+    index = ChannelClusterIndex(
+        best_channels=slow_best_channels, cluster_ids=lambda: sorted(best_channels))
+
+    # Concurrent lookups while the index is being built all see the complete index.
+    results = []
+    threads = [
+        Thread(target=lambda: results.append(index.clusters_on_channel(1))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [list(range(1, 40, 4))] * 8
@@ -251,6 +251,7 @@ def test_clustering_merge():
     assert 0 not in clustering.spikes_per_cluster
     assert info.added == [11]
     assert info.deleted == [0, 1]
+    assert info.deleted_spike_counts == [len(spk0), len(spk1)]
     _assert_is_checkpoint(1)
 
     # Checkpoint 2.
@@ -268,6 +269,7 @@ def test_clustering_merge():
     assert info.added == [2, 3]
     assert info.deleted == [12]
     assert info.history == 'undo'
+    assert info.deleted_spike_counts == [len(clustering.spikes_in_clusters([2, 3]))]
     assert info.undo_state == ['hello']
     _assert_is_checkpoint(1)
     ae(clustering.spikes_per_cluster[11], np.sort(np.r_[spk0, spk1]))
@@ -476,6 +478,8 @@ def test_clustering_long():
     # Merge to a given cluster.
     clustering.spike_clusters[:] = spike_clusters_base[:]
     clustering._new_cluster_id = 11
+    # Need to update explicitely, the cluster index is updated incrementally.
+    clustering._update_cluster_ids()
 
     my_spikes_0 = np.nonzero(np.in1d(clustering.spike_clusters, [4, 6]))[0]
     info = clustering.merge([4, 6], 11)
@@ -494,3 +498,63 @@ def test_clustering_long():
     clustering.assign(my_spikes, clusters)
     clu = clustering.spike_clusters[my_spikes]
     ae(clu - clu[0], clusters)
+
+
+def test_clustering_undo_redo_long():
+    n_spikes = 5000
+    n_clusters = 50
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+
+    clustering = Clustering(spike_clusters)
+    checkpoints = [clustering.spike_clusters.copy()]
+
+    # Alternate merges and splits.
+    for i in range(40):
+        if i % 2 == 0:
+            clustering.merge(clustering.cluster_ids[:2])
+        else:
+            clustering.split(np.arange(i, n_spikes, 7))
+        checkpoints.append(clustering.spike_clusters.copy())
+
+    # The base assignment is not used when undoing.
+    clustering._spike_clusters_base = None
+
+    def _check(index):
+        ae(clustering.spike_clusters, checkpoints[index])
+        ae(clustering.cluster_ids, np.unique(checkpoints[index]))
+        for clu in clustering.cluster_ids:
+            ae(clustering.spikes_per_cluster[clu],
+               np.nonzero(checkpoints[index] == clu)[0])
+
+    for index in range(len(checkpoints) - 2, -1, -1):
+        clustering.undo()
+        _check(index)
+    assert clustering.undo() is None
+
+    for index in range(1, len(checkpoints)):
+        clustering.redo()
+        _check(index)
+    assert clustering.redo() is None
+
+
+def test_clustering_undo_no_replay():
+    n_spikes = 10000
+    n_clusters = 100
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    clustering = Clustering(spike_clusters.copy())
+    for _ in range(50):
+        up = clustering.merge(clustering.cluster_ids[:2])
+    last_spikes = up.spike_ids
+
+    # Undoing the last action only reapplies its delta, without replaying the history.
+    calls = []
+    _do_assign = clustering._do_assign
+
+    def _counted(spike_ids, *args, **kwargs):
+        calls.append(len(spike_ids))
+        return _do_assign(spike_ids, *args, **kwargs)
+
+    clustering._do_assign = _counted
+    up = clustering.undo()
+    assert calls == [len(last_spikes)]
+    assert len(up.added) == 2
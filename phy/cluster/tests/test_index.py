@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Test cluster index."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.io.mock import artificial_spike_clusters
+from .._index import ClusterIndex, SpikesPerClusterStore
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_cluster_index_empty():
+    index = ClusterIndex()
+    ae(index.cluster_ids, [])
+    ae(index.spike_counts, [])
+    assert index.spikes_per_cluster == {}
+    assert index.spike_count(0) == 0
+    ae(index.spikes_in_clusters([0, 1]), [])
+
+
+def test_cluster_index_simple():
+    spike_clusters = np.array([2, 5, 3, 2, 7, 5, 2])
+    index = ClusterIndex(spike_clusters)
+
+    ae(index.cluster_ids, [2, 3, 5, 7])
+    ae(index.spike_counts, [3, 1, 2, 1])
+    ae(index.spikes_per_cluster[2], [0, 3, 6])
+    assert index.spike_count(5) == 2
+    assert index.spike_count(4) == 0
+    ae(index.spikes_in_clusters([7, 2]), [0, 3, 4, 6])
+
+    # Merge 2 and 7 into 8.
+    index.update(to_remove=[2, 7], to_add={8: [0, 3, 4, 6]})
+    ae(index.cluster_ids, [3, 5, 8])
+    ae(index.spike_counts, [1, 2, 4])
+    assert 2 not in index.spikes_per_cluster
+    ae(index.spikes_in_clusters([8]), [0, 3, 4, 6])
+
+    # Split 8 into 9 and 10.
+    index.update(to_remove=[8], to_add={9: [0, 6], 10: [3, 4]})
+    ae(index.cluster_ids, [3, 5, 9, 10])
+    ae(index.spike_counts, [1, 2, 2, 2])
+
+    # No-op.
+    index.update()
+    ae(index.cluster_ids, [3, 5, 9, 10])
+
+
+def test_cluster_index_spikes_per_cluster():
+    spike_clusters = np.array([2, 5, 3, 2, 7, 5, 2])
+
+    # A coherent spikes_per_cluster dictionary is used as is.
+    spc = {2: np.array([0, 3, 6]), 3: np.array([2]), 5: np.array([1, 5]), 7: np.array([4])}
+    index = ClusterIndex(spike_clusters, spikes_per_cluster=spc)
+    assert index.spikes_per_cluster[2] is spc[2]
+
+    # An incoherent one is recomputed.
+    index = ClusterIndex(spike_clusters, spikes_per_cluster={2: np.array([0, 3, 6])})
+    ae(index.spikes_per_cluster[5], [1, 5])
+    ae(index.spike_counts, [3, 1, 2, 1])
+
+
+def test_cluster_index_rebuild():
+    n_spikes = 1000
+    n_clusters = 10
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    index = ClusterIndex(spike_clusters)
+
+    spike_clusters[:10] = 100
+    index.rebuild(spike_clusters, spikes_per_cluster=index.spikes_per_cluster)
+    ae(index.cluster_ids, np.r_[np.arange(n_clusters), 100])
+    ae(index.spikes_per_cluster[100], np.arange(10))
+    ae(index.spike_counts, np.bincount(spike_clusters)[index.cluster_ids])
+
+
+#------------------------------------------------------------------------------
+# Test store
+#------------------------------------------------------------------------------
+
+def _assert_spc_equal(spc0, spc1):
+    assert sorted(spc0) == sorted(spc1)
+    for clu in spc0:
+        ae(spc0[clu], spc1[clu])
+
+
+def test_spikes_per_cluster_store(tempdir):
+    n_spikes = 1000
+    n_clusters = 10
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    index = ClusterIndex(spike_clusters)
+
+    path = tempdir / 'spc'
+    store = SpikesPerClusterStore(path)
+    assert store.load(spike_clusters) is None
+
+    store.save(spike_clusters, index.spikes_per_cluster)
+
+    # Load in a new store: the arrays are memory-mapped.
+    store = SpikesPerClusterStore(path)
+    spc = store.load(spike_clusters)
+    _assert_spc_equal(spc, index.spikes_per_cluster)
+    assert isinstance(spc[0], np.memmap)
+
+    # The store is invalid with a different spike_clusters array.
+    spike_clusters_bis = spike_clusters.copy()
+    spike_clusters_bis[0] = 100
+    assert SpikesPerClusterStore(path).load(spike_clusters_bis) is None
+    assert SpikesPerClusterStore(path).load(spike_clusters[:-1]) is None
+
+    # Merge two clusters: only the new cluster is written in a new segment.
+    index.update(to_remove=[0, 1], to_add={20: index.spikes_in_clusters([0, 1])})
+    spike_clusters[index.spikes_per_cluster[20]] = 20
+    size = sum(f.stat().st_size for f in path.glob('spikes_*.bin'))
+    store.save(spike_clusters, index.spikes_per_cluster)
+    assert len(list(path.glob('spikes_*.bin'))) == 2
+    new_size = sum(f.stat().st_size for f in path.glob('spikes_*.bin'))
+    assert new_size - size == 8 * len(index.spikes_per_cluster[20])
+
+    spc = SpikesPerClusterStore(path).load(spike_clusters)
+    _assert_spc_equal(spc, index.spikes_per_cluster)
+
+    # Merge everything: the store is compacted.
+    index.update(
+        to_remove=index.cluster_ids, to_add={30: index.spikes_in_clusters(index.cluster_ids)})
+    spike_clusters[:] = 30
+    store.save(spike_clusters, index.spikes_per_cluster)
+    assert len(list(path.glob('spikes_*.bin'))) == 1
+    assert len(list(path.glob('clusters_*.npy'))) == 1
+
+    spc = SpikesPerClusterStore(path).load(spike_clusters)
+    _assert_spc_equal(spc, index.spikes_per_cluster)
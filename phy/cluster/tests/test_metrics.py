@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""Test cluster metrics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.utils import connect
+from ..clustering import Clustering
+from .._metrics import ClusterMetrics, metrics_fingerprint
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_cluster_metrics_1():
+    metrics = {'square': lambda cl: cl ** 2, 'name': lambda cl: 'c%d' % cl}
+    vectorized = {'double': lambda ids: 2 * np.asarray(ids), 'square': lambda ids: -1 * ids}
+    m = ClusterMetrics(metrics=metrics, vectorized=vectorized, cluster_ids=lambda: [1, 3, 4])
+
+    assert m.names == ['square', 'name', 'double']
+    # The vectorized functions take precedence.
+    ae(m.column('square'), [-1, -3, -4])
+    ae(m.column('double', [4, 1]), [8, 2])
+    assert m.get(3) == {'square': -3, 'name': 'c3', 'double': 6}
+    # Not in the table.
+    assert m.get(5) == {'square': -5, 'name': 'c5', 'double': 10}
+    assert m.rows([4]) == [{'id': 4, 'square': -4, 'name': 'c4', 'double': 8}]
+    assert [row['id'] for row in m.rows()] == [1, 3, 4]
+
+    # Metric added after the table has been built.
+    metrics['triple'] = lambda cl: 3 * cl
+    assert m.get(4)['triple'] == 12
+
+
+def test_cluster_metrics_clustering():
+    n_spikes, n_clusters = 1000, 20
+    clustering = Clustering(np.random.randint(0, n_clusters, n_spikes))
+    n_calls = []
+
+    def n_spikes_cluster(cluster_id):
+        n_calls.append(cluster_id)
+        return len(clustering.spikes_per_cluster[cluster_id])
+
+    def n_spikes_clusters(cluster_ids):
+        return np.bincount(clustering.spike_clusters)[cluster_ids]
+
+    m = ClusterMetrics(
+        metrics={'n_spikes': n_spikes_cluster}, vectorized={'n_spikes_v': n_spikes_clusters},
+        cluster_ids=lambda: clustering.cluster_ids)
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        m.update(up)
+
+    def _check():
+        rows = m.rows()
+        assert [row['id'] for row in rows] == list(clustering.cluster_ids)
+        for row in rows:
+            n = len(clustering.spikes_per_cluster[row['id']])
+            assert row['n_spikes'] == row['n_spikes_v'] == n
+
+    _check()
+    assert len(n_calls) == n_clusters
+
+    clustering.merge([2, 3, 5])
+    del n_calls[:]
+    _check()
+    # Only the row of the new cluster is computed.
+    assert n_calls == [n_clusters]
+
+    clustering.split(np.arange(0, n_spikes, 3))
+    _check()
+
+    clustering.undo()
+    _check()
+
+    clustering.undo()
+    _check()
+
+    clustering.redo()
+    _check()
+
+
+def test_cluster_metrics_snapshot(tempdir):
+    spike_clusters = np.array([1, 3, 3, 4])
+    metrics = {'square': lambda cl: cl ** 2, 'name': lambda cl: 'c%d' % cl}
+    m = ClusterMetrics(metrics=metrics, cluster_ids=lambda: [1, 3, 4])
+    fingerprint = metrics_fingerprint(spike_clusters, metrics=metrics, extra='x')
+    path = tempdir / 'metrics.pkl'
+
+    assert not m.load(path, fingerprint)
+    m.save(path, fingerprint)
+
+    # Different spike clusters, metrics, or data.
+    assert metrics_fingerprint(spike_clusters[::-1], metrics=metrics, extra='x') != fingerprint
+    assert metrics_fingerprint(spike_clusters, metrics={'name': len}, extra='x') != fingerprint
+    assert metrics_fingerprint(spike_clusters, metrics=metrics, extra='y') != fingerprint
+
+    n_calls = []
+    m = ClusterMetrics(
+        metrics={name: n_calls.append for name in metrics}, cluster_ids=lambda: [1, 3, 4])
+    assert not m.load(path, 'other')
+    assert m.load(path, fingerprint)
+    assert m.from_snapshot
+    assert m.rows() == [
+        {'id': 1, 'square': 1, 'name': 'c1'},
+        {'id': 3, 'square': 9, 'name': 'c3'},
+        {'id': 4, 'square': 16, 'name': 'c4'}]
+    assert not n_calls
+
+    # Corrupted snapshot.
+    path.write_bytes(b'abc')
+    assert not m.load(path, fingerprint)
+
+
+def test_cluster_metrics_refresh():
+    values = {1: 1., 3: np.nan, 4: 4.}
+    ids = [1, 3, 4]
+    m = ClusterMetrics(metrics={'x': values.get}, cluster_ids=lambda: ids)
+    ae(m.column('x').astype(float), [1, np.nan, 4])
+
+    values[4] = 5.
+    table = m.compute()
+    # The table is not modified by compute().
+    ae(m.column('x').astype(float), [1, np.nan, 4])
+    assert m.set_table(table) == [4]
+    ae(m.column('x').astype(float), [1, np.nan, 5])
+
+    # The clusters have changed in the meantime.
+    table = m.compute()
+    ids.append(5)
+    values[5] = 0
+    m._ids = None
+    assert m.set_table(table) is None
+
+
+def test_cluster_metrics_iter_compute():
+    values = {cluster_id: float(cluster_id) for cluster_id in range(10)}
+    m = ClusterMetrics(
+        metrics={'x': values.get}, vectorized={'y': lambda ids: 2 * ids},
+        cluster_ids=lambda: sorted(values))
+    steps = list(m.iter_compute(batch_size=4))
+    # One step per batch, and the table.
+    assert steps[:3] == [None] * 3
+    table = steps[-1]
+    ae(table.ids, np.arange(10))
+    ae(table.columns['x'].astype(float), np.arange(10))
+    ae(table.columns['y'], 2 * np.arange(10))
+    assert m.set_table(table) == []
+
+
+def test_cluster_metrics_startup_snapshot(tempdir):
+    n_clusters = 2000
+    cluster_ids = lambda: np.arange(n_clusters)
+    n_calls = []
+
+    def metric(cluster_id):
+        n_calls.append(cluster_id)
+        return float(cluster_id)
+
+    metrics = {'m%d' % i: metric for i in range(5)}
+    path = tempdir / 'metrics.pkl'
+
+    m = ClusterMetrics(metrics=metrics, cluster_ids=cluster_ids)
+    rows = m.rows()
+    assert len(n_calls) == 5 * n_clusters
+    m.save(path, 'f')
+
+    # No metric is computed when the table is loaded from the snapshot.
+    del n_calls[:]
+    m = ClusterMetrics(metrics=metrics, cluster_ids=cluster_ids)
+    assert m.load(path, 'f')
+    assert m.rows() == rows
+    assert not n_calls
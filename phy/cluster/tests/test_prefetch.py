@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Test prefetch."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+
+from phylib.utils import Bunch
+from phy.utils.context import Context, merge_sum, _fullname
+from .._prefetch import Prefetcher
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_prefetcher_empty():
+    p = Prefetcher(enable_threading=False)
+    assert p.prefetch([1, 2, 3]) is None
+
+    p = Prefetcher(n_clusters=0, enable_threading=False)
+    p.add(lambda cluster_id: cluster_id)
+    assert p.prefetch([1, 2, 3]) is None
+
+
+def test_prefetcher_sync():
+    _calls = []
+
+    def f(cluster_id):
+        _calls.append(('f', cluster_id))
+        return np.zeros(10)
+
+    def g(cluster_id):
+        _calls.append(('g', cluster_id))
+        if cluster_id == 3:
+            raise KeyError(cluster_id)
+
+    p = Prefetcher(n_clusters=2, enable_threading=False)
+    p.add(f)
+    p.add(g)
+    assert p.functions == [f, g]
+
+    # Excluded and duplicate clusters are skipped, and the number of clusters is capped.
+    assert p.prefetch([1, 1, 2, 3, 4], exclude=[2]) == 3
+    assert _calls == [('f', 1), ('g', 1), ('f', 3), ('g', 3)]
+
+    # Size limit: the prefetch stops after the first array of 80 bytes.
+    del _calls[:]
+    p.max_bytes = 50
+    assert p.prefetch([5, 6]) == 1
+    assert _calls == [('f', 5)]
+
+
+def test_prefetcher_cancel():
+    p = Prefetcher(enable_threading=False)
+    _calls = []
+
+    def f(cluster_id):
+        _calls.append(cluster_id)
+        # A new selection occurs while prefetching.
+        if cluster_id == 2:
+            p.cancel()
+
+    p.add(f)
+    assert p.prefetch([1, 2, 3]) == 2
+    assert _calls == [1, 2]
+
+
+def test_prefetcher_threaded(qtbot):
+    p = Prefetcher()
+    _calls = []
+    p.add(_calls.append)
+    p.prefetch([1, 2])
+    qtbot.waitUntil(lambda: _calls == [1, 2])
+
+
+def test_prefetcher_memcache(qtbot, tempdir):
+    context = Context(tempdir / 'cache')
+    context.memcache_limit = 50 * 800
+    _calls = []
+
+    def f(cluster_id):
+        _calls.append(cluster_id)
+        return np.zeros(100) + cluster_id
+    f = context.memcache(f, per_cluster=True, merge=merge_sum)
+
+    # The memcache is updated in the main thread while the prefetch runs in the thread pool.
+    p = Prefetcher(n_clusters=200)
+    p.add(f)
+    p.prefetch(list(range(200)))
+    for i in range(100):
+        context.update_memcache(Bunch(description='merge', added=[1000 + i], deleted=[i, i + 1]))
+        f(i)
+    qtbot.waitUntil(lambda: 199 in _calls)
+    cache = context._memcache[_fullname(f)]
+    assert cache.nbytes == sum(v.nbytes for k, v in cache.items())
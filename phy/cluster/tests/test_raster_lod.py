@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Test raster spike density."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
+from .._raster_lod import RasterDensity, _bin_counts, _merge_bins, _normalize_counts
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_raster_density_utils():
+    spike_times = np.array([0., .5, 1., 1.5, 2.5, 3.9, 4.])
+    spike_clusters = np.array([1, 3, 1, 7, 3, 1, 3])
+    counts = _bin_counts(spike_times, spike_clusters, [3, 1], (0, 4), 4, chunk_size=2)
+    ae(counts, [[1, 0, 1, 1], [1, 1, 0, 1]])
+    # Clusters without spikes, and restricted interval.
+    ae(_bin_counts(spike_times, spike_clusters, [5], (0, 4), 2), [[0, 0]])
+    ae(_bin_counts(spike_times, spike_clusters, [1, 7], (1, 2), 2), [[1, 0], [0, 1]])
+
+    ae(_merge_bins(counts, 2), [[1, 2], [2, 1]])
+    ae(_merge_bins(counts, 3), [[2, 1], [2, 1]])
+    ae(_merge_bins(counts, 1), counts)
+
+    ac(_normalize_counts([[0, 1, 4], [0, 0, 0]], floor=.2), [[0, .4, 1], [0, 0, 0]])
+    assert _normalize_counts(np.zeros((2, 0))).shape == (2, 0)
+
+
+def test_raster_density():
+    n_spikes, n_clusters = 100000, 20
+    spike_times = np.sort(np.random.uniform(0, 100, n_spikes))
+    spike_clusters = np.random.randint(0, n_clusters, n_spikes)
+
+    d = RasterDensity(spike_times, spike_clusters, duration=100)
+    d.n_bins = 1000
+    d.chunk_size = 10000
+
+    # Coarse bins: the cached counts are merged.
+    b = d.get([4, 2], n_bins=100)
+    assert b.counts.shape == (2, 100)
+    assert b.interval == (0, 100)
+    assert b.counts[0].sum() == np.sum(spike_clusters == 4)
+    assert sorted(d._rows) == [2, 4]
+
+    # The bins are aligned with the cached bins.
+    b = d.get([4], (10.05, 20.), n_bins=50)
+    assert b.counts.shape == (1, 50)
+    ac(b.interval, (10, 20.))
+    ac(b.counts, d.get([4], (10, 20), n_bins=50).counts)
+
+    # Fine bins: the counts are computed from the spikes in the interval.
+    b = d.get([4, 5], (10, 10.5), n_bins=100)
+    assert b.counts.shape == (2, 100)
+    assert b.interval == (10, 10.5)
+    spikes = (spike_times >= 10) & (spike_times <= 10.5)
+    assert b.counts[1].sum() == np.sum(spikes & (spike_clusters == 5))
+    assert sorted(d._rows) == [2, 4]
+
+    # New clusters after a merge.
+    spike_clusters[np.isin(spike_clusters, [2, 4])] = n_clusters
+    b = d.get([n_clusters, 4], n_bins=1000)
+    ae(b.counts[0], d.get([2]).counts[0] + b.counts[1])
@@ -320,16 +320,95 @@ def test_supervisor_cluster_metrics(
     assert 'my_metrics' in mc.columns
 
 
+def test_supervisor_metrics_snapshot(
+        qtbot, gui, cluster_ids, similarity, tempdir, monkeypatch):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    values = {}
+    n_calls = []
+
+    def my_metrics(cluster_id):
+        n_calls.append(cluster_id)
+        return values.get(cluster_id, cluster_id ** 2)
+
+    def _create():
+        return Supervisor(
+            spike_clusters, cluster_metrics={'my_metrics': my_metrics}, similarity=similarity,
+            context=Context(tempdir), metrics_fingerprint=lambda: 'data')
+
+    mc = _create()
+    info = mc.cluster_info
+    assert len(n_calls) == len(cluster_ids)
+    mc.save_metrics_snapshot()
+
+    # The metrics are loaded from the snapshot at the next launch.
+    del n_calls[:]
+    mc = _create()
+    assert mc.metrics.from_snapshot
+    assert mc.cluster_info == info
+    assert not n_calls
+
+    # Revalidation of the snapshot in the background.
+    mc.attach(gui)
+    b = Barrier()
+    connect(b('cluster_view'), event='ready', sender=mc.cluster_view)
+    connect(b('similarity_view'), event='ready', sender=mc.similarity_view)
+    b.wait()
+    values[cluster_ids[0]] = -1
+    mc.refresh_metrics()
+    qtbot.waitUntil(lambda: not mc.metrics.from_snapshot)
+    assert mc.cluster_view.get(cluster_ids[0])['my_metrics'] == -1
+
+    # The refresh is done between the GUI events, and is cancelled by a clustering action.
+    mc.metrics.from_snapshot = True
+    mc.refresh_metrics()
+    mc.clustering.merge(cluster_ids[:2])
+    del n_calls[:]
+    qtbot.wait(50)
+    assert not n_calls
+    assert mc.metrics.from_snapshot
+
+    # The spike_clusters array is hashed once for the spikes_per_cluster store and the
+    # metrics snapshot.
+    hashes = []
+    monkeypatch.setattr(
+        _supervisor, '_spike_clusters_hash', lambda arr: hashes.append(arr) or 'hash')
+    _create().save_metrics_snapshot()
+    assert len(hashes) == 1
+    monkeypatch.undo()
+
+    # The snapshot is discarded when the data has changed.
+    mc = Supervisor(
+        spike_clusters, cluster_metrics={'my_metrics': my_metrics}, similarity=similarity,
+        context=Context(tempdir), metrics_fingerprint=lambda: 'other data')
+    assert not mc.metrics.from_snapshot
+
+
 def test_supervisor_select_1(qtbot, supervisor):
     # WARNING: always use actions in tests, because this doesn't call
     # the supervisor method directly, but raises an event, enqueue the task,
     # and call TaskLogger.process() which handles the cascade of callbacks.
+    generation = supervisor.select_generation
     supervisor.select_actions.select([0])
     supervisor.block()
     _assert_selected(supervisor, [0])
+    assert supervisor.select_generation > generation
+    assert supervisor.n_coalesced_selections == 0
     supervisor.task_logger.show_history()
 
 
+def test_supervisor_select_coalesced(qtbot, supervisor):
+    view = object()
+    emit('is_busy', view, True)
+    # The same selection may be coalesced in several views.
+    for generation in (1, 2, 2):
+        emit('select_coalesced', view, generation)
+    assert supervisor.n_coalesced_selections == 2
+    # The generations are forgotten once all views have shown the latest selection.
+    emit('is_busy', view, False)
+    assert not supervisor._coalesced
+    assert supervisor.n_coalesced_selections == 2
+
+
 def test_supervisor_select_2(qtbot, supervisor):
     supervisor.select_actions.next_best()
     supervisor.block()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Test cluster template counts."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.utils import connect
+from ..clustering import Clustering
+from .._template_counts import ClusterTemplateCounts
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _check(counts, clustering, spike_templates, n_templates):
+    for cluster_id in clustering.cluster_ids:
+        spike_ids = clustering.spikes_per_cluster[cluster_id]
+        expected = np.bincount(spike_templates[spike_ids], minlength=n_templates)
+        ae(counts.counts(cluster_id), expected)
+        assert counts.best_template(cluster_id) == np.argmax(expected)
+    ae(counts.best_templates(clustering.cluster_ids),
+       [counts.best_template(cluster_id) for cluster_id in clustering.cluster_ids])
+    m = counts.matrix(clustering.cluster_ids)
+    assert m.shape == (len(clustering.cluster_ids), n_templates)
+    assert m.sum() == len(spike_templates)
+
+
+def test_template_counts_1():
+    spike_templates = np.array([0, 1, 1, 2, 2, 2, 3, 0])
+    spike_clusters = np.array([0, 1, 1, 2, 2, 2, 2, 5])
+    counts = ClusterTemplateCounts(
+        spike_templates=spike_templates, spike_clusters=spike_clusters, n_templates=5)
+
+    ae(counts.counts(2), [0, 0, 3, 1, 0])
+    ae(counts.counts(5), [1, 0, 0, 0, 0])
+    ae(counts.templates(2), [2, 3])
+    assert counts.best_template(1) == 1
+    assert counts.best_template(2) == 2
+
+    m = counts.matrix([2, 0, 5])
+    ae(m.toarray(), [[0, 0, 3, 1, 0], [1, 0, 0, 0, 0], [1, 0, 0, 0, 0]])
+
+    ae(counts.best_templates([2, 0, 1, 5]), [2, 0, 1, 0])
+    assert counts.best_templates([]).shape == (0,)
+
+    values = np.array([.1, -.5, .3, .7, 1.])
+    ae(counts.max_per_cluster(values, [0, 1, 2, 5]), [.1, -.5, .7, .1])
+
+
+def test_template_counts_chunks():
+    n_spikes, n_templates = 1000, 20
+    spike_templates = np.random.randint(0, n_templates, n_spikes)
+    spike_clusters = np.random.randint(0, 30, n_spikes)
+
+    class Counts(ClusterTemplateCounts):
+        chunk_size = 64
+
+    counts = Counts(
+        spike_templates=spike_templates, spike_clusters=spike_clusters, n_templates=n_templates)
+    for cluster_id in np.unique(spike_clusters):
+        expected = np.bincount(
+            spike_templates[spike_clusters == cluster_id], minlength=n_templates)
+        ae(counts.counts(cluster_id), expected)
+        ae(counts.templates(cluster_id), np.nonzero(expected)[0])
+
+
+def test_template_counts_matrix_cache():
+    spike_templates = np.array([0, 1, 1, 2, 2, 2, 3, 0])
+    clustering = Clustering(np.array([0, 1, 1, 2, 2, 2, 2, 5]))
+    counts = ClusterTemplateCounts(
+        spike_templates=spike_templates, spike_clusters=clustering.spike_clusters,
+        n_templates=5,
+        spikes_per_cluster=lambda cluster_id: clustering.spikes_per_cluster[cluster_id])
+
+    # The matrix is reused until the next clustering action.
+    m = counts.matrix(clustering.cluster_ids)
+    assert counts.matrix(clustering.cluster_ids) is m
+    assert counts.matrix([0, 1]) is not m
+
+    counts.update(clustering.merge([1, 2]))
+    m = counts.matrix(clustering.cluster_ids)
+    ae(m.toarray(), [[1, 0, 0, 0, 0], [1, 0, 0, 0, 0], [0, 2, 3, 1, 0]])
+
+
+def test_template_counts_clustering():
+    n_spikes, n_templates = 1000, 20
+    spike_templates = np.random.randint(0, n_templates, n_spikes)
+    clustering = Clustering(spike_templates.copy())
+    counts = ClusterTemplateCounts(
+        spike_templates=spike_templates, spike_clusters=clustering.spike_clusters,
+        n_templates=n_templates,
+        spikes_per_cluster=lambda cluster_id: clustering.spikes_per_cluster[cluster_id])
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        counts.update(up)
+
+    _check(counts, clustering, spike_templates, n_templates)
+
+    clustering.merge([2, 3, 5])
+    _check(counts, clustering, spike_templates, n_templates)
+
+    clustering.split(np.arange(0, n_spikes, 3))
+    _check(counts, clustering, spike_templates, n_templates)
+
+    clustering.undo()
+    _check(counts, clustering, spike_templates, n_templates)
+
+    clustering.undo()
+    _check(counts, clustering, spike_templates, n_templates)
+
+    clustering.redo()
+    _check(counts, clustering, spike_templates, n_templates)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""Test trace cache."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
+from .._trace_cache import TraceCache, _regular_chunk_bounds, _split_chunk_bounds
+from .._utils import RotatingProperty
+
+
+#------------------------------------------------------------------------------
+# Fixtures
+#------------------------------------------------------------------------------
+
+class _Traces(object):
+    """Array wrapper counting the number of reads."""
+    def __init__(self, arr, chunk_bounds=None):
+        self.arr = arr
+        self.shape = arr.shape
+        if chunk_bounds is not None:
+            self.chunk_bounds = chunk_bounds
+        self.n_reads = 0
+        self.n_samples_read = 0
+
+    def __getitem__(self, item):
+        self.n_reads += 1
+        self.n_samples_read += len(self.arr[item])
+        return self.arr[item]
+
+
+def _filter():
+    f = RotatingProperty()
+    f.add('raw', lambda x, axis=None: x)
+    f.add('double', lambda x, axis=None: 2 * x)
+    return f
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_regular_chunk_bounds():
+    ae(_regular_chunk_bounds(10, 3), [0, 3, 6, 9, 10])
+    ae(_regular_chunk_bounds(9, 3), [0, 3, 6, 9])
+
+
+def test_trace_cache_get():
+    arr = np.random.randn(1000, 4)
+    traces = _Traces(arr, chunk_bounds=[0, 300, 600, 1000])
+    f = _filter()
+    c = TraceCache(
+        traces=traces, sample_rate=100., raw_data_filter=f, chunk_duration=5.,
+        enable_threading=False)
+    assert c.padding == 5
+    ae(c.chunk_bounds, [0, 300, 600, 1000])
+
+    # Interval within a chunk: the chunk is centred with its padded median.
+    out = c.get((1., 2.))
+    assert out.dtype == np.float32
+    ac(out, arr[100:200] - np.median(arr[0:305], axis=0), rtol=1e-5, atol=1e-5)
+    assert traces.n_reads == 1
+
+    # Interval overlapping two chunks, the first is already cached.
+    out = c.get((2., 4.))
+    assert out.shape == (200, 4)
+    ac(out[100:], arr[300:400] - np.median(arr[295:605], axis=0), rtol=1e-5, atol=1e-5)
+    assert traces.n_reads == 2
+    assert (0, 'raw') in c and (1, 'raw') in c
+
+    # Cached: no read.
+    c.get((3., 5.))
+    assert traces.n_reads == 2
+
+    # The chunks are cached per filter.
+    f.set('double')
+    out = c.get((3., 5.))
+    assert traces.n_reads == 3
+    assert (1, 'double') in c
+    ac(out, 2 * c.get_chunk(1, 'raw')[:200], rtol=1e-5, atol=1e-5)
+
+    # Out of bounds.
+    assert c.get((9., 12.)).shape == (100, 4)
+    assert c.get((12., 13.)).shape == (0, 4)
+
+
+def test_split_chunk_bounds():
+    ae(_split_chunk_bounds([0, 10, 13], 4), [0, 3, 6, 10, 13])
+    ae(_split_chunk_bounds([0, 4, 8], 4), [0, 4, 8])
+
+
+def test_trace_cache_huge_chunk():
+    arr = np.random.randn(1000, 4)
+    # The reader reports a single chunk for the whole data.
+    traces = _Traces(arr, chunk_bounds=[0, 1000])
+    c = TraceCache(traces=traces, sample_rate=100., enable_threading=False)
+    # The chunk is split into chunks of one second.
+    assert c.n_chunks == 10
+    out = c.get((2.2, 2.8))
+    ac(out, arr[220:280] - np.median(arr[195:305], axis=0), rtol=1e-5, atol=1e-5)
+    # Only the chunk of the interval is read, with its padding.
+    assert traces.n_samples_read == 110
+    assert c.nbytes == 100 * 4 * 4
+
+
+def test_trace_cache_lru():
+    arr = np.random.randn(1000, 4)
+    traces = _Traces(arr)
+    c = TraceCache(traces=traces, sample_rate=100., enable_threading=False)
+    # Regular chunks of one second.
+    assert c.n_chunks == 10
+    # Room for two chunks only.
+    c.max_bytes = 2 * 100 * 4 * 4
+    c.get((0., 1.))
+    c.get((1., 2.))
+    c.get((0., .5))
+    c.get((2., 3.))
+    assert (0, None) in c
+    assert (1, None) not in c
+    assert (2, None) in c
+    assert c.nbytes == c.max_bytes
+
+    c.clear()
+    assert c.nbytes == 0
+    assert (0, None) not in c
+
+
+def test_trace_cache_read_ahead(qtbot):
+    arr = np.random.randn(1000, 4)
+    traces = _Traces(arr)
+    c = TraceCache(traces=traces, sample_rate=100., n_read_ahead=2)
+
+    # No read-ahead before the panning direction is known.
+    c.get((4.2, 4.8))
+    assert traces.n_reads == 1
+
+    # Panning to the right.
+    c.get((4.5, 5.1))
+    qtbot.waitUntil(lambda: (6, None) in c and (7, None) in c)
+    assert (3, None) not in c
+
+    # Panning to the left.
+    c.get((4.0, 4.6))
+    qtbot.waitUntil(lambda: (3, None) in c and (2, None) in c)
+
+
+class _CumSum(object):
+    """Chunked filter computing the cumulative sum."""
+    def __call__(self, arr, axis=0):  # pragma: no cover
+        return np.cumsum(arr, axis=axis)
+
+    def filter_chunk(self, arr):
+        return np.cumsum(arr, axis=0)
+
+
+def test_trace_cache_chunked_filter():
+    arr = np.random.randn(1000, 4)
+    traces = _Traces(arr, chunk_bounds=[0, 300, 600, 1000])
+    f = RotatingProperty()
+    f.add('cumsum', _CumSum())
+    c = TraceCache(
+        traces=traces, sample_rate=100., raw_data_filter=f, chunk_duration=5.,
+        enable_threading=False)
+
+    def _centred(x):
+        return x - np.median(x, axis=0)
+
+    # The first chunk is filtered from the beginning of the data.
+    ac(c.get_chunk(0), _centred(np.cumsum(arr, axis=0)[:300]), rtol=1e-5, atol=1e-4)
+
+    # The other chunks are filtered from their left padding, even when the previous chunk
+    # has been filtered.
+    ac(c.get_chunk(1), _centred(np.cumsum(arr[295:], axis=0)[5:305]), rtol=1e-5, atol=1e-4)
+    c.clear()
+    ac(c.get_chunk(2), _centred(np.cumsum(arr[595:], axis=0)[5:]), rtol=1e-5, atol=1e-4)
+
+
+def test_trace_cache_chunked_filter_order():
+    arr = np.random.randn(1000, 4)
+    f = RotatingProperty()
+    f.add('cumsum', _CumSum())
+
+    def _load(order):
+        c = TraceCache(traces=arr, sample_rate=100., raw_data_filter=f, enable_threading=False)
+        return [c.get_chunk(chunk_idx) for chunk_idx in order]
+
+    # The chunks do not depend on the order in which they are loaded.
+    chunks = _load(range(10))
+    for order in ([9, 3, 4, 0, 1, 2, 8, 7, 6, 5], range(9, -1, -1)):
+        for chunk_idx, chunk in zip(order, _load(order)):
+            ae(chunk, chunks[chunk_idx])
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Test trace envelope pyramid."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
+from .._trace_cache import TraceCache
+from .._trace_lod import (
+    TracePyramid, _reduce_envelope, _sample_envelope, _interleave_envelope, _filter_fingerprint)
+from .._utils import RotatingProperty
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_envelope_utils():
+    arr = np.array([[0, 5], [3, 1], [-2, 4], [1, 1], [7, -1]], dtype=np.float32)
+    env = _sample_envelope(arr, 2)
+    assert env.shape == (3, 2, 2)
+    ae(env[:, 0, 0], [0, -2, 7])
+    ae(env[:, 1, 0], [3, 1, 7])
+    ae(env[:, 0, 1], [1, 1, -1])
+    ae(env[:, 1, 1], [5, 4, -1])
+
+    ae(_reduce_envelope(env, 2), _sample_envelope(arr, 4))
+    ae(_reduce_envelope(env, 1), env)
+
+    data, times = _interleave_envelope(env, 1., .5)
+    ae(data[:, 0], [0, 3, -2, 1, 7, 7])
+    ae(times, [1, 1, 1.5, 1.5, 2, 2])
+
+
+class _Traces(object):
+    """Array wrapper counting the number of samples read."""
+    def __init__(self, arr):
+        self.arr = arr
+        self.shape = arr.shape
+        self.n_samples_read = 0
+
+    def __getitem__(self, item):
+        self.n_samples_read += len(self.arr[item])
+        return self.arr[item]
+
+
+class _Filter(object):
+    def __init__(self, gain):
+        self.gain = np.array([gain])
+
+    def __call__(self, arr, axis=0):
+        return self.gain * arr
+
+
+def _pyramid(cache_dir=None, n_samples=10000, n_channels=3, fingerprint='', arr=None, f=None):
+    arr = np.random.randn(n_samples, n_channels) if arr is None else arr
+    c = TraceCache(
+        traces=_Traces(arr), sample_rate=1000., raw_data_filter=f, enable_threading=False)
+
+    class Pyramid(TracePyramid):
+        base_factor = 4
+        level_factor = 2
+        block_size = 100
+
+    return arr, c, Pyramid(trace_cache=c, cache_dir=cache_dir, fingerprint=fingerprint)
+
+
+def test_filter_fingerprint():
+    assert _filter_fingerprint(None) == 'None'
+    assert _filter_fingerprint(_Filter(1)) == _filter_fingerprint(_Filter(1))
+    assert _filter_fingerprint(_Filter(1)) != _filter_fingerprint(_Filter(2))
+    assert _filter_fingerprint(lambda x: x) != _filter_fingerprint(lambda x: 2 * x)
+
+
+def test_trace_pyramid_levels():
+    _, c, p = _pyramid()
+    assert p.factors == [4, 8, 16, 32, 64, 128]
+    assert p.n_levels == 6
+    assert p.n_bins(0) == 2500
+    assert p.n_bins(5) == 79
+
+    assert p.get_level(3) is None
+    assert p.get_level(4) == 0
+    assert p.get_level(20) == 2
+    assert p.get_level(1000) == 5
+
+    # Not enough samples per pixel: no decimation.
+    assert p.get((0., 1.), 500) is None
+
+
+def test_trace_pyramid_get():
+    arr, c, p = _pyramid()
+    filtered = c.get_samples(0, 10000)
+
+    # 5000 samples on 100 pixels: level 3 (32 samples per bin).
+    out = p.get((1., 6.), 100)
+    assert out.factor == 32
+    n = out.data.shape[0] // 2
+    assert n == 188 - 31
+    assert out.data.shape == (2 * n, 3)
+    ac(out.times[::2], np.arange(31, 188) * .032)
+    for k in (0, 10, n - 1):
+        b = filtered[(31 + k) * 32:(32 + k) * 32]
+        ac(out.data[2 * k], b.min(axis=0))
+        ac(out.data[2 * k + 1], b.max(axis=0))
+
+    # Only the blocks needed by the interval have been computed.
+    _, blocks = p._open_level(None, 0)
+    assert np.all(blocks[:16])
+    assert not np.any(blocks[16:])
+
+    # Bins merged at the coarsest level.
+    out = p.get((0., 10.), 20)
+    assert out.factor == 128 * 3
+    ac(out.data[1], filtered[:384].max(axis=0))
+
+
+def test_trace_pyramid_reads():
+    arr, c, p = _pyramid()
+    p.get((0., 10.), 20)
+    # Every chunk has been read once, with its padding, even though the blocks of the finest
+    # level do not coincide with the chunks.
+    assert c.traces.n_samples_read == 10000 + 18 * 50
+    assert c.nbytes == 0
+
+
+def test_trace_pyramid_disk(tempdir):
+    path = tempdir / 'envelopes'
+    f = RotatingProperty()
+    f.add('gain', _Filter(1))
+    arr, c, p = _pyramid(cache_dir=path, fingerprint='data', f=f)
+    out = p.get((0., 10.), 200)
+    assert out.data.shape[0] >= 400
+    assert len(list(path.glob('envelope_gain_32_*.npy'))) == 2
+
+    # The envelopes are reloaded from disk and not recomputed.
+    _, c_, p_ = _pyramid(cache_dir=path, fingerprint='data', arr=arr, f=f)
+    out_ = p_.get((0., 10.), 200)
+    ae(out_.data, out.data)
+    assert c_.traces.n_samples_read == 0
+
+    # The envelopes are recomputed when the data has changed, and the stale files are deleted.
+    _, c_, p_ = _pyramid(cache_dir=path, fingerprint='other data', arr=2 * arr, f=f)
+    ac(p_.get((0., 10.), 200).data, 2 * out.data, rtol=1e-5, atol=1e-5)
+    assert c_.traces.n_samples_read > 0
+    assert len(list(path.glob('envelope_gain_32_*.npy'))) == 2
+
+    # The envelopes are recomputed when the filter parameters have changed.
+    f = RotatingProperty()
+    f.add('gain', _Filter(3))
+    _, c_, p_ = _pyramid(cache_dir=path, fingerprint='data', arr=arr, f=f)
+    ac(p_.get((0., 10.), 200).data, 3 * out.data, rtol=1e-5, atol=1e-5)
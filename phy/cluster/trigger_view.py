@@ -1,17 +1,17 @@
 from phylib.utils import emit
-from phy.gui.widgets import Table, HTMLWidget
+from phy.gui.table import NativeTable
 
 # -----------------------------------------------------------------------------
 # Trigger view
 # -----------------------------------------------------------------------------
 
 
-class TriggerView(Table):
+class TriggerView(NativeTable):
     """Display a table of triggers with their names and counts."""
     _view_name = 'trigger_view'
 
     def __init__(self, *args, data=None, columns=(), sort=None):
-        HTMLWidget.__init__(
+        NativeTable.__init__(
             self, *args, title=self.__class__.__name__, debounce_events=('select',))
         self._reset_table(data=data, columns=columns, sort=sort)
 
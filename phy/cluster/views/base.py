@@ -58,6 +58,10 @@ class ManualClusteringView(object):
     - `view_attached(view, gui)`: this is the event to connect to if you write a plugin that
       needs to modify a view.
     - `is_busy(view)`
+    - `select_coalesced(view, generation)`: when a selection is superseded by a more recent
+      one before the view has been updated.
+    - `select_deferred(view, cluster_ids)`: when the view is hidden (for example in a
+      non-current dock tab) and the selection is only processed once the view is shown.
     - `toggle_auto_update(view)`
 
     """
@@ -72,7 +76,15 @@ class ManualClusteringView(object):
 
     def __init__(self, shortcuts=None, **kwargs):
         self._lock = None
+        # Version of the latest selection, and latest selection received while the view was
+        # busy, used to drop stale view updates.
+        self._select_version = 0
+        self._pending_select = None
         self._closed = False
+        # Whether the dock of the view is hidden, and selections received in the meantime,
+        # processed when the view becomes visible: {event_name: function}.
+        self._hidden = False
+        self._deferred = {}
         self.cluster_ids = ()
 
         #  = f'export-{cls.__name__.lower()}'
@@ -162,11 +174,34 @@ class ManualClusteringView(object):
         # Maximum number of clusters that can be displayed in the view, for performance reasons.
         if self.max_n_clusters and len(cluster_ids) > self.max_n_clusters:
             return
+        # The selection generation of the supervisor, shared by all views, only identifies the
+        # selection in the select_coalesced event.
+        generation = getattr(sender, 'select_generation', None)
+        # Hidden views do not compute anything, only the latest selection is processed once
+        # the view is shown.
+        if self._hidden:
+            self._deferred['select'] = partial(
+                self._select_threaded, sender, cluster_ids, gui, generation, kwargs)
+            emit('select_deferred', self, cluster_ids)
+            return
+        self._select_threaded(sender, cluster_ids, gui, generation, kwargs)
+
+    def _select_threaded(self, sender, cluster_ids, gui, generation, kwargs):
+        # Every selection gets a new version number from the view's own counter. Only the
+        # results of the latest selection are shown, the results of the previous selections
+        # are stale.
+        self._select_version += 1
+        version = self._select_version
 
         # The lock is used so that two different background threads do not access the same
         # view simultaneously, which can lead to conflicts, errors in the plotting code,
-        # and QTimer thread exceptions that lead to frozen OpenGL views.
+        # and QTimer thread exceptions that lead to frozen OpenGL views. When the view is
+        # busy, the latest selection is kept and processed as soon as the view is free, the
+        # intermediate selections are coalesced.
         if self._lock:
+            if self._pending_select:
+                emit('select_coalesced', self, self._pending_select[3])
+            self._pending_select = (sender, cluster_ids, gui, generation, kwargs)
             return
         self._lock = True
 
@@ -179,6 +214,9 @@ class ManualClusteringView(object):
 
         # This function executes in the Qt thread pool.
         def _worker():  # pragma: no cover
+            # The selection has changed while the task was waiting in the thread pool.
+            if version != self._select_version:
+                return
             self.on_select(cluster_ids=cluster_ids, **kwargs)
 
         # We launch this function in the thread pool.
@@ -199,6 +237,16 @@ class ManualClusteringView(object):
             except NameError as e:  # pragma: no cover
                 logger.warning(str(e))
                 return
+            self._lock = None
+            # The selection has changed in the meantime: the results are stale. The recorded
+            # OpenGL updates are kept in the queue, as they are superseded by the updates
+            # of the next computation, and we process the latest selection.
+            pending, self._pending_select = self._pending_select, None
+            if version != self._select_version and pending and not self._closed:
+                logger.log(5, "Drop stale view update in %s.", self.name)
+                emit('select_coalesced', self, generation)
+                self._select_threaded(*pending)
+                return
             # When the task has finished in the thread pool, we recover all program
             # updates of the view, and we execute them on the GPU.
             if isinstance(self.canvas, PlotCanvas):
@@ -210,7 +258,6 @@ class ManualClusteringView(object):
             # Finally, we update the canvas.
             self.canvas.update()
             emit('is_busy', self, False)
-            self._lock = None
             self.update_status()
 
         # Start the task on the thread pool, and let the OpenGL canvas know that we're
@@ -218,14 +265,12 @@ class ManualClusteringView(object):
         # This is what we call the "lazy" mode.
         emit('is_busy', self, True)
 
-        # HACK: disable threading mechanism for now
-        # if getattr(gui, '_enable_threading', True):
-        if 0:   # pragma: no cover
-            # This is only for OpenGL views.
+        # NOTE: only OpenGL views can be updated from a background thread.
+        if getattr(gui, '_enable_threading', True) and isinstance(self.canvas, PlotCanvas):
             self.canvas.set_lazy(True)
             thread_pool().start(worker)
         else:
-            # This is for OpenGL views, without threading.
+            # Without threading, the data is computed and the view updated in the main thread.
             worker.run()
             self._lock = None
 
@@ -240,9 +285,23 @@ class ManualClusteringView(object):
         assert isinstance(trigger_ids, list)
         if not trigger_ids:
             return
-        
+        if self._hidden:
+            self._deferred['select_triggers'] = partial(
+                self.on_trigger_select_threaded, sender, trigger_ids, gui=gui, **kwargs)
+            return
+
         self.plot(**kwargs)
         
+    def _on_dock_visibility_changed(self, visible):
+        """Called when the dock of the view is shown or hidden, for example when switching
+        dock tabs. The selections deferred while the view was hidden are processed."""
+        self._hidden = not visible
+        if not visible or self._closed:
+            return
+        deferred, self._deferred = self._deferred, {}
+        for f in deferred.values():
+            f()
+
     def on_cluster(self, up):
         """Callback function when a clustering action occurs. May be overriden.
 
@@ -263,6 +322,7 @@ class ManualClusteringView(object):
         - Update the view's attribute from the GUI state
         - Add the default view actions (auto_update, screenshot)
         - Bind the on_select() method to the select and select_triggers event raised by the supervisor.
+        - Defer the selections received while the view is hidden until it is shown.
 
         """
 
@@ -271,6 +331,8 @@ class ManualClusteringView(object):
 
         gui.add_view(self, position=self._default_position)
         self.gui = gui
+        # Skip the selections while the view is hidden.
+        self.dock.visibilityChanged.connect(self._on_dock_visibility_changed)
 
         # Set the view state.
         self.set_state(gui.state.get_view_state(self))
@@ -299,6 +361,7 @@ class ManualClusteringView(object):
                 return
             logger.debug("Close view %s.", self.name)
             self._closed = True
+            self._deferred.clear()
             gui.remove_menu(self.name)
             unconnect(on_select)
             gui.state.update_view_state(self, self.state)
@@ -12,11 +12,12 @@ import logging
 import numpy as np
 
 from phylib.io.array import _index_of
-from phylib.utils import emit
+from phylib.utils import emit, connect, Bunch
 from phy.utils.color import _add_selected_clusters_colors
 
 from .base import ManualClusteringView, BaseGlobalView, MarkerSizeMixin, BaseColorView
-from phy.plot.visuals import ScatterVisual
+from phy.cluster._raster_lod import RasterDensity, _normalize_counts
+from phy.plot.visuals import ScatterVisual, DensityVisual
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,10 @@ logger = logging.getLogger(__name__)
 class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusteringView):
     """This view shows a raster plot of all clusters.
 
+    When there are more than `max_marker_spikes` spikes around the visible time range, the view
+    shows the spike density of every cluster in time bins instead of individual spikes. The
+    individual spikes of the visible time range are shown when zooming in.
+
     Constructor
     -----------
 
@@ -42,6 +47,12 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
 
     _default_position = 'right'
 
+    # Maximum number of spikes shown as individual markers.
+    max_marker_spikes = 1000000
+
+    # Maximum number of time bins of the spike density.
+    max_density_bins = 4096
+
     default_shortcuts = {
         'change_marker_size': 'alt+wheel',
         'switch_color_scheme': 'shift+wheel',
@@ -56,6 +67,10 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
         self.n_spikes = len(spike_times)
         self.duration = spike_times[-1] * 1.01
         self.n_clusters = 1
+        self.density = RasterDensity(spike_times, spike_clusters, duration=self.duration)
+        # Currently shown level of detail, with the markers or the density in a time range.
+        self._lod = None
+        self._marker_slice = slice(None, None)
 
         assert len(spike_clusters) == self.n_spikes
         self.set_spike_clusters(spike_clusters)
@@ -75,12 +90,21 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
                 vec2 marker_size = point_size * vec2(width, height);
                 marker_size.x = clamp(marker_size.x, 1, 20);
             ''',
+            color_lookup=True,
         )
         self.visual.inserter.insert_vert('''
                 gl_PointSize = a_size * u_zoom.y + 5.0;
         ''', 'end')
         self.canvas.add_visual(self.visual)
+
+        # Spike density shown instead of the markers when zoomed out.
+        self.density_visual = DensityVisual()
+        self.density_visual.hide()
+        self.canvas.add_visual(self.density_visual)
+
         self.canvas.panzoom.set_constrain_bounds((-1, -2, +1, +2))
+        connect(self._on_pan_zoom, event='pan', sender=self.canvas.panzoom)
+        connect(self._on_pan_zoom, event='zoom', sender=self.canvas.panzoom)
 
     # Data-related functions
     # -------------------------------------------------------------------------
@@ -88,12 +112,14 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
     def set_spike_clusters(self, spike_clusters):
         """Set the spike clusters for all spikes."""
         self.spike_clusters = spike_clusters
+        self.density.spike_clusters = spike_clusters
 
     def set_cluster_ids(self, cluster_ids):
         """Set the shown clusters, which can be filtered and in any order (from top to bottom)."""
         if cluster_ids is None or not len(cluster_ids):
             return
         self.all_cluster_ids = cluster_ids
+        self.sorted_cluster_ids = np.sort(cluster_ids)
         self.n_clusters = len(self.all_cluster_ids)
         # Only keep spikes that belong to the selected clusters.
         self.spike_ids = np.isin(self.spike_clusters, self.all_cluster_ids)
@@ -102,29 +128,45 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
     # -------------------------------------------------------------------------
 
     def _get_x(self):
-        """Return the x position of the spikes."""
-        return self.spike_times[self.spike_ids]
+        """Return the x position of the spikes shown as markers."""
+        s = self._marker_slice
+        return self.spike_times[s][self.spike_ids[s]]
 
     def _get_y(self):
         """Return the y position of the spikes, given the relative position of the clusters."""
-        return np.zeros(np.sum(self.spike_ids))
+        s = self._marker_slice
+        return np.zeros(np.sum(self.spike_ids[s]))
 
     def _get_box_index(self):
-        """Return, for every spike, its row in the raster plot. This depends on the ordering
-        in self.cluster_ids."""
-        cl = self.spike_clusters[self.spike_ids]
+        """Return, for every spike shown as a marker, its row in the raster plot. This depends
+        on the ordering in self.cluster_ids."""
+        s = self._marker_slice
+        cl = self.spike_clusters[s][self.spike_ids[s]]
         # Sanity check.
         # assert np.all(np.in1d(cl, self.cluster_ids))
         return _index_of(cl, self.all_cluster_ids)
 
-    def _get_color(self, box_index, selected_clusters=None):
-        """Return, for every spike, its color, based on its box index."""
-        cluster_colors = self.get_cluster_colors(self.all_cluster_ids, alpha=.75)
+    def _get_color_index(self):
+        """Return, for every spike shown as a marker, the index of its cluster in the color
+        table. This does not depend on the ordering in self.cluster_ids, so that it does not
+        change when the clusters are sorted."""
+        s = self._marker_slice
+        cl = self.spike_clusters[s][self.spike_ids[s]]
+        return _index_of(cl, self.sorted_cluster_ids)
+
+    def _get_density_box_index(self):
+        """Return, for every vertex of the density visual, the row of its cluster in the raster
+        plot. The rows of the density are ordered by cluster id."""
+        return np.repeat(_index_of(self.sorted_cluster_ids, self.all_cluster_ids), 6)
+
+    def _get_color(self, selected_clusters=None):
+        """Return the color table, with one color per cluster, ordered by cluster id."""
+        cluster_colors = self.get_cluster_colors(self.sorted_cluster_ids, alpha=.75)
         # Selected cluster colors.
         if selected_clusters is not None:
             cluster_colors = _add_selected_clusters_colors(
-                selected_clusters, self.all_cluster_ids, cluster_colors)
-        return cluster_colors[box_index, :]
+                selected_clusters, self.sorted_cluster_ids, cluster_colors)
+        return cluster_colors
 
     # Main methods
     # -------------------------------------------------------------------------
@@ -133,17 +175,112 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
         """Bounds of the raster plot view."""
         return (0, 0, self.duration, self.n_clusters)
 
+    def _visible_interval(self):
+        """Return the time range currently visible in the view."""
+        x0, _, x1, _ = self.canvas.panzoom.get_range()
+        d = self.duration
+        return max(0., .5 * (x0 + 1) * d), min(d, .5 * (x1 + 1) * d)
+
+    def _get_lod(self):
+        """Return the level of detail to show for the current visible time range: either the
+        markers of all spikes in a time range, or the spike density in a time range with a given
+        number of bins."""
+        if self.n_spikes <= self.max_marker_spikes:
+            return Bunch(markers=True, interval=(0, self.duration))
+        t0, t1 = self._visible_interval()
+        w = t1 - t0
+        # The data is loaded on both sides of the visible range so that panning does not
+        # require reloading the data immediately.
+        interval = (max(0., t0 - w), min(self.duration, t1 + w))
+        # NOTE: this counts the spikes of all clusters, including the hidden ones.
+        i0, i1 = np.searchsorted(self.spike_times, interval)
+        if i1 - i0 <= self.max_marker_spikes:
+            return Bunch(markers=True, interval=interval)
+        # About one bin per pixel.
+        n_bins = min(self.max_density_bins, 3 * max(1, self.canvas.get_size()[0]))
+        return Bunch(
+            markers=False, interval=interval, n_bins=n_bins,
+            bin_duration=(interval[1] - interval[0]) / n_bins)
+
+    def _needs_update(self, lod):
+        """Whether the shown level of detail must be updated after a pan or zoom."""
+        cur = self._lod
+        if cur is None or cur.markers != lod.markers:
+            return True
+        t0, t1 = self._visible_interval()
+        if t0 < cur.interval[0] or t1 > cur.interval[1]:
+            return True
+        return not lod.markers and not (.5 <= lod.bin_duration / cur.bin_duration <= 2)
+
+    def _plot_markers(self, interval):
+        """Show all spikes in a time range as individual markers."""
+        i0 = np.searchsorted(self.spike_times, interval[0], side='left')
+        i1 = np.searchsorted(self.spike_times, interval[1], side='right')
+        self._marker_slice = slice(i0, i1)
+        x = self._get_x()  # spike times for the selected spikes
+        y = self._get_y()  # just 0
+        box_index = self._get_box_index()
+        color_index = self._get_color_index()
+        color = self._get_color(selected_clusters=self.cluster_ids)
+        assert x.shape == y.shape == box_index.shape == color_index.shape
+
+        self.visual.set_data(
+            x=x, y=y, color=color, color_index=color_index, size=self.marker_size,
+            data_bounds=(0, -1, self.duration, 1))
+        self.visual.set_box_index(box_index)
+        self.density_visual.hide()
+        self.visual.show()
+
+    def _plot_density(self, interval, n_bins):
+        """Show the spike density of every cluster in a time range."""
+        b = self.density.get(self.sorted_cluster_ids, interval, n_bins)
+        self.density_visual.set_data(
+            density=_normalize_counts(b.counts), rect=(b.interval[0], -1, b.interval[1], 1),
+            color=self._get_color(selected_clusters=self.cluster_ids),
+            data_bounds=(0, -1, self.duration, 1))
+        self.density_visual.set_box_index(self._get_density_box_index())
+        self.visual.hide()
+        self.density_visual.show()
+
+    def _update_lod(self, force=False):
+        """Update the level of detail if needed, and return whether it has been updated."""
+        lod = self._get_lod()
+        if not force and not self._needs_update(lod):
+            return False
+        logger.log(
+            5, "Show the raster %s between %.1fs and %.1fs.",
+            'markers' if lod.markers else 'density', *lod.interval)
+        self._lod = lod
+        if lod.markers:
+            self._plot_markers(lod.interval)
+        else:
+            self._plot_density(lod.interval, lod.n_bins)
+        return True
+
+    def _on_pan_zoom(self, sender, value):
+        if self._lod is not None and self._update_lod():
+            self.canvas.update()
+
     def update_cluster_sort(self, cluster_ids):
         """Update the order of all clusters."""
         self.all_cluster_ids = cluster_ids
-        self.visual.set_box_index(self._get_box_index())
+        if self._lod is not None and not self._lod.markers:
+            self.density_visual.set_box_index(self._get_density_box_index())
+        else:
+            self.visual.set_box_index(self._get_box_index())
         self.canvas.update()
 
     def update_color(self):
-        """Update the color of the spikes, depending on the selected clusters."""
-        box_index = self._get_box_index()
-        color = self._get_color(box_index, selected_clusters=self.cluster_ids)
-        self.visual.set_color(color)
+        """Update the color of the spikes, depending on the selected clusters.
+
+        Only the color table, with one color per cluster, is updated.
+
+        """
+        color = self._get_color(selected_clusters=self.cluster_ids)
+        if self._lod is not None and not self._lod.markers:
+            self.density_visual.set_color(color)
+        else:
+            self.visual.set_color_table(color)
         self.canvas.update()
 
     @property
@@ -154,18 +291,8 @@ class RasterView(MarkerSizeMixin, BaseColorView, BaseGlobalView, ManualClusterin
         """Make the raster plot."""
         if not len(self.spike_clusters):
             return
-        x = self._get_x()  # spike times for the selected spikes
-        y = self._get_y()  # just 0
-        box_index = self._get_box_index()
-        color = self._get_color(box_index)
-        assert x.shape == y.shape == box_index.shape
-        assert color.shape[0] == len(box_index)
         self.data_bounds = self._get_data_bounds()
-
-        self.visual.set_data(
-            x=x, y=y, color=color, size=self.marker_size,
-            data_bounds=(0, -1, self.duration, 1))
-        self.visual.set_box_index(box_index)
+        self._update_lod(force=True)
         self.canvas.stacked.n_boxes = self.n_clusters
         self._update_axes()
         # self.canvas.stacked.add_boxes(self.canvas)
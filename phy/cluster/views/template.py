@@ -83,7 +83,9 @@ class TemplateView(ScalingMixin, BaseColorView, BaseGlobalView, ManualClustering
         self.canvas.enable_axes()
         self.templates = templates
 
-        self.visual = PlotVisual()
+        # The colors of the templates are looked up in a color table with one color per
+        # cluster, so that changing the colors does not require updating all vertices.
+        self.visual = PlotVisual(color_lookup=True)
         self.canvas.add_visual(self.visual)
         self._cluster_box_index = {}  # dict {cluster_id: box_index} used to quickly reorder
 
@@ -113,7 +115,7 @@ class TemplateView(ScalingMixin, BaseColorView, BaseGlobalView, ManualClustering
         assert box_index.size == bunch.template.size * 2
         return box_index
 
-    def _plot_cluster(self, bunch, color=None):
+    def _plot_cluster(self, bunch):
         """Plot one cluster."""
         wave = bunch.template  # shape: (n_samples, n_channels)
         channel_ids_loc = bunch.channel_ids
@@ -125,13 +127,20 @@ class TemplateView(ScalingMixin, BaseColorView, BaseGlobalView, ManualClustering
         # Find the x coordinates.
         t = get_linear_x(n_channels_loc, n_samples)
 
-        color = color or self.cluster_colors[bunch.cluster_rel]
-        assert len(color) == 4
-
         box_index = self._get_box_index(bunch)
 
+        # The color table is ordered by cluster id.
         return Bunch(
-            x=t, y=wave.T, color=color, box_index=box_index, data_bounds=self.data_bounds)
+            x=t, y=wave.T, color_index=bunch.cluster_rel, box_index=box_index,
+            data_bounds=self.data_bounds)
+
+    def _get_color_table(self, selected_clusters=None):
+        """Return the color table, with one color per cluster, ordered by cluster id."""
+        cluster_colors = self.cluster_colors
+        if selected_clusters is not None:
+            cluster_colors = _add_selected_clusters_colors(
+                selected_clusters, self.sorted_cluster_ids, cluster_colors)
+        return cluster_colors
 
     def set_cluster_ids(self, cluster_ids):
         """Update the cluster ids when their identity or order has changed."""
@@ -188,17 +197,8 @@ class TemplateView(ScalingMixin, BaseColorView, BaseGlobalView, ManualClustering
             return self.plot()
         # The call to set_cluster_ids() update the cluster_colors array.
         self.set_cluster_ids(self.all_cluster_ids)
-        # Selected cluster colors.
-        cluster_colors = self.cluster_colors
-        selected_clusters = self.cluster_ids
-        if selected_clusters is not None:
-            cluster_colors = _add_selected_clusters_colors(
-                selected_clusters, self.sorted_cluster_ids, cluster_colors)
-        # Number of vertices per cluster = number of vertices per signal
-        n_vertices_clu = [
-            len(self._cluster_box_index[cluster_id]) for cluster_id in self.sorted_cluster_ids]
-        # The argument passed to set_color() must have 1 row per vertex.
-        self.visual.set_color(np.repeat(cluster_colors, n_vertices_clu, axis=0))
+        # Only the color table, with one color per cluster, is updated.
+        self.visual.set_color_table(self._get_color_table(self.cluster_ids))
         self.canvas.update()
 
     @property
@@ -223,6 +223,7 @@ class TemplateView(ScalingMixin, BaseColorView, BaseGlobalView, ManualClustering
             self._cluster_box_index[bunch.cluster_id] = data.box_index
             self.visual.add_batch_data(**data)
         self.canvas.update_visual(self.visual)
+        self.visual.set_color_table(self._get_color_table())
         self._apply_scaling()
         self.canvas.axes.reset_data_bounds((0, 0, n_clusters, self.n_channels))
         self.canvas.update()
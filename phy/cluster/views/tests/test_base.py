@@ -6,9 +6,13 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from timeit import default_timer
+import time
+
 import numpy as np
 
-from phylib.utils import emit
+from phylib.utils import emit, connect
+from phy.gui.qt import QTimer
 from phy.utils.color import selected_cluster_color, colormaps
 from ..base import BaseColorView, ManualClusteringView
 from . import _stop_and_close
@@ -70,3 +74,98 @@ def test_manual_clustering_view_2(qtbot, gui):
     v.canvas.close()
     v.actions.close()
     qtbot.wait(100)
+
+
+class MySlowView(MyView):
+    def on_select(self, cluster_ids=None, **kwargs):
+        # Simulate data loading.
+        time.sleep(.01)
+        self.n_computed += 1
+        super(MySlowView, self).on_select(cluster_ids=cluster_ids, **kwargs)
+
+
+def test_manual_clustering_view_threaded(qtbot, gui):
+    v = MySlowView()
+    v.n_computed = 0
+    v.canvas.show()
+    v.attach(gui)
+
+    class Supervisor(object):
+        select_generation = 0
+
+    coalesced = []
+
+    @connect(sender=v)
+    def on_select_coalesced(sender, generation):
+        coalesced.append(generation)
+
+    # Measure the maximum time the GUI thread is blocked, with a timer that should tick
+    # every millisecond.
+    ticks = [default_timer()]
+    timer = QTimer()
+    timer.timeout.connect(lambda: ticks.append(default_timer()))
+    timer.start(1)
+
+    # Select 100 clusters in a row.
+    durations = []
+    for cluster_id in range(100):
+        t0 = default_timer()
+        Supervisor.select_generation += 1
+        emit('select', Supervisor(), cluster_ids=[cluster_id])
+        durations.append(default_timer() - t0)
+        qtbot.wait(1)
+    qtbot.waitUntil(lambda: v._lock is None and v.cluster_ids == [99])
+    timer.stop()
+
+    # The selections are processed in the background, and the stale ones are dropped.
+    frame_budget = 1. / 30
+    assert max(durations) < frame_budget
+    assert np.diff(ticks).max() < frame_budget
+    assert v.n_computed < 100
+    # The intermediate selections have been coalesced, but not the last one.
+    assert coalesced
+    assert 100 not in coalesced
+    assert len(set(coalesced)) + v.n_computed >= 100
+
+    v.canvas.close()
+    v.actions.close()
+    qtbot.wait(100)
+
+
+def test_manual_clustering_view_hidden(qtbot, gui):
+    v0, v1 = MySlowView(), MySlowView()
+    for v in (v0, v1):
+        v.n_computed = 0
+        v.attach(gui)
+    # The first view is hidden in a dock tab behind the second view.
+    gui.tabifyDockWidget(v0.dock, v1.dock)
+    v1.dock.raise_()
+    qtbot.waitUntil(lambda: v0._hidden)
+
+    deferred = []
+
+    @connect(sender=v0)
+    def on_select_deferred(sender, cluster_ids):
+        deferred.append(cluster_ids)
+
+    class Supervisor(object):
+        select_generation = 0
+
+    for cluster_id in range(3):
+        Supervisor.select_generation += 1
+        emit('select', Supervisor(), cluster_ids=[cluster_id])
+    qtbot.waitUntil(lambda: v1._lock is None and v1.cluster_ids == [2])
+
+    # The hidden view has not computed anything.
+    assert v0.n_computed == 0
+    assert deferred == [[0], [1], [2]]
+
+    # The latest selection is shown once the view is visible.
+    v0.dock.raise_()
+    qtbot.waitUntil(lambda: v0._lock is None and v0.cluster_ids == [2])
+    assert v0.n_computed == 1
+
+    for v in (v0, v1):
+        v.canvas.close()
+        v.actions.close()
+    qtbot.wait(100)
@@ -106,3 +106,37 @@ def test_raster_1(qtbot, gui):
     v.plot()
 
     _stop_and_close(qtbot, v)
+
+
+def test_raster_density(qtbot, gui):
+    ns = 10000
+    nc = 100
+    spike_times = artificial_spike_samples(ns) / 20000.
+    spike_clusters = artificial_spike_clusters(ns, nc)
+
+    v = RasterView(spike_times, spike_clusters)
+    v.max_marker_spikes = 1000
+    v.show()
+    qtbot.waitForWindowShown(v.canvas)
+    v.attach(gui)
+
+    # Zoomed out: the spike density is shown.
+    v.set_cluster_ids(np.arange(nc))
+    v.plot()
+    assert not v._lod.markers
+    assert v.visual._hidden
+    assert v.density_visual.n_vertices == 6 * nc
+
+    v.on_select(cluster_ids=[0])
+    v.update_cluster_sort(np.arange(nc)[::-1])
+
+    # Zoomed in: the markers of the visible time range are shown.
+    v.zoom_to_time_range((1., 1.2))
+    assert v._lod.markers
+    assert v.density_visual._hidden
+    assert 0 < v.visual.n_vertices <= v.max_marker_spikes
+
+    v.canvas.panzoom.reset()
+    assert not v._lod.markers
+
+    _stop_and_close(qtbot, v)
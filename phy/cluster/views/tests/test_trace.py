@@ -8,13 +8,16 @@
 
 import numpy as np
 from numpy.testing import assert_allclose as ac
+from numpy.testing import assert_array_equal as ae
 
 from phylib.io.mock import artificial_traces, artificial_spike_clusters
 from phylib.utils import Bunch, connect
 from phylib.utils.geometry import linear_positions
 from phy.plot.tests import mouse_click
 
-from ..trace import TraceView, TraceImageView, select_traces, _iter_spike_waveforms
+from ..trace import (
+    TraceView, TraceImageView, select_traces, _iter_spike_waveforms, _get_spike_waveforms,
+    _concat_spike_waveforms)
 from . import _stop_and_close
 
 
@@ -47,6 +50,52 @@ def test_iter_spike_waveforms():
         assert w
 
 
+def test_get_spike_waveforms():
+    nc = 5
+    ns = 20
+    sr = 2000.
+    ch = [3, 1]
+    duration = 1.
+    st = np.linspace(0.1, .9, ns)
+    sc = artificial_spike_clusters(ns, nc)
+    traces = 10 * artificial_traces(int(round(duration * sr)), nc)
+
+    m = Bunch(spike_times=st, spike_clusters=sc, sample_rate=sr)
+    s = Bunch(cluster_meta={}, selected=[0])
+    kwargs = dict(
+        interval=[0., 1.],
+        traces_interval=traces,
+        model=m,
+        supervisor=s,
+        n_samples_waveforms=ns,
+        get_best_channels=lambda cluster_id: (ch, np.ones(len(ch))),
+    )
+
+    # One row per spike and best channel.
+    w = _get_spike_waveforms(show_all_spikes=True, **kwargs)
+    assert w.data.shape == (2 * ns, ns)
+    ae(w.channel_id, np.tile(ch, ns))
+    # Non-selected spikes first.
+    assert np.all(np.diff(w.select_index) >= 0)
+    ae(w.spike_cluster[w.select_index == 0], 0)
+    i = w.spike_id[0]
+    s0 = int(round(w.start_time[0] * sr))
+    ae(w.data[0], traces[s0:s0 + ns, ch[0]])
+    ae(w.data[1], traces[s0:s0 + ns, ch[1]])
+
+    # Consistency with the per-spike waveforms.
+    waveforms = list(_iter_spike_waveforms(show_all_spikes=True, **kwargs))
+    assert [wave.spike_id for wave in waveforms][0] == i
+    w_ = _concat_spike_waveforms(waveforms)
+    for key in ('data', 'spike_id', 'spike_cluster', 'channel_id', 'select_index'):
+        ae(w_[key], w[key])
+
+    # Only the spikes of the selected clusters.
+    w = _get_spike_waveforms(show_all_spikes=False, **kwargs)
+    ae(w.spike_cluster, 0)
+    ae(w.select_index, 0)
+
+
 def test_trace_view_1(qtbot, tempdir, gui):
     nc = 5
     ns = 20
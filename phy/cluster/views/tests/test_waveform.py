@@ -107,3 +107,44 @@ def test_waveform_view(qtbot, tempdir, gui):
     v.set_state(v.state)
 
     _stop_and_close(qtbot, v)
+
+
+def test_waveform_view_overlap(qtbot, gui):
+    nc = 5
+    ns = 10
+    w = 10 + 100 * artificial_waveforms(ns, 20, nc)
+
+    def get_waveforms(cluster_id):
+        return Bunch(
+            data=w,
+            channel_ids=np.arange(nc) + cluster_id,
+            channel_positions=staggered_positions(nc + 3)[cluster_id:cluster_id + nc])
+
+    v = WaveformView(waveforms=get_waveforms, sample_rate=10000.)
+    v.show()
+    qtbot.waitForWindowShown(v.canvas)
+    v.attach(gui)
+    v.cluster_ids = [0, 2, 3]
+    v.plot()
+
+    program = v.waveform_visual.program
+    assert program['u_n_clu'] == 3
+    ac(np.asarray(program['u_clu_offsets'])[0, :3, 0], [0, 1, 2])
+    pos = program._attributes['a_position']._buffer
+    pos._pending_data = None
+    pos._spans = []
+
+    # The overlap is changed on the GPU, without uploading the waveforms again.
+    v.toggle_waveform_overlap(True)
+    assert program['u_overlap'] == 1
+    assert not pos.pending_spans
+    v.toggle_waveform_overlap(False)
+    assert program['u_overlap'] == 0
+    assert not pos.pending_spans
+
+    # Box and probe scaling only change uniforms too.
+    v.widen()
+    v.extend_vertically()
+    assert not pos.pending_spans
+
+    _stop_and_close(qtbot, v)
@@ -35,10 +35,21 @@ def select_traces(traces, interval, sample_rate=None):
     return traces
 
 
-def _iter_spike_waveforms(
+def _get_spike_waveforms(
         interval=None, traces_interval=None, model=None, supervisor=None,
         n_samples_waveforms=None, get_best_channels=None, show_all_spikes=False):
-    """Iterate through the spike waveforms belonging in the current trace view."""
+    """Extract at once all spike waveforms belonging in the current trace view.
+
+    Return a Bunch with one row per displayed spike and best channel, with the following
+    attributes, non-selected spikes first, then selected spikes:
+
+    * `data`: an `(n_signals, n_samples)` array with the waveforms
+    * `spike_id`, `spike_time`, `spike_cluster`, `start_time`: spike information
+    * `channel_id`, `channel_amp`: the channel and its relative amplitude
+    * `select_index`: the index of the cluster in the selection, or -1 for non-selected
+      clusters
+
+    """
     m = model
     p = supervisor
     sr = m.sample_rate
@@ -46,36 +57,121 @@ def _iter_spike_waveforms(
     s0, s1 = int(round(interval[0] * sr)), int(round(interval[1] * sr))
     ns = n_samples_waveforms
     k = ns // 2
-    for show_selected in (False, True):
-        for i in range(a, b):
-            t = m.spike_times[i]
-            c = m.spike_clusters[i]
-            is_selected = c in p.selected
-            # Show non selected spikes first, then selected spikes so that they appear on top.
-            if is_selected is not show_selected:
-                continue
-            # Skip non-selected spikes if requested.
-            if (not show_all_spikes and c not in supervisor.selected):
-                continue
-            # cg = p.cluster_meta.get('group', c)
-            channel_ids, channel_amps = get_best_channels(c)
-            s = int(round(t * sr)) - s0
-            # Skip partial spikes.
-            if s - k < 0 or s + k >= (s1 - s0):  # pragma: no cover
-                continue
-            # Extract the waveform.
-            wave = Bunch(
-                data=traces_interval[s - k:s + ns - k, channel_ids],
-                channel_ids=channel_ids,
-                start_time=(s + s0 - k) / sr,
-                spike_id=i,
-                spike_time=t,
-                spike_cluster=c,
-                channel_amps=channel_amps,  # for each of the channel_ids, the relative amp
-                select_index=p.selected.index(c) if c in p.selected else None,
-            )
-            assert wave.data.shape == (ns, len(channel_ids))
-            yield wave
+    selected = list(p.selected)
+
+    spike_ids = np.arange(a, b)
+    spike_times = np.asarray(m.spike_times[a:b])
+    spike_clusters = np.asarray(m.spike_clusters[a:b])
+    is_selected = np.isin(spike_clusters, selected)
+    s = np.round(spike_times * sr).astype(np.int64) - s0
+    # Skip partial spikes, and non-selected spikes if requested.
+    keep = (s - k >= 0) & (s + k < s1 - s0)
+    if not show_all_spikes:
+        keep &= is_selected
+    # Show non selected spikes first, then selected spikes so that they appear on top.
+    order = np.nonzero(keep)[0]
+    order = order[np.argsort(is_selected[order], kind='stable')]
+    spike_ids, spike_times, spike_clusters, s = (
+        spike_ids[order], spike_times[order], spike_clusters[order], s[order])
+
+    # Group the spikes by cluster, as the best channels depend on the cluster only.
+    cluster_ids, inverse = np.unique(spike_clusters, return_inverse=True)
+    perm = np.argsort(inverse, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(inverse, minlength=len(cluster_ids)))]
+    rows, channels, amps, data = [], [], [], []
+    for i, c in enumerate(cluster_ids):
+        idx = perm[bounds[i]:bounds[i + 1]]
+        channel_ids, channel_amps = get_best_channels(c)
+        channel_ids = np.asarray(channel_ids, dtype=np.int64)
+        nc = len(channel_ids)
+        # Extract the waveforms of all spikes of the cluster with fancy indexing:
+        # (n_spikes, n_samples, n_channels) => (n_spikes * n_channels, n_samples)
+        samples = (s[idx] - k)[:, np.newaxis] + np.arange(ns)
+        waves = traces_interval[samples[..., np.newaxis], channel_ids]
+        assert waves.shape == (len(idx), ns, nc)
+        data.append(np.transpose(waves, (0, 2, 1)).reshape((-1, ns)))
+        rows.append(np.repeat(idx, nc))
+        channels.append(np.tile(channel_ids, len(idx)))
+        amps.append(np.tile(np.asarray(channel_amps, dtype=np.float64), len(idx)))
+
+    if rows:
+        rows, channels, amps, data = (
+            np.concatenate(rows), np.concatenate(channels),
+            np.concatenate(amps), np.concatenate(data))
+        # Restore the spike order, keeping the channels of every spike in order.
+        signal_order = np.argsort(rows, kind='stable')
+        rows, channels, amps, data = (
+            rows[signal_order], channels[signal_order], amps[signal_order], data[signal_order])
+    else:
+        rows = np.zeros(0, dtype=np.int64)
+        channels, amps = rows, np.zeros(0)
+        data = np.zeros((0, ns), dtype=traces_interval.dtype)
+
+    spike_clusters = spike_clusters[rows]
+    select_index = -np.ones(len(rows), dtype=np.int64)
+    for i, c in enumerate(selected):
+        select_index[spike_clusters == c] = i
+    return Bunch(
+        data=data,
+        spike_id=spike_ids[rows],
+        spike_time=spike_times[rows],
+        spike_cluster=spike_clusters,
+        start_time=(s[rows] + s0 - k) / sr,
+        channel_id=channels,
+        channel_amp=amps,  # for each of the channel_ids, the relative amp
+        select_index=select_index,
+    )
+
+
+def _iter_spike_waveforms(**kwargs):
+    """Iterate through the spike waveforms belonging in the current trace view.
+
+    Same parameters as `_get_spike_waveforms()`, but yield one Bunch per spike.
+
+    """
+    w = _get_spike_waveforms(**kwargs)
+    # Split the signals into spikes.
+    splits = np.nonzero(np.diff(w.spike_id))[0] + 1
+    for idx in np.split(np.arange(len(w.spike_id)), splits):
+        if not len(idx):
+            continue
+        i = idx[0]
+        select_index = int(w.select_index[i])
+        yield Bunch(
+            data=w.data[idx].T,
+            channel_ids=w.channel_id[idx],
+            start_time=w.start_time[i],
+            spike_id=w.spike_id[i],
+            spike_time=w.spike_time[i],
+            spike_cluster=w.spike_cluster[i],
+            channel_amps=w.channel_amp[idx],
+            select_index=select_index if select_index >= 0 else None,
+        )
+
+
+def _concat_spike_waveforms(waveforms):
+    """Convert a list of per-spike waveform Bunch instances, as yielded by
+    `_iter_spike_waveforms()`, into a single Bunch as returned by `_get_spike_waveforms()`."""
+    if not waveforms:
+        return Bunch(
+            data=np.zeros((0, 0)), spike_id=np.zeros(0, dtype=np.int64),
+            spike_cluster=np.zeros(0, dtype=np.int64), start_time=np.zeros(0),
+            channel_id=np.zeros(0, dtype=np.int64), select_index=np.zeros(0, dtype=np.int64))
+    nc = [len(w.channel_ids) for w in waveforms]
+
+    def _rep(name, default=None):
+        return np.repeat([
+            w.get(name, default) if w.get(name, default) is not None else -1
+            for w in waveforms], nc)
+
+    return Bunch(
+        data=np.concatenate([np.asarray(w.data).T for w in waveforms]),
+        spike_id=_rep('spike_id'),
+        spike_cluster=_rep('spike_cluster'),
+        start_time=_rep('start_time'),
+        channel_id=np.concatenate([w.channel_ids for w in waveforms]).astype(np.int64),
+        select_index=_rep('select_index'),
+    )
 
 
 class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
@@ -87,7 +183,10 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
     traces : function
         Maps a time interval `(t0, t1)` to a `Bunch(data, color, waveforms)` where
         * `data` is an `(n_samples, n_channels)` array
-        * `waveforms` is a list of bunchs with the following attributes:
+        * `times` is an optional `(n_samples,)` array with the times of the rows of `data`,
+          used when the traces are decimated (for example, a min/max envelope)
+        * `waveforms` is either a Bunch with all spike waveforms, as returned by
+          `_get_spike_waveforms()`, or a list of bunchs with the following attributes:
             * `data`
             * `color`
             * `channel_ids`
@@ -196,7 +295,8 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
         self._interval = None
         self.go_to(duration / 2.)
 
-        self._waveform_times = []
+        # Displayed spike waveforms, used for spike click.
+        self._spike_waveforms = None
         self.canvas.panzoom.set_constrain_bounds((-1, -2, +1, +2))
 
     def _create_visuals(self):
@@ -230,14 +330,14 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
     # Internal methods
     # -------------------------------------------------------------------------
 
-    def _plot_traces(self, traces, color=None):
+    def _plot_traces(self, traces, color=None, times=None):
         traces = traces.T
         n_samples = traces.shape[1]
         n_ch = self.n_channels
         assert traces.shape == (n_ch, n_samples)
         color = color or self.default_trace_color
 
-        t = self._interval[0] + np.arange(n_samples) * self.dt
+        t = self._interval[0] + np.arange(n_samples) * self.dt if times is None else times
         t = np.tile(t, (n_ch, 1))
 
         box_index = self.channel_y_ranks
@@ -255,53 +355,52 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
             box_index=box_index.ravel(),
         )
 
-    def _plot_spike(self, bunch):
-        # The spike time corresponds to the first sample of the waveform.
-        n_samples, n_channels = bunch.data.shape
-        assert len(bunch.channel_ids) == n_channels
+    def _plot_waveforms(self, waveforms, **kwargs):
+        """Plot the waveforms, in a single batch."""
+        if isinstance(waveforms, list):
+            waveforms = _concat_spike_waveforms(waveforms)
+        n_signals = len(waveforms.spike_id)
+        self._spike_waveforms = waveforms
+        if not n_signals:  # pragma: no cover
+            self.waveform_visual.hide()
+            return
+        self.waveform_visual.show()
+        n_samples = waveforms.data.shape[1]
 
-        # Generate the x coordinates of the waveform.
-        t = bunch.start_time + self.dt * np.arange(n_samples)
-        t = np.tile(t, (n_channels, 1))  # (n_unmasked_channels, n_samples)
+        # Generate the x coordinates of the waveforms. The spike time corresponds to the first
+        # sample of the waveform.
+        t = waveforms.start_time[:, np.newaxis] + self.dt * np.arange(n_samples)
+        assert t.shape == (n_signals, n_samples)
 
-        # Determine the spike color.
-        i = bunch.select_index
-        c = bunch.spike_cluster
+        # Determine the spike colors, cluster by cluster.
         cs = self.color_schemes.get()
-        color = selected_cluster_color(i, alpha=1) if i is not None else cs.get(c, alpha=1)
+        color = np.zeros((n_signals, 4))
+        select_index = waveforms.select_index
+        for i in np.unique(select_index[select_index >= 0]):
+            color[select_index == i] = selected_cluster_color(int(i), alpha=1)
+        not_selected = select_index < 0
+        if np.any(not_selected):
+            clusters = waveforms.spike_cluster[not_selected]
+            cluster_ids, inverse = np.unique(clusters, return_inverse=True)
+            colors = np.array([cs.get(c, alpha=1) for c in cluster_ids])
+            color[not_selected] = colors[inverse]
 
         # We could tweak the color of each spike waveform depending on the template amplitude
-        # on each of its best channels.
-        # channel_amps = bunch.get('channel_amps', None)
-        # if channel_amps is not None:
-        #     color = np.tile(color, (n_channels, 1))
-        #     assert color.shape == (n_channels, 4)
-        #     color[:, 3] = channel_amps
+        # on each of its best channels, with `waveforms.channel_amp`.
 
         # The box index depends on the channel.
-        box_index = self.channel_y_ranks[bunch.channel_ids]
-        box_index = np.repeat(box_index[:, np.newaxis], n_samples, axis=0)
-        self.waveform_visual.add_batch_data(
-            box_index=box_index,
-            x=t, y=bunch.data.T, color=color,
+        box_index = np.repeat(self.channel_y_ranks[waveforms.channel_id], n_samples)
+
+        # NOTE: the waveforms are uploaded as a single 2D array, without going through the
+        # batch accumulator.
+        self.waveform_visual.reset_batch()
+        self.canvas.update_visual(
+            self.waveform_visual,
+            x=t, y=waveforms.data, color=color,
             data_bounds=self.data_bounds,
+            box_index=box_index,
         )
 
-    def _plot_waveforms(self, waveforms, **kwargs):
-        """Plot the waveforms."""
-        # waveforms = self.waveforms
-        assert isinstance(waveforms, list)
-        if waveforms:
-            self.waveform_visual.show()
-            self.waveform_visual.reset_batch()
-            for w in waveforms:
-                self._plot_spike(w)
-                self._waveform_times.append(
-                    (w.start_time, w.spike_id, w.spike_cluster, w.get('channel_ids', None)))
-            self.canvas.update_visual(self.waveform_visual)
-        else:  # pragma: no cover
-            self.waveform_visual.hide()
-
     def _plot_labels(self, traces):
         self.text_visual.reset_batch()
         for ch in range(self.n_channels):
@@ -355,11 +454,11 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
             self.data_bounds = (start, ymin, end, ymax)
 
             # Used for spike click.
-            self._waveform_times = []
+            self._spike_waveforms = None
 
             # Plot the traces.
             self._plot_traces(
-                traces.data, color=traces.get('color', None))
+                traces.data, color=traces.get('color', None), times=traces.get('times', None))
 
             # Plot the labels.
             if self.do_show_labels:
@@ -607,19 +706,21 @@ class TraceView(ScalingMixin, BaseColorView, ManualClusteringView):
             channel_id = np.nonzero(self.channel_y_ranks == box_id)[0]
             # Find the spike and cluster closest to the mouse.
             db = self.data_bounds
-            # Get the information about the displayed spikes.
-            wt = [(t, s, c, ch) for t, s, c, ch in self._waveform_times if channel_id in ch]
-            if not wt:
+            # Get the information about the displayed spikes on that channel.
+            wt = self._spike_waveforms
+            if wt is None:
+                return
+            on_channel = np.isin(wt.channel_id, channel_id)
+            if not np.any(on_channel):
                 return
             # Get the time coordinate of the mouse position.
             mouse_pos = self.canvas.panzoom.window_to_ndc(e.pos)
             mouse_time = Range(NDC, db).apply(mouse_pos)[0][0]
             # Get the closest spike id.
-            times, spike_ids, spike_clusters, channel_ids = zip(*wt)
-            i = np.argmin(np.abs(np.array(times) - mouse_time))
+            i = np.argmin(np.abs(wt.start_time[on_channel] - mouse_time))
             # Raise the select_spike event.
-            spike_id = spike_ids[i]
-            cluster_id = spike_clusters[i]
+            spike_id = wt.spike_id[on_channel][i]
+            cluster_id = wt.spike_cluster[on_channel][i]
             emit('select_spike', self, channel_id=channel_id,
                  spike_id=spike_id, cluster_id=cluster_id)
 
@@ -703,7 +804,7 @@ class TraceImageView(TraceView):
     # Internal methods
     # -------------------------------------------------------------------------
 
-    def _plot_traces(self, traces, color=None):
+    def _plot_traces(self, traces, color=None, times=None):
         traces = traces.T
         n_samples = traces.shape[1]
         n_ch = self.n_channels
@@ -13,9 +13,10 @@ import logging
 import numpy as np
 
 from phylib.io.array import _flatten, _index_of
-from phylib.utils import emit
+from phylib.utils import Bunch, emit
 from phy.utils.color import selected_cluster_color
 from phy.plot import get_linear_x
+from phy.plot.gloo import TextureFloat2D
 from phy.plot.visuals import (  # noqa
     PlotVisual, PlotAggVisual, UniformScatterVisual, TextVisual, LineVisual, _min, _max)
 from phy.cluster._utils import RotatingProperty
@@ -61,6 +62,32 @@ def _overlap_transform(t, offset=0, n=1, overlap=None):
     return t
 
 
+# GPU version of _overlap_transform(), applied to the waveforms in the vertex shader. The
+# cluster index is the integer part of the masks, and the offset of every cluster is stored
+# in a texture.
+_OVERLAP_HEADER = """
+uniform float u_overlap;
+uniform float u_n_clu;
+uniform sampler2D u_clu_offsets;
+uniform float n_clu_offsets;
+"""
+
+_OVERLAP_GLSL = """
+if (u_overlap < .5) {
+    float clu_offset = fetch_texture(floor(a_mask), u_clu_offsets, n_clu_offsets).x;
+    float k = 8.;
+    {{varout}}.x = -1. + (2. * clu_offset * (k + 1.) + ({{varout}}.x + 1.) * k) /
+        (u_n_clu * (k + 1.) - 1.);
+}
+"""
+
+
+def _add_overlap_transform(visual):
+    """Shift the waveforms of the different clusters on the GPU when they do not overlap."""
+    visual.inserter.insert_vert(_OVERLAP_HEADER, 'header')
+    visual.inserter.insert_vert(_OVERLAP_GLSL, 'before_transforms')
+
+
 class WaveformView(ScalingMixin, ManualClusteringView):
     """This view shows the waveforms of the selected clusters, on relevant channels,
     following the probe geometry.
@@ -124,6 +151,7 @@ class WaveformView(ScalingMixin, ManualClusteringView):
         self.filtered_tags = ()
         self.wave_duration = 0.  # updated in the plotting method
         self.data_bounds = None
+        self._axes_bunchs = ()  # used to plot the axes again when the overlap changes
         self.sample_rate = sample_rate
         self._status_suffix = ''
         assert sample_rate > 0., "The sample rate must be provided to the waveform view."
@@ -161,8 +189,12 @@ class WaveformView(ScalingMixin, ManualClusteringView):
 
         # Two types of visuals: thin raw line visual for normal waveforms, thick antialiased
         # agg plot visual for mean and template waveforms.
+        # The overlap is applied on the GPU, so that toggling it does not require to upload
+        # the waveforms again.
         self.waveform_agg_visual = PlotAggVisual()
         self.waveform_visual = PlotVisual()
+        _add_overlap_transform(self.waveform_agg_visual)
+        _add_overlap_transform(self.waveform_visual)
         self.canvas.add_visual(self.waveform_agg_visual)
         self.canvas.add_visual(self.waveform_visual)
 
@@ -214,9 +246,8 @@ class WaveformView(ScalingMixin, ManualClusteringView):
         assert wave.shape[2] == n_channels
         assert masks.shape == (n_spikes_clu, n_channels)
 
-        # Find the x coordinates.
+        # Find the x coordinates. The overlap transform is applied on the GPU.
         t = get_linear_x(n_spikes_clu * n_channels, n_samples)
-        t = _overlap_transform(t, offset=bunch.offset, n=bunch.n_clu, overlap=self.overlap)
         # HACK: on the GPU, we get the actual masks with fract(masks)
         # since we add the relative cluster index. We need to ensure
         # that the masks is never 1.0, otherwise it is interpreted as
@@ -251,8 +282,11 @@ class WaveformView(ScalingMixin, ManualClusteringView):
             x=t, y=wave, color=bunch.color, masks=masks, box_index=box_index,
             data_bounds=self.data_bounds)
 
-        # Waveform axes.
-        # --------------
+    def _plot_axes(self, bunch):
+        """Plot the axes of the waveforms of a cluster, which depend on the overlap."""
+        channel_ids_loc = bunch.channel_ids
+        n_spikes_clu = bunch.n_spikes
+        nw = n_spikes_clu * len(channel_ids_loc)
 
         # Horizontal y=0 lines.
         ax_db = self.data_bounds
@@ -289,6 +323,30 @@ class WaveformView(ScalingMixin, ManualClusteringView):
             box_index=box_index,
         )
 
+    def _plot_all_axes(self):
+        """Plot the axes of the waveforms of all clusters."""
+        self.line_visual.reset_batch()
+        self.tick_visual.reset_batch()
+        for bunch in self._axes_bunchs:
+            self._plot_axes(bunch)
+        self.canvas.update_visual(self.tick_visual)
+        self.canvas.update_visual(self.line_visual)
+
+    def _update_overlap(self, offsets=None, n_clu=None):
+        """Update the uniforms of the overlap transform applied on the GPU."""
+        for visual in (self.waveform_visual, self.waveform_agg_visual):
+            visual.program['u_overlap'] = float(self.overlap)
+            if offsets is None:
+                continue
+            # NOTE: fetch_texture() requires at least two rows in the texture.
+            offsets = np.asarray(offsets, dtype=np.float32)
+            n = max(2, len(offsets))
+            texture = np.zeros((1, n, 4), dtype=np.float32)
+            texture[0, :len(offsets), 0] = offsets
+            visual.program['u_clu_offsets'] = texture.view(TextureFloat2D)
+            visual.program['n_clu_offsets'] = n
+            visual.program['u_n_clu'] = n_clu
+
     def _plot_labels(self, channel_ids, n_clusters, channel_labels):
         # Add channel labels.
         if not self.do_show_labels:
@@ -334,13 +392,18 @@ class WaveformView(ScalingMixin, ManualClusteringView):
         self.data_bounds = self.data_bounds or self._get_data_bounds(bunchs)
 
         self._current_visual.reset_batch()
-        self.line_visual.reset_batch()
-        self.tick_visual.reset_batch()
         for bunch in bunchs:
             self._plot_cluster(bunch)
-        self.canvas.update_visual(self.tick_visual)
-        self.canvas.update_visual(self.line_visual)
         self.canvas.update_visual(self._current_visual)
+        self._update_overlap([b.offset for b in bunchs], bunchs[0].n_clu)
+
+        # Waveform axes.
+        self._axes_bunchs = [
+            Bunch(
+                channel_ids=b.channel_ids, offset=b.offset, n_clu=b.n_clu,
+                n_spikes=b.data.shape[0])
+            for b in bunchs if b.data is not None and b.data.size]
+        self._plot_all_axes()
 
         self._plot_labels(channel_ids, len(self.cluster_ids), channel_labels)
 
@@ -400,7 +463,11 @@ class WaveformView(ScalingMixin, ManualClusteringView):
     @overlap.setter
     def overlap(self, value):
         self._overlap = value
-        self.plot()
+        # The waveforms are shifted on the GPU: only the axes are plotted again.
+        self._update_overlap()
+        if self._axes_bunchs:
+            self._plot_all_axes()
+            self.canvas.update()
 
     def toggle_waveform_overlap(self, checked):
         """Toggle the overlap of the waveforms."""
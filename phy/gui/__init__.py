@@ -10,3 +10,4 @@ from .qt import (
 from .gui import GUI, GUIState, DockWidget
 from .actions import Actions, Snippets
 from .widgets import HTMLWidget, HTMLBuilder, Table, IPythonView, KeyValueWidget
+from .table import NativeTable
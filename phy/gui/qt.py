@@ -35,10 +35,11 @@ from PyQt5.QtCore import (Qt, QByteArray, QMetaObject, QObject,  # noqa
                           QThreadPool, QRunnable,
                           pyqtSignal, pyqtSlot, QSize, QUrl,
                           QEvent, QCoreApplication,
+                          QAbstractTableModel, QModelIndex,
                           qInstallMessageHandler,
                           )
 from PyQt5.QtGui import (  # noqa
-    QKeySequence, QIcon, QColor, QMouseEvent, QGuiApplication,
+    QKeySequence, QIcon, QColor, QBrush, QMouseEvent, QGuiApplication,
     QFontDatabase, QWindow, QOpenGLWindow)
 from PyQt5.QtWebEngineWidgets import (QWebEngineView,  # noqa
                                       QWebEnginePage,
@@ -51,7 +52,8 @@ from PyQt5.QtWidgets import (# noqa
     QPushButton, QLabel, QCheckBox, QPlainTextEdit,
     QLineEdit, QSlider, QSpinBox, QDoubleSpinBox,
     QMessageBox, QApplication, QMenu, QMenuBar,
-    QInputDialog, QOpenGLWidget)
+    QInputDialog, QOpenGLWidget,
+    QTableView, QHeaderView, QAbstractItemView)
 
 # Enable high DPI support.
 # BUG: uncommenting this create scaling bugs on high DPI screens
@@ -0,0 +1,707 @@
+# -*- coding: utf-8 -*-
+
+"""Native Qt table widget."""
+
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import ast
+from functools import lru_cache, reduce
+import logging
+import re
+
+import numpy as np
+
+from .qt import (
+    Qt, QTimer, QAbstractTableModel, QModelIndex, QBrush, QColor, QWidget, QVBoxLayout,
+    QLineEdit, QTableView, QHeaderView, QAbstractItemView, QApplication, Debouncer)
+from .widgets import _uniq
+from phylib.utils import emit, Bunch
+from phylib.utils._types import _is_integer
+from phy.utils.color import colormaps, _is_bright
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+# Utils
+# -----------------------------------------------------------------------------
+
+def _format_value(value):
+    """Format a table value for display."""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+
+def _sort_key(value):
+    """Sort key allowing to compare values of different types: empty values first,
+    then numbers, then strings."""
+    if value is None or value == '':
+        return (0, 0)
+    if isinstance(value, str):
+        return (2, value)
+    try:
+        return (1, float(value))
+    except (TypeError, ValueError):  # pragma: no cover
+        return (2, str(value))
+
+
+# String literals, which are left untouched when converting a filter into Python.
+_STRING_LITERAL = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''')
+
+
+def _js_to_python(expr):
+    expr = expr.replace('!==', '!=').replace('===', '==')
+    expr = expr.replace('&&', ' and ').replace('||', ' or ')
+    expr = re.sub(r'!(?!=)', ' not ', expr)
+    for js, py in (('true', 'True'), ('false', 'False'), ('null', 'None')):
+        expr = re.sub(r'\b%s\b' % js, py, expr)
+    return expr
+
+
+def _to_python(text):
+    """Convert the Javascript operators (`&&`, `||`, `!`, `===`, `true`...) accepted by the
+    previous HTML table into Python, outside of the string literals."""
+    # The odd parts are the string literals.
+    parts = _STRING_LITERAL.split(text)
+    return ''.join(
+        part if i % 2 else _js_to_python(part) for i, part in enumerate(parts)).strip()
+
+
+def _isin(a, b):
+    return np.isin(a, list(b) if isinstance(b, (list, tuple, set)) else b)
+
+
+def _is_none(a):
+    """Missing values are NaN in the numerical columns, and None in the other columns."""
+    a = np.asarray(a)
+    if a.dtype == object:
+        return np.array([v is None for v in a.ravel()], dtype=bool).reshape(a.shape)
+    return np.isnan(a) if a.dtype.kind == 'f' else np.zeros(a.shape, dtype=bool)
+
+
+# Element-wise functions used by the vectorized filters instead of the boolean operators.
+_VECTORIZED_FUNCTIONS = {
+    '_and_': np.logical_and,
+    '_or_': np.logical_or,
+    '_not_': np.logical_not,
+    '_in_': _isin,
+    '_not_in_': lambda a, b: np.logical_not(_isin(a, b)),
+    '_is_none_': _is_none,
+}
+
+
+def _is_none_constant(node):
+    return isinstance(node, ast.Constant) and node.value is None
+
+
+class _Vectorizer(ast.NodeTransformer):
+    """Transform a boolean expression on scalars into an element-wise expression on arrays."""
+
+    def _call(self, name, args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = '_and_' if isinstance(node.op, ast.And) else '_or_'
+        return reduce(lambda a, b: self._call(name, [a, b]), node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self._call('_not_', [node.operand])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        # Chained comparisons `a < b < c` become `_and_(a < b, b < c)`.
+        operands = [node.left] + node.comparators
+        pairs = []
+        for op, left, right in zip(node.ops, operands[:-1], operands[1:]):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                name = '_in_' if isinstance(op, ast.In) else '_not_in_'
+                pairs.append(self._call(name, [left, right]))
+            elif (isinstance(op, (ast.Eq, ast.NotEq, ast.Is, ast.IsNot)) and
+                    (_is_none_constant(left) or _is_none_constant(right))):
+                # Comparisons with None test the missing values.
+                test = self._call('_is_none_', [right if _is_none_constant(left) else left])
+                if isinstance(op, (ast.NotEq, ast.IsNot)):
+                    test = self._call('_not_', [test])
+                pairs.append(test)
+            else:
+                pairs.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+        return reduce(lambda a, b: self._call('_and_', [a, b]), pairs)
+
+
+@lru_cache(maxsize=64)
+def _compile_filter(text):
+    """Compile a filter expression on the column names, both as a scalar expression evaluated
+    on a single row, and as a vectorized expression evaluated on the columns.
+
+    Return a `Bunch(names, row_code, code)` instance, or None if the expression is invalid.
+
+    """
+    expr = _to_python(text)
+    try:
+        tree = ast.parse(expr, mode='eval')
+        row_code = compile(tree, '<filter>', 'eval')
+    except SyntaxError:
+        logger.debug("Invalid filter `%s`.", text)
+        return None
+    names = sorted(set(
+        node.id for node in ast.walk(tree) if isinstance(node, ast.Name)))
+    tree = ast.fix_missing_locations(_Vectorizer().visit(tree))
+    return Bunch(names=names, row_code=row_code, code=compile(tree, '<filter>', 'eval'))
+
+
+class _RowValues(dict):
+    """Row values used as namespace when evaluating a filter. Unknown names are None."""
+    def __missing__(self, key):
+        return None
+
+
+_NO_BUILTINS = {'__builtins__': {}}
+
+
+def _match(flt, row):
+    """Evaluate a compiled filter on a row. Rows for which the evaluation fails are hidden."""
+    try:
+        return bool(eval(flt.row_code, _NO_BUILTINS, _RowValues(row)))
+    except Exception:
+        return False
+
+
+def _to_array(values):
+    """Convert the values of a column into a float array if possible, with NaN for the missing
+    values, or an object array otherwise."""
+    if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool))
+           for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    out = np.empty(len(values), dtype=object)
+    out[:] = values
+    return out
+
+
+def _mask(flt, columns, n):
+    """Evaluate a compiled filter on columns of length `n` and return a boolean mask, or None
+    if the filter cannot be vectorized."""
+    namespace = dict(_VECTORIZED_FUNCTIONS)
+    namespace.update(columns)
+    try:
+        with np.errstate(invalid='ignore'):
+            mask = np.asarray(eval(flt.code, _NO_BUILTINS, namespace))
+        mask = np.broadcast_to(mask, (n,)).astype(bool)
+    except Exception:
+        return None
+    return mask
+
+
+# -----------------------------------------------------------------------------
+# Table model
+# -----------------------------------------------------------------------------
+
+class TableModel(QAbstractTableModel):
+    """Qt model exposing the shown rows of a `NativeTable` to a `QTableView`. The view only
+    requests the values of the visible cells."""
+
+    def __init__(self, table):
+        super(TableModel, self).__init__(table)
+        self._table = table
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._table._shown)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._table.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self._table.columns[section]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():  # pragma: no cover
+            return
+        t = self._table
+        row_id = t._shown[index.row()]
+        column = t.columns[index.column()]
+        if role == Qt.DisplayRole:
+            return _format_value(t._rows[row_id].get(column, None))
+        elif role == Qt.BackgroundRole:
+            return t._background(row_id, column)
+        elif role == Qt.ForegroundRole:
+            return t._foreground(row_id, column)
+
+    def refresh(self):
+        """Notify the view that all shown values may have changed."""
+        if self.rowCount() and self.columnCount():
+            self.dataChanged.emit(
+                self.index(0, 0), self.index(self.rowCount() - 1, self.columnCount() - 1))
+
+
+# -----------------------------------------------------------------------------
+# Native table
+# -----------------------------------------------------------------------------
+
+class NativeTable(QWidget):
+    """A sortable table with support for selection, implemented with a Qt model and view.
+
+    Only the visible rows are rendered, and sorting and filtering happen in Python. This
+    widget has the same API and raises the same events as the HTML `Table` widget, except
+    that the callbacks are called immediately.
+
+    Constructor
+    -----------
+
+    parent : Widget
+    columns : list
+        List of column names, the first being `id`.
+    value_names : list
+        Unused, kept for compatibility with the HTML table.
+    data : list
+        List of dictionaries with the row values. Rows with a true `is_masked` value are skipped
+        by the `next()` and `previous()` methods.
+    sort : 2-tuple
+        Initial sort as a pair `(column_name, order)` where `order` is either `asc` or `desc`.
+    title : str
+        Window title.
+    debounce_events : list-like
+        The list of event names that should be debounced.
+
+    Events
+    ------
+
+    ready()
+    select(obj)
+    table_sort(ids)
+    table_filter(ids)
+
+    """
+
+    _ready = False
+    _ready_pending = False
+    # Text color of the rows depending on the value of their `group` field.
+    row_colors = {}
+    # Background color of the selected rows.
+    selected_color = '#444'
+
+    def __init__(
+            self, *args, columns=None, value_names=None, data=None, sort=None, title='',
+            debounce_events=()):
+        super(NativeTable, self).__init__(*args)
+        self.setWindowTitle(title)
+        self._debouncer = Debouncer()
+        self._debounce_events = debounce_events
+        self._is_busy = False
+        self._selected_index_offset = 0
+        self.columns = []
+        self._rows, self._ids, self._shown, self._selected = {}, [], [], []
+
+        self._filter_edit = QLineEdit(self)
+        self._filter_edit.setPlaceholderText('filter')
+        self._filter_edit.returnPressed.connect(
+            lambda: self._filter(self._filter_edit.text()))
+
+        self._model = TableModel(self)
+        self._view = QTableView(self)
+        self._view.setModel(self._model)
+        self._view.setSelectionMode(QAbstractItemView.NoSelection)
+        self._view.setFocusPolicy(Qt.NoFocus)
+        self._view.setShowGrid(False)
+        self._view.setWordWrap(False)
+        self._view.verticalHeader().hide()
+        self._view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self._view.verticalHeader().setDefaultSectionSize(20)
+        header = self._view.horizontalHeader()
+        header.setSectionsClickable(True)
+        header.setSortIndicatorShown(True)
+        header.sectionClicked.connect(self._on_header_clicked)
+        self._view.pressed.connect(self._on_pressed)
+        self.setStyleSheet(
+            'QTableView, QLineEdit, QHeaderView::section '
+            '{background-color: black; color: white; border: 0;}')
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(4, 4, 4, 4)
+        layout.addWidget(self._filter_edit)
+        layout.addWidget(self._view)
+        self.setLayout(layout)
+
+        self._init_table(columns=columns, value_names=value_names, data=data, sort=sort)
+
+    def _init_table(self, columns=None, value_names=None, data=None, sort=None):
+        """Build the table."""
+        self._model.beginResetModel()
+        self.columns = list(columns or ['id'])
+        self.value_names = value_names or self.columns
+        # id => row values
+        self._rows = {}
+        # All ids, in the current sort order.
+        self._ids = []
+        # Shown ids, in the current sort order.
+        self._shown = []
+        # Selected ids, in selection order.
+        self._selected = []
+        self._sort = None
+        # Compiled filter, and cache of the column arrays used by the vectorized filters.
+        self._filter_code = None
+        self._column_arrays = {}
+        self._filter_edit.setText('')
+        self._add_rows(data or [])
+        if sort and sort[0]:
+            self._set_sort(*sort)
+        self._shown = list(self._ids)
+        self._model.endResetModel()
+        self._update_header()
+
+        emit('pre_build', self)
+        # The ready event is raised asynchronously, like with the HTML table, so that
+        # the event handlers can be connected after the table creation.
+        if not self._ready_pending:
+            self._ready_pending = True
+            QTimer.singleShot(0, self._set_ready)
+
+    def _set_ready(self):
+        """Set the widget as ready."""
+        self._ready = True
+        self._ready_pending = False
+        emit('ready', self)
+
+    def is_ready(self):
+        """Whether the widget has been fully loaded."""
+        return self._ready
+
+    @property
+    def debouncer(self):
+        """Widget debouncer."""
+        return self._debouncer
+
+    def _emit(self, name, arg):
+        logger.log(5, "Emit %s %s.", name, arg)
+        if name in self._debounce_events:
+            self._debouncer.submit(emit, name, self, arg)
+        else:
+            emit(name, self, arg)
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _add_rows(self, objects):
+        self._column_arrays.clear()
+        for obj in objects:
+            row_id = obj['id']
+            if row_id not in self._rows:
+                self._ids.append(row_id)
+            self._rows[row_id] = dict(obj)
+
+    def _set_sort(self, name, sort_dir='asc'):
+        """Sort all rows by a column, in a stable way."""
+        self._sort = (name, sort_dir)
+        self._column_arrays.clear()
+        rows = self._rows
+        self._ids.sort(
+            key=lambda row_id: _sort_key(rows[row_id].get(name, None)),
+            reverse=sort_dir == 'desc')
+
+    def _column(self, name):
+        """Return the values of a column as an array, in the current sort order."""
+        if name not in self._column_arrays:
+            rows = self._rows
+            self._column_arrays[name] = _to_array(
+                [rows[row_id].get(name, None) for row_id in self._ids])
+        return self._column_arrays[name]
+
+    def _filtered_ids(self):
+        """Return the ids matching the current filter, in the current sort order."""
+        flt = self._filter_code
+        if flt is None:
+            return list(self._ids)
+        n = len(self._ids)
+        mask = _mask(flt, {name: self._column(name) for name in flt.names}, n) if n else None
+        if mask is None:
+            # The filter could not be vectorized, it is evaluated on every row.
+            return [row_id for row_id in self._ids if _match(flt, self._rows[row_id])]
+        return [row_id for row_id, m in zip(self._ids, mask) if m]
+
+    def _update_shown(self):
+        """Update the shown rows after a change in the sort, the filter, or the rows."""
+        self._model.layoutAboutToBeChanged.emit()
+        self._shown = self._filtered_ids()
+        shown = set(self._shown)
+        self._selected = [row_id for row_id in self._selected if row_id in shown]
+        self._model.layoutChanged.emit()
+
+    def _update_header(self):
+        header = self._view.horizontalHeader()
+        if self._sort and self._sort[0] in self.columns:
+            header.setSortIndicator(
+                self.columns.index(self._sort[0]),
+                Qt.AscendingOrder if self._sort[1] == 'asc' else Qt.DescendingOrder)
+        else:
+            header.setSortIndicator(-1, Qt.AscendingOrder)
+
+    def _resort(self):
+        """Sort again after some rows have been added or changed, without raising an event."""
+        if self._sort:
+            self._set_sort(*self._sort)
+        self._update_shown()
+
+    def _row_index(self, row_id):
+        try:
+            return self._shown.index(row_id)
+        except ValueError:
+            return None
+
+    def _is_masked(self, row_id):
+        return bool(self._rows[row_id].get('is_masked', False))
+
+    def _background(self, row_id, column):
+        if row_id not in self._selected:
+            return
+        if column == 'id':
+            i = self._selected.index(row_id) + self._selected_index_offset
+            r, g, b = colormaps.default[i % len(colormaps.default)]
+            return QBrush(QColor(int(255 * r), int(255 * g), int(255 * b)))
+        return QBrush(QColor(self.selected_color))
+
+    def _foreground(self, row_id, column):
+        if column == 'id' and row_id in self._selected:
+            i = self._selected.index(row_id) + self._selected_index_offset
+            rgb = colormaps.default[i % len(colormaps.default)]
+            if _is_bright(tuple(int(255 * x) for x in rgb)):
+                return QBrush(QColor('black'))
+        color = self.row_colors.get(self._rows[row_id].get('group', None), None)
+        if color:
+            return QBrush(QColor(color))
+
+    def _sibling_id(self, row_id=None, direction='next'):
+        """Return the next or previous non-masked shown row."""
+        if row_id is None:
+            row_id = self._selected[0] if self._selected else None
+        i = self._row_index(row_id) if row_id is not None else None
+        if i is None:
+            return None
+        step = 1 if direction == 'next' else -1
+        i += step
+        while 0 <= i < len(self._shown):
+            if not self._is_masked(self._shown[i]):
+                return self._shown[i]
+            i += step
+        return None
+
+    def _selected_and_next(self, kwargs=None):
+        selected = list(self._selected)
+        next_id = self._sibling_id(selected[-1]) if selected else None
+        return {'selected': selected, 'next': next_id, 'kwargs': kwargs or {}}
+
+    def _set_selected(self, ids, kwargs=None):
+        """Set the selection and raise the select event."""
+        shown = set(self._shown)
+        self._selected = [row_id for row_id in _uniq(ids) if row_id in shown]
+        self._model.refresh()
+        obj = self._selected_and_next(kwargs)
+        self._emit('select', obj)
+        return obj
+
+    def _select_first(self):
+        if not self._shown:
+            return
+        first = self._shown[0]
+        if self._is_masked(first):
+            first = self._sibling_id(first, 'next')
+        return self._set_selected([first] if first is not None else [])
+
+    def _select_last(self):
+        if not self._shown:
+            return
+        last = self._shown[-1]
+        if self._is_masked(last):
+            last = self._sibling_id(last, 'previous')
+        return self._set_selected([last] if last is not None else [])
+
+    def _move_to_sibling(self, direction):
+        if not self._selected:
+            return self._select_first()
+        row_id = self._sibling_id(direction=direction)
+        if row_id is None:
+            return
+        return self._set_selected([row_id])
+
+    def _filter(self, text):
+        """Filter the rows with a Python expression on the column names."""
+        was_filtered = self._filter_code is not None
+        # An invalid filter shows all rows.
+        code = _compile_filter(text) if text else None
+        self._filter_code = code
+        self._update_shown()
+        if code is not None or was_filtered:
+            self._emit('table_filter', list(self._shown))
+        return list(self._shown)
+
+    def _on_header_clicked(self, section):
+        name = self.columns[section]
+        sort_dir = 'desc' if self._sort == (name, 'asc') else 'asc'
+        self.sort_by(name, sort_dir)
+
+    def _on_pressed(self, index):
+        row_id = self._shown[index.row()]
+        modifiers = QApplication.keyboardModifiers()
+        if modifiers & (Qt.ControlModifier | Qt.MetaModifier):
+            selected = list(self._selected)
+            if row_id in selected:
+                selected.remove(row_id)
+            else:
+                selected.append(row_id)
+            self._set_selected(selected)
+        elif modifiers & Qt.ShiftModifier and self._selected:
+            rows = [self._row_index(row_id) for row_id in self._selected]
+            i, j = sorted((max(rows), index.row()))
+            self._set_selected(self._selected + self._shown[i:j + 1])
+        else:
+            self._set_selected([row_id])
+
+    def keyPressEvent(self, e):
+        if e.key() == Qt.Key_Escape and self._filter_edit.hasFocus():
+            self.filter('')
+        else:  # pragma: no cover
+            super(NativeTable, self).keyPressEvent(e)
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def _call(self, callback, out):
+        if callback:
+            callback(out)
+        return out
+
+    def sort_by(self, name, sort_dir='asc'):
+        """Sort by a given variable."""
+        logger.log(5, "Sort by `%s` %s.", name, sort_dir)
+        self._set_sort(name, sort_dir)
+        self._update_shown()
+        self._update_header()
+        self._emit('table_sort', list(self._shown))
+
+    def filter(self, text=''):
+        """Filter the view with a Python expression on the column names, for example
+        `n_spikes > 100 and group == 'good'`.
+
+        The expression is evaluated at once on the arrays of column values, and the list of
+        shown ids is returned.
+
+        """
+        logger.log(5, "Filter table with `%s`.", text)
+        self._filter_edit.setText(text)
+        return self._filter(text)
+
+    def get_ids(self, callback=None):
+        """Get the list of shown ids."""
+        return self._call(callback, list(self._shown))
+
+    def get_next_id(self, callback=None):
+        """Get the next non-skipped row id."""
+        return self._call(callback, self._sibling_id(direction='next'))
+
+    def get_previous_id(self, callback=None):
+        """Get the previous non-skipped row id."""
+        return self._call(callback, self._sibling_id(direction='previous'))
+
+    def first(self, callback=None):
+        """Select the first item."""
+        return self._call(callback, self._select_first())
+
+    def last(self, callback=None):
+        """Select the last item."""
+        return self._call(callback, self._select_last())
+
+    def next(self, callback=None):
+        """Select the next non-skipped row."""
+        return self._call(callback, self._move_to_sibling('next'))
+
+    def previous(self, callback=None):
+        """Select the previous non-skipped row."""
+        return self._call(callback, self._move_to_sibling('previous'))
+
+    def select(self, ids, callback=None, **kwargs):
+        """Select some rows in the table from Python, and raise the select event as when the
+        user selects rows with the mouse."""
+        ids = _uniq(ids)
+        assert all(_is_integer(_) for _ in ids)
+        return self._call(callback, self._set_selected(ids, kwargs))
+
+    def set_selected_index_offset(self, n):
+        """Set the index of the first selected row, used for the colors of the selected rows."""
+        self._selected_index_offset = n
+        self._model.refresh()
+
+    def scroll_to(self, id):
+        """Scroll until a given row is visible."""
+        i = self._row_index(id)
+        if i is not None:
+            self._view.scrollTo(self._model.index(i, 0), QAbstractItemView.EnsureVisible)
+
+    def set_busy(self, busy):
+        """Set the busy state of the GUI."""
+        self._is_busy = busy
+
+    def get(self, id, callback=None):
+        """Get the object given its id."""
+        row = self._rows.get(id, None)
+        return self._call(callback, dict(row) if row is not None else None)
+
+    def add(self, objects):
+        """Add objects object to the table."""
+        if not objects:
+            return
+        if isinstance(objects, dict):
+            objects = [objects]
+        self._add_rows(objects)
+        self._resort()
+
+    def change(self, objects):
+        """Change some objects."""
+        if not objects:
+            return
+        self._column_arrays.clear()
+        for obj in objects:
+            row = self._rows.get(obj['id'], None)
+            if row is not None:
+                row.update(obj)
+        self._resort()
+
+    def remove(self, ids):
+        """Remove some objects from their ids."""
+        if not ids:
+            return
+        ids = set(ids)
+        self._column_arrays.clear()
+        for row_id in ids:
+            self._rows.pop(row_id, None)
+        self._ids = [row_id for row_id in self._ids if row_id not in ids]
+        self._update_shown()
+
+    def remove_all(self):
+        """Remove all rows in the table."""
+        self._selected = []
+        self.remove(list(self._ids))
+
+    def remove_all_and_add(self, objects):
+        """Remove all rows in the table and add new objects."""
+        if not objects:
+            return self.remove_all()
+        self._selected = []
+        self._rows = {}
+        self._ids = []
+        self.add(objects)
+
+    def get_selected(self, callback=None):
+        """Get the currently selected rows."""
+        return self._call(callback, list(self._selected))
+
+    def get_current_sort(self, callback=None):
+        """Get the current sort as a tuple `(name, dir)`."""
+        return self._call(callback, list(self._sort) if self._sort else None)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""Test native table."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import fixture
+
+from phylib.utils import connect, unconnect
+from ..qt import Qt
+from ..table import NativeTable, _compile_filter, _match, _mask, _to_array
+from ..widgets import Barrier
+
+
+#------------------------------------------------------------------------------
+# Fixtures
+#------------------------------------------------------------------------------
+
+@fixture
+def table(qtbot):
+    columns = ["id", "count"]
+    data = [{"id": i,
+             "count": 100 - 10 * i,
+             "float": float(i),
+             "is_masked": True if i in (2, 3, 5) else False,
+             } for i in range(10)]
+    table = NativeTable(columns=columns, data=data)
+    b = Barrier()
+    connect(b(1), event='ready', sender=table)
+    qtbot.addWidget(table)
+    b.wait()
+
+    yield table
+
+    table.close()
+
+
+#------------------------------------------------------------------------------
+# Test native table
+#------------------------------------------------------------------------------
+
+def test_table_filter_expr():
+    assert _match(_compile_filter("a == 1 && b != 'x'"), {'a': 1, 'b': 'y'})
+    assert not _match(_compile_filter("a == 1 && b != 'x'"), {'a': 1, 'b': 'x'})
+    assert _match(_compile_filter("!(a > 2) || false"), {'a': 1})
+    assert _match(_compile_filter("a === null"), {})
+    # Evaluation errors hide the row.
+    assert not _match(_compile_filter("a > 2"), {'a': None})
+    assert _compile_filter("a >") is None
+    # The operators are not converted in the string literals.
+    assert _match(_compile_filter('group == "false!" && !b'), {'group': 'false!'})
+    assert _match(_compile_filter("g === 'a || \\'null\\''"), {'g': "a || 'null'"})
+    # The compiled filters are cached.
+    assert _compile_filter("a == 1") is _compile_filter("a == 1")
+
+
+def test_table_filter_vectorized():
+    a = _to_array([1, 2, None, 4])
+    b = _to_array(['x', 'y', 'x', None])
+    assert a.dtype == np.float64
+    assert b.dtype == object
+
+    def _m(text):
+        flt = _compile_filter(text)
+        return _mask(flt, {name: {'a': a, 'b': b}.get(name) for name in flt.names}, 4)
+
+    ae(_m("a > 1 && b != 'x'"), [0, 1, 0, 1])
+    ae(_m("!(a >= 2) || b === 'y'"), [1, 1, 1, 0])
+    ae(_m("1 < a < 4"), [0, 1, 0, 0])
+    ae(_m("b in ('x', 'z')"), [1, 0, 1, 0])
+    ae(_m("a == null"), [0, 0, 1, 0])
+    ae(_m("b is not None"), [1, 1, 1, 0])
+    ae(_m("true"), [1, 1, 1, 1])
+    # Filters which cannot be vectorized.
+    assert _m("b > 'a'") is None
+    assert _m("a + b") is None
+
+
+def test_table_empty(qtbot):
+    table = NativeTable()
+    qtbot.addWidget(table)
+    qtbot.waitUntil(table.is_ready)
+    assert table.debouncer
+    assert table.get_ids() == []
+    assert table.next() is None
+    table.close()
+
+
+def test_table_model(qtbot, table):
+    model = table._model
+    assert model.rowCount() == 10
+    assert model.columnCount() == 2
+    assert model.headerData(1, Qt.Horizontal) == 'count'
+    assert model.data(model.index(1, 1)) == '90'
+
+    table.select([1, 4])
+    assert model.data(model.index(4, 0), Qt.BackgroundRole) is not None
+    assert model.data(model.index(0, 0), Qt.BackgroundRole) is None
+
+
+def test_table_select(qtbot, table):
+    _sel = []
+
+    @connect(sender=table)
+    def on_select(sender, obj):
+        _sel.append(obj)
+
+    out = table.select([1, 2, 1], some_kwarg=3)
+    assert out == {'selected': [1, 2], 'next': 4, 'kwargs': {'some_kwarg': 3}}
+    assert table.get_selected() == [1, 2]
+    qtbot.waitUntil(lambda: _sel == [out])
+
+    _l = []
+    table.get_selected(callback=_l.append)
+    assert _l == [[1, 2]]
+
+    unconnect(on_select)
+
+
+def test_table_nav(qtbot, table):
+    table.next()
+    assert table.get_selected() == [0]
+    assert table.get_next_id() == 1
+    assert table.get_previous_id() is None
+
+    # Masked rows are skipped.
+    table.select([4])
+    table.next()
+    assert table.get_selected() == [6]
+    table.previous()
+    assert table.get_selected() == [4]
+
+    table.last()
+    assert table.get_selected() == [9]
+    assert table.next() is None
+    table.first()
+    assert table.get_selected() == [0]
+
+
+def test_table_sort(qtbot, table):
+    table.select([6])
+
+    _l = []
+
+    @connect(sender=table)
+    def on_table_sort(sender, row_ids):
+        _l.append(row_ids)
+
+    table.sort_by('count', 'asc')
+    assert table.get_current_sort() == ['count', 'asc']
+    assert table.get_selected() == [6]
+    assert table.get_ids() == list(range(9, -1, -1))
+
+    table.next()
+    assert table.get_selected() == [4]
+
+    table.sort_by('count', 'desc')
+    assert table.get_ids() == list(range(10))
+    assert _l == [list(range(9, -1, -1)), list(range(10))]
+
+    # Header click toggles the sort.
+    table._on_header_clicked(1)
+    assert table.get_current_sort() == ['count', 'asc']
+
+    unconnect(on_table_sort)
+
+
+def test_table_add_change_remove(qtbot, table):
+    table.add({'id': 100, 'count': 1000})
+    assert table.get_ids() == list(range(10)) + [100]
+
+    table.remove([0, 1])
+    assert table.get_ids() == list(range(2, 10)) + [100]
+
+    assert table.get(100) == {'id': 100, 'count': 1000}
+    table.change([{'id': 100, 'count': 2000}])
+    assert table.get(100) == {'id': 100, 'count': 2000}
+
+    # The table is automatically resorted after a change.
+    table.sort_by('count', 'asc')
+    table.change([{'id': 5, 'count': 1000}])
+    assert table.get_ids() == [9, 8, 7, 6, 4, 3, 2, 5, 100]
+
+    table.remove_all_and_add({"id": 1000})
+    assert table.get_ids() == [1000]
+    table.remove_all()
+    assert table.get_ids() == []
+
+
+def test_table_filter(qtbot, table):
+    _l = []
+
+    @connect(sender=table)
+    def on_table_filter(sender, row_ids):
+        _l.append(row_ids)
+
+    table.filter("id == 5")
+    assert table.get_ids() == [5]
+
+    assert table.filter("count == 80 || count == 70") == [2, 3]
+    assert table.get_ids() == [2, 3]
+
+    # The selection is restricted to the shown rows.
+    table.select([2, 5])
+    assert table.get_selected() == [2]
+
+    # Invalid filter.
+    table.filter("count ==")
+    assert table.get_ids() == list(range(10))
+
+    table.filter()
+    assert table.get_ids() == list(range(10))
+
+    # Filter evaluated on every row, and filter updated after a change in the rows.
+    table.add({'id': 10, 'count': 'many'})
+    assert table.filter("count > 85") == [0, 1]
+    table.change([{'id': 2, 'count': 90}])
+    assert table.get_ids() == [0, 1, 2]
+
+    assert _l == [[5], [2, 3], list(range(10)), [0, 1]]
+
+    unconnect(on_table_filter)
+
+
+def test_table_scroll(qtbot, table):
+    table.add([{'id': 1000 + i, 'count': i} for i in range(1000)])
+    table.scroll_to(1400)
+    table.set_selected_index_offset(2)
+    table.set_busy(True)
+    table.set_busy(False)
@@ -23,4 +23,4 @@ from .utils import get_linear_x, BatchAccumulator
 from .interact import Grid, Boxed, Lasso
 from .visuals import (
     ScatterVisual, UniformScatterVisual, PlotVisual, UniformPlotVisual, HistogramVisual,
-    TextVisual, LineVisual, ImageVisual, PolygonVisual)
+    TextVisual, LineVisual, ImageVisual, DensityVisual, PolygonVisual)
@@ -635,6 +635,8 @@ class BaseCanvas(QOpenGLWindow):
 
         # Finally, we create the visual's program.
         visual.program = LazyProgram(vs, fs, gs)
+        # Visuals added in lazy mode, typically in a background thread, are lazy too.
+        visual.program._is_lazy = self._is_lazy
         logger.log(5, "Vertex shader: %s", vs)
         logger.log(5, "Fragment shader: %s", fs)
 
@@ -33,18 +33,44 @@ from .globject import GLObject
 log = logging.getLogger(__name__)
 
 
+def _merge_spans(spans, max_gap=0):
+    """
+    Merge (start, stop) byte spans that overlap or are separated by at most
+    max_gap bytes, and return the sorted list of merged spans.
+    """
+    out = []
+    for start, stop in sorted(spans):
+        if out and start <= out[-1][1] + max_gap:
+            out[-1] = (out[-1][0], max(out[-1][1], stop))
+        else:
+            out.append((start, stop))
+    return out
+
+
 class Buffer(GPUData, GLObject):
     """
     Generic GPU buffer.
 
     A generic buffer is an interface used to upload data to a GPU array buffer
     (gl.GL_ARRAY_BUFFER or gl.GL_ELEMENT_ARRAY_BUFFER).
+
+    Once the buffer has been uploaded, the spans written since the last upload
+    are tracked separately, and only these spans are uploaded with
+    glBufferSubData (spans closer than `span_gap` bytes are merged).
     """
 
+    # Dirty spans separated by less than this number of bytes are uploaded at once.
+    span_gap = 4096
+
+    # Total number of bytes uploaded to the GPU by all buffers.
+    nbytes_uploaded = 0
+
     def __init__(self, target, usage=gl.GL_DYNAMIC_DRAW):
         GLObject.__init__(self)
         self._target = target
         self._usage = usage
+        # None until the first upload, when the whole buffer is uploaded.
+        self._spans = None
 
     @property
     def need_update(self):
@@ -79,16 +105,40 @@ class Buffer(GPUData, GLObject):
         log.log(5, "GPU: Deactivating buffer (id=%d)" % self._id)
         gl.glBindBuffer(self._target, 0)
 
+    def _add_pending_data(self, start, stop):
+        """ Add pending data and record the dirty span """
+
+        base = self.base
+        if isinstance(base, GPUData):
+            base._add_pending_data(start, stop)
+            return
+        GPUData._add_pending_data(self, start, stop)
+        if self._spans is not None:
+            self._spans.append((start, stop))
+
+    @property
+    def pending_spans(self):
+        """ List of (start, stop) byte spans to upload at the next update """
+
+        if isinstance(self.base, Buffer):
+            return self.base.pending_spans
+        if not self._pending_data:
+            return []
+        if not self._spans:
+            return [self._pending_data]
+        return _merge_spans(self._spans, self.span_gap)
+
     def _update(self):
         """ Upload all pending data to GPU. """
 
         if self.pending_data:
-            start, stop = self.pending_data
-            offset, nbytes = start, stop - start
-            # offset, nbytes = self.pending_data
-            data = self.ravel().view(np.ubyte)[offset:offset + nbytes]
-            gl.glBufferSubData(self.target, offset, nbytes, data)
+            raw = self.ravel().view(np.ubyte)
+            for offset, stop in self.pending_spans:
+                nbytes = stop - offset
+                gl.glBufferSubData(self.target, offset, nbytes, raw[offset:stop])
+                Buffer.nbytes_uploaded += nbytes
         self._pending_data = None
+        self._spans = []
         self._need_update = False
 
 
@@ -104,3 +154,64 @@ class IndexBuffer(Buffer):
 
     def __init__(self, usage=gl.GL_DYNAMIC_DRAW):
         Buffer.__init__(self, gl.GL_ELEMENT_ARRAY_BUFFER, usage)
+
+
+class BufferPool(object):
+    """
+    Pool of the vertex buffers of a program.
+
+    The vertex buffers released by the program attributes, when they need a
+    larger buffer, are kept in the pool and reused by attributes requiring a
+    buffer of the same type, instead of allocating new buffers on the GPU.
+    Buffers that do not fit in the pool are deleted the next time the program
+    is activated, since a GL context is required.
+    """
+
+    # Maximum number of released buffers kept for reuse.
+    max_buffers = 8
+
+    # Growth factor of the capacity when a buffer needs to be enlarged.
+    growth = 1.5
+
+    # A buffer is replaced when it is this many times larger than the data.
+    shrink_ratio = 4
+
+    def __init__(self):
+        self._buffers = []
+        self._garbage = []
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def get(self, dtype, size, capacity=None):
+        """
+        Return a vertex buffer with the given dtype and at least `size` items,
+        reusing the smallest suitable released buffer if possible, otherwise
+        allocating a buffer with `capacity` items. Released buffers much larger
+        than the requested size are not reused.
+        """
+
+        max_size = self.shrink_ratio * max(size, capacity or 0, 1024)
+        candidates = [
+            buf for buf in self._buffers
+            if buf.dtype == dtype and size <= len(buf) <= max_size]
+        if candidates:
+            buf = min(candidates, key=len)
+            self._buffers.remove(buf)
+            log.log(5, "Reuse vertex buffer with %d items" % len(buf))
+            return buf
+        capacity = max(size, capacity or 0)
+        return np.zeros(capacity, dtype=dtype).view(VertexBuffer)
+
+    def release(self, buf):
+        """ Give back a buffer which is no longer used """
+
+        self._buffers.append(buf)
+        while len(self._buffers) > self.max_buffers:
+            self._garbage.append(self._buffers.pop(0))
+
+    def collect(self):
+        """ Delete the buffers that have been dropped from the pool (requires a GL context) """
+
+        while self._garbage:
+            self._garbage.pop().delete()
@@ -13,7 +13,7 @@ from . import gl
 from .snippet import Snippet
 from .globject import GLObject
 from .array import VertexArray
-from .buffer import VertexBuffer, IndexBuffer
+from .buffer import VertexBuffer, IndexBuffer, BufferPool
 from .shader import VertexShader, FragmentShader, GeometryShader
 from .variable import Uniform, Attribute
 
@@ -93,6 +93,9 @@ class Program(GLObject):
         self._uniforms = {}
         self._attributes = {}
 
+        # Vertex buffers released by the attributes, reused by other attributes
+        self._buffer_pool = BufferPool()
+
         # Build hooks, uniforms and attributes
         self._build_hooks()
         self._build_uniforms()
@@ -373,6 +376,9 @@ class Program(GLObject):
         log.log(5, "GPU: Activating program (id=%d)" % self._id)
         gl.glUseProgram(self.handle)
 
+        # Delete the vertex buffers dropped from the pool
+        self._buffer_pool.collect()
+
         for uniform in sorted(self._uniforms.values(), key=attrgetter('name')):
             if uniform.active:
                 uniform.activate()
@@ -65,7 +65,7 @@ import numpy as np
 from . import gl
 from .globject import GLObject
 from .array import VertexArray
-from .buffer import VertexBuffer
+from .buffer import Buffer, VertexBuffer
 from .texture import TextureCube
 from .texture import Texture1D, Texture2D
 
@@ -305,6 +305,9 @@ class Uniform(Variable):
 class Attribute(Variable):
     """ An Attribute represents a program attribute variable """
 
+    # Maximum number of separate spans uploaded when updating the data.
+    max_spans = 64
+
     _afunctions = {
         gl.GL_FLOAT: gl.glVertexAttrib1f,
         gl.GL_FLOAT_VEC2: gl.glVertexAttrib2f,
@@ -323,6 +326,11 @@ class Attribute(Variable):
         # Whether this attribure is generic
         self._generic = False
 
+        # Vertex buffer owned by this attribute, reused by successive set_data()
+        # calls, and number of items of this buffer holding the current data
+        self._buffer = None
+        self._n_valid = 0
+
     def set_data(self, data):
         """ Assign new data to the variable (deferred operation) """
 
@@ -355,13 +363,61 @@ class Attribute(Variable):
         else:  # lif not isinstance(data, VertexBuffer):
             name, base, count = self.dtype
             data = np.array(data, dtype=base, copy=False)
-            data = data.ravel().view([(name, base, (count,))])
+            data = np.ascontiguousarray(data.ravel()).view([(name, base, (count,))])
             # WARNING : transform data with the right type
             # data = np.array(data,copy=False)
-            self._data = data.view(VertexBuffer)
+            self._set_buffer_data(data)
 
         self._generic = False
 
+    def _get_buffer(self, dtype, size):
+        """ Return a vertex buffer with at least size items, reusing the current buffer
+        if possible """
+
+        buf = self._buffer
+        pool = self._program._buffer_pool
+        # The current buffer is reused unless it is too small, or much too large.
+        if (buf is not None and buf.dtype == dtype and
+                size <= len(buf) <= max(size, 1024) * pool.shrink_ratio):
+            return buf
+        capacity = size
+        if buf is not None:
+            if buf.dtype == dtype and size > len(buf):
+                capacity = int(len(buf) * pool.growth)
+            pool.release(buf)
+        self._buffer = pool.get(dtype, size, capacity=capacity)
+        self._n_valid = 0
+        return self._buffer
+
+    def _set_buffer_data(self, data):
+        """ Copy the data in the vertex buffer, only marking the items that have changed
+        since the last call for upload """
+
+        n = len(data)
+        buf = self._get_buffer(data.dtype, n)
+        raw = buf.view(np.ndarray)
+        # Compare the new data with the data currently in the buffer.
+        m = min(n, self._n_valid)
+        if m:
+            itemsize = data.dtype.itemsize
+            changed = np.flatnonzero(np.any(
+                raw[:m].view(np.uint8).reshape((m, itemsize)) !=
+                data[:m].view(np.uint8).reshape((m, itemsize)), axis=1))
+            if len(changed):
+                # Group the changed items in runs, merging runs separated by small gaps.
+                gap = max(1, Buffer.span_gap // itemsize)
+                splits = np.flatnonzero(np.diff(changed) > gap)
+                starts = changed[np.r_[0, splits + 1]]
+                stops = changed[np.r_[splits, len(changed) - 1]] + 1
+                if len(starts) > self.max_spans:
+                    starts, stops = starts[:1], stops[-1:]
+                for i, j in zip(starts, stops):
+                    buf[i:j] = data[i:j]
+        if n > m:
+            buf[m:n] = data[m:n]
+        self._n_valid = n
+        self._data = buf[:n]
+
     def _activate(self):
         if isinstance(self.data, (VertexBuffer, VertexArray)):
             self.data.activate()
@@ -0,0 +1,11 @@
+uniform sampler2D u_density;
+
+varying vec2 v_tex_coords;
+varying vec4 v_color;
+
+void main() {
+    float density = texture2D(u_density, v_tex_coords).r;
+    if (density <= 0.)
+        discard;
+    gl_FragColor = vec4(v_color.rgb, v_color.a * density);
+}
@@ -0,0 +1,20 @@
+#include "utils.glsl"
+
+attribute vec2 a_position;
+attribute float a_tex_x;
+attribute float a_row;  // 0..n_rows-1
+
+uniform sampler2D u_color_table;
+uniform float n_colors;
+uniform float n_color_cols;
+uniform float n_rows;
+
+varying vec2 v_tex_coords;
+varying vec4 v_color;
+
+void main() {
+    gl_Position = transform(a_position);
+
+    v_tex_coords = vec2(a_tex_x, (a_row + .5) / n_rows);
+    v_color = fetch_table(a_row, u_color_table, n_colors, n_color_cols);
+}
@@ -6,13 +6,22 @@ attribute float a_signal_index;  // 0..n_signals-1
 attribute float a_mask;
 
 uniform float u_mask_max;
+uniform vec4 u_data_bounds;
+uniform sampler2D u_signal_bounds;
+uniform float n_signal_bounds;  // 0 when all signals have the bounds u_data_bounds
+uniform float n_signal_bounds_cols;
 
 varying vec4 v_color;
 varying float v_signal_index;
 varying float v_mask;
 
 void main() {
-    vec2 xy = a_position.xy;
+    // Normalize the raw data, with the bounds of the signal.
+    vec4 bounds = u_data_bounds;
+    if (n_signal_bounds > 0.0)
+        bounds = fetch_table(
+            a_signal_index, u_signal_bounds, n_signal_bounds, n_signal_bounds_cols);
+    vec2 xy = -1.0 + 2.0 * (a_position.xy - bounds.xy) / (bounds.zw - bounds.xy);
     gl_Position = transform(xy);
     gl_Position.z = min(a_position.z, get_depth(a_mask, u_mask_max));
 
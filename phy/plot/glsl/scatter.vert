@@ -2,11 +2,15 @@ attribute vec3 a_position;
 attribute vec4 a_color;
 attribute float a_size;
 
+uniform vec4 u_data_bounds;
+
 varying vec4 v_color;
 varying float v_size;
 
 void main() {
-    vec2 xy = a_position.xy;
+    // Normalize the raw data.
+    vec4 bounds = u_data_bounds;
+    vec2 xy = -1.0 + 2.0 * (a_position.xy - bounds.xy) / (bounds.zw - bounds.xy);
     gl_Position = transform(xy);
     gl_Position.z = a_position.z;
 
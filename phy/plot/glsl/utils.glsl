@@ -23,6 +23,16 @@ vec4 fetch_texture(float index, sampler2D texture, float size) {
 }
 
 
+vec4 fetch_table(float index, sampler2D texture, float size, float n_cols) {
+    // Fetch the row `index` of a table with `size` rows, wrapped in a 2D texture with
+    // `n_cols` columns.
+    float n_rows = ceil(size / n_cols);
+    float row = floor((index + .5) / n_cols);
+    float col = index - row * n_cols;
+    return texture2D(texture, vec2((col + .5) / n_cols, (row + .5) / n_rows));
+}
+
+
 vec4 filled(float distance, float linewidth, float antialias, vec4 bg_color)
 {
     vec4 frag_color;
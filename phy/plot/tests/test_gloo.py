@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""Test the vertex buffer updates of the gloo programs."""
+
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import tracemalloc
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+from pytest import fixture
+
+from ..gloo import Program
+from ..gloo.buffer import _merge_spans
+from ..transform import Range
+from ..visuals import PlotVisual, ScatterVisual, _color_lookup_shader, _set_color_table
+
+
+#------------------------------------------------------------------------------
+# Fixtures
+#------------------------------------------------------------------------------
+
+VERT = """
+attribute vec2 a_position;
+attribute vec4 a_color;
+varying vec4 v_color;
+void main() {
+    gl_Position = vec4(a_position, 0., 1.);
+    v_color = a_color;
+}
+"""
+
+FRAG = """
+varying vec4 v_color;
+void main() {
+    gl_FragColor = v_color;
+}
+"""
+
+
+@fixture
+def program():
+    return Program(VERT, FRAG)
+
+
+def _uploaded(program, name):
+    """Return the number of bytes to upload for an attribute, and mark them as uploaded,
+    as Buffer._update() would do in a GL context."""
+    buf = program._attributes[name]._buffer
+    nbytes = sum(stop - start for start, stop in buf.pending_spans)
+    buf._pending_data = None
+    buf._spans = []
+    return nbytes
+
+
+def _values(program, name):
+    return np.asarray(program[name]).view(np.float32).reshape((len(program[name]), -1))
+
+
+def _build(visual):
+    """Build the program of a visual without a canvas."""
+    vs, fs = visual.inserter.insert_into_shaders(visual.vertex_shader, visual.fragment_shader)
+    visual.program = Program(vs, fs)
+    visual.canvas = None
+    return visual
+
+
+def _normalized(visual):
+    """Normalize the positions of a plot visual as the vertex shader does."""
+    pos = _values(visual.program, 'a_position')[:, :2].astype(np.float64)
+    bounds = visual.program['u_data_bounds'][np.newaxis, :]
+    if visual.program['n_signal_bounds'] > 0:
+        index = _values(visual.program, 'a_signal_index')[:, 0].astype(np.int64)
+        bounds = np.asarray(visual.program['u_signal_bounds']).reshape((-1, 4))[index]
+    return -1 + 2 * (pos - bounds[:, :2]) / (bounds[:, 2:] - bounds[:, :2])
+
+
+def _peak_memory(f):
+    """Return the peak memory allocated by a function, in bytes."""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_merge_spans():
+    assert _merge_spans([]) == []
+    assert _merge_spans([(10, 20), (0, 5), (15, 30)]) == [(0, 5), (10, 30)]
+    assert _merge_spans([(10, 20), (0, 5)], max_gap=5) == [(0, 20)]
+
+
+def test_attribute_dirty_spans(program):
+    color = np.random.rand(1000, 4).astype(np.float32)
+    program['a_color'] = color
+    buf = program._attributes['a_color']._buffer
+    # The whole buffer is uploaded the first time.
+    assert _uploaded(program, 'a_color') == color.nbytes
+
+    # Same data: nothing to upload.
+    program['a_color'] = color
+    assert _uploaded(program, 'a_color') == 0
+
+    # Only the changed items are uploaded, the buffer is reused.
+    color[10:20] = 0
+    color[900] = 1
+    program['a_color'] = color
+    assert program._attributes['a_color']._buffer is buf
+    assert buf.pending_spans == [(160, 320), (14400, 14416)]
+    ae(_values(program, 'a_color'), color)
+
+
+def test_attribute_capacity(program):
+    program['a_position'] = np.random.rand(1000, 2)
+    attr = program._attributes['a_position']
+    buf = attr._buffer
+
+    # Smaller data: the buffer is reused.
+    pos = np.random.rand(800, 2)
+    program['a_position'] = pos
+    assert attr._buffer is buf
+    assert len(program['a_position']) == 800
+    ae(_values(program, 'a_position'), pos.astype(np.float32))
+
+    # Larger data: the buffer grows, the old one goes to the pool.
+    program['a_position'] = np.random.rand(1100, 2)
+    assert len(attr._buffer) == 1500
+    assert len(program._buffer_pool) == 1
+
+    # The released buffer is reused by another attribute with the same type.
+    pool = program._buffer_pool
+    assert pool.get(buf.dtype, 900) is buf
+    assert len(pool) == 0
+
+    # Buffers dropped from the pool are deleted when the program is activated.
+    pool.max_buffers = 1
+    pool.release(buf)
+    pool.release(attr._buffer)
+    assert len(pool) == 1
+    assert len(pool._garbage) == 1
+    pool.collect()
+    assert not pool._garbage
+
+
+def test_attribute_shrink(program):
+    program['a_position'] = np.random.rand(100000, 2)
+    attr = program._attributes['a_position']
+    buf = attr._buffer
+    assert len(buf) == 100000
+
+    # Much smaller data: the oversized buffer is replaced by a smaller one.
+    pos = np.random.rand(10, 2)
+    program['a_position'] = pos
+    assert attr._buffer is not buf
+    assert len(attr._buffer) == 10
+    assert len(program['a_position']) == 10
+    ae(_values(program, 'a_position'), pos.astype(np.float32))
+
+    # The oversized buffer stays in the pool but is not reused for small data.
+    pool = program._buffer_pool
+    assert buf in pool._buffers
+    assert pool.get(buf.dtype, 10) is not buf
+    assert pool.get(buf.dtype, 50000) is buf
+
+
+def test_upload_benchmark(program):
+    """Bytes uploaded when changing the color of one signal among many, as when a cluster is
+    selected in a view showing many clusters."""
+    n_signals, n_samples = 100, 1000
+    n = n_signals * n_samples
+    program['a_position'] = np.random.rand(n, 2)
+    color = np.tile(np.random.rand(n_signals, 1, 4), (1, n_samples, 1)).reshape((n, 4))
+    program['a_color'] = color
+    _uploaded(program, 'a_color')
+
+    uploaded = []
+    for i in range(10):
+        color[i * n_samples:(i + 1) * n_samples] = np.random.rand(4)
+        program['a_color'] = color
+        uploaded.append(_uploaded(program, 'a_color'))
+    full = n * 4 * 4
+    assert max(uploaded) == n_samples * 4 * 4
+    assert sum(uploaded) < full / 5
+
+
+def test_color_lookup():
+    program = Program(_color_lookup_shader(VERT), FRAG)
+    n_clusters, n_spikes = 100, 100000
+    program['a_position'] = np.random.rand(n_spikes, 2)
+    program['a_color_index'] = np.random.randint(0, n_clusters, n_spikes).astype(np.float32)
+    _uploaded(program, 'a_color_index')
+
+    # Changing the colors only updates the color table, not the vertices.
+    color = np.random.rand(n_clusters, 4)
+    _set_color_table(program, color, (0, 0, 0, 1))
+    texture = program['u_color_table']
+    assert texture.shape == (1, n_clusters, 4)
+    assert program['n_colors'] == n_clusters
+    assert _uploaded(program, 'a_color_index') == 0
+
+    # The texture is reused when the number of clusters does not change.
+    color[0] = 0
+    _set_color_table(program, color, (0, 0, 0, 1))
+    assert program['u_color_table'] is texture
+    ae(texture[0, 0], 0)
+
+    # There are at least two colors in the table.
+    _set_color_table(program, color[:1], (0, 0, 0, 1))
+    assert program['n_colors'] == 2
+
+    # A large table is wrapped into several texture rows.
+    color = np.random.rand(2500, 4)
+    _set_color_table(program, color, (0, 0, 0, 1))
+    texture = program['u_color_table']
+    assert texture.shape == (3, 1024, 4)
+    assert program['n_colors'] == 2500
+    assert program['n_color_cols'] == 1024
+    ac(texture.reshape((-1, 4))[:2500], color, rtol=1e-6)
+
+
+def test_plot_gpu_normalization():
+    v = _build(PlotVisual())
+    y = [np.random.randn(10), 10 + np.random.randn(20)]
+
+    # Same bounds for all signals: the raw data is uploaded.
+    v.set_data(y=y, data_bounds=(-1, -20, 1, 20))
+    assert v.program['n_signal_bounds'] == 0
+    ae(_values(v.program, 'a_position')[:10, 1], y[0].astype(np.float32))
+    ac(_normalized(v)[:, 1], np.concatenate(y) / 20, atol=1e-6)
+
+    # Per-signal bounds in a float texture.
+    v.set_data(y=y, data_bounds='auto')
+    assert v.program['n_signal_bounds'] == 2
+    n = _normalized(v)
+    ac(n[:10, 1].min(), -1, atol=1e-6)
+    ac(n[10:, 1].max(), 1, atol=1e-6)
+
+    # Data far away from the origin, as in the trace view: normalized on the CPU.
+    x = [3600 + np.linspace(0, 1e-3, 10)]
+    v.set_data(x=x, y=[np.zeros(10)], data_bounds=(3600, -1, 3600 + 1e-3, 1))
+    assert v.program['n_signal_bounds'] == 0
+    ac(_normalized(v)[:, 0], np.linspace(-1, 1, 10), atol=1e-5)
+
+    # A 1-second interval far away from the origin is also normalized on the CPU.
+    x = [1000 + np.linspace(0, 1, 10)]
+    v.set_data(x=x, y=[np.zeros(10)], data_bounds=(1000, -1, 1001, 1))
+    assert v.program['n_signal_bounds'] == 0
+    ae(v.program['u_data_bounds'], [-1, -1, 1, 1])
+    ac(_normalized(v)[:, 0], np.linspace(-1, 1, 10), atol=1e-6)
+
+    # Many per-signal bounds are wrapped into several texture rows.
+    y = np.random.randn(2500, 5)
+    v.set_data(y=y, data_bounds='auto')
+    assert v.program['n_signal_bounds'] == 2500
+    assert v.program['n_signal_bounds_cols'] == 1024
+    assert v.program['u_signal_bounds'].shape == (3, 1024, 4)
+    n = _normalized(v)[:, 1].reshape((2500, 5))
+    ac(n.min(axis=1), -1, atol=1e-5)
+    ac(n.max(axis=1), 1, atol=1e-5)
+
+
+def test_scatter_gpu_normalization():
+    v = _build(ScatterVisual())
+    pos = np.random.randn(100, 2)
+    v.set_data(pos=pos, data_bounds=(-10, -10, 10, 10))
+    ae(v.program['u_data_bounds'], [-10, -10, 10, 10])
+    ae(_values(v.program, 'a_position')[:, :2], pos.astype(np.float32))
+
+    # Per-point bounds: normalized on the CPU.
+    v.set_data(pos=pos, data_bounds=np.c_[pos - 1, pos + 1])
+    ae(v.program['u_data_bounds'], [-1, -1, 1, 1])
+    ac(_values(v.program, 'a_position')[:, :2], 0, atol=1e-6)
+
+
+def test_plot_upload_benchmark():
+    """Memory allocated when uploading 100 waveforms on 32 channels with 82 samples, compared
+    to the former normalization of the positions on the CPU."""
+    n_spikes, n_channels, n_samples = 100, 32, 82
+    n_signals = n_spikes * n_channels
+    x = np.tile(np.linspace(-1, 1, n_samples), (n_signals, 1))
+    y = np.random.randn(n_signals, n_samples)
+    data_bounds = (-1, -5, 1, 5)
+
+    def _cpu_positions():
+        pos = np.empty((y.size, 2), dtype=np.float64)
+        pos[:, 0] = x.ravel()
+        pos[:, 1] = y.ravel()
+        bounds = np.repeat(np.tile(data_bounds, (n_signals, 1)), n_samples, axis=0)
+        pos = Range(from_bounds=bounds).apply(pos)
+        depth = np.repeat(np.zeros((n_signals, 1)), n_samples, axis=0)
+        return np.c_[pos, depth].astype(np.float32)
+
+    v = _build(PlotVisual())
+    v.set_data(x=x, y=y, data_bounds=data_bounds)
+    ac(_normalized(v), _cpu_positions()[:, :2], atol=1e-6)
+
+    # The whole upload allocates less than the former position normalization alone.
+    cpu = _peak_memory(_cpu_positions)
+    gpu = _peak_memory(lambda: v.set_data(x=x, y=y, data_bounds=data_bounds))
+    assert gpu < cpu / 1.5
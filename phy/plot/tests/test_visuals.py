@@ -70,6 +70,22 @@ def test_scatter_custom(qtbot, canvas_pz):
     _test_visual(qtbot, canvas_pz, ScatterVisual(), pos=pos, color=c, size=s)
 
 
+def test_scatter_color_lookup(qtbot, canvas_pz):
+    n = 100
+    pos = .2 * np.random.randn(n, 2)
+    color = np.random.uniform(.4, .7, size=(5, 4))
+    color_index = np.random.randint(0, 5, n)
+
+    v = ScatterVisual(color_lookup=True)
+    canvas_pz.add_visual(v)
+    v.set_data(pos=pos, color=color, color_index=color_index)
+    v.set_color(color[::-1])
+    canvas_pz.show()
+    qtbot.waitForWindowShown(canvas_pz)
+    v.close()
+    canvas_pz.close()
+
+
 #------------------------------------------------------------------------------
 # Test patch visual
 #------------------------------------------------------------------------------
@@ -173,6 +189,18 @@ def test_plot_color(qtbot, canvas_pz):
     canvas_pz.close()
 
 
+def test_plot_color_lookup(qtbot, canvas_pz):
+    v = PlotVisual(color_lookup=True)
+    canvas_pz.add_visual(v)
+    for i in range(3):
+        v.add_batch_data(y=.2 * np.random.randn(2, 10), color_index=i, data_bounds='auto')
+    canvas_pz.update_visual(v)
+    v.set_color_table(np.random.uniform(low=.5, high=.9, size=(3, 4)))
+    canvas_pz.show()
+    qtbot.waitForWindowShown(canvas_pz)
+    canvas_pz.close()
+
+
 def test_plot_2(qtbot, canvas_pz):
 
     n_signals = 50
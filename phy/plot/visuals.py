@@ -20,7 +20,7 @@ from pathlib import Path
 import numpy as np
 
 from .base import BaseVisual
-from .gloo import gl
+from .gloo import gl, TextureFloat2D
 from .transform import NDC
 from .utils import (
     _tesselate_histogram, _get_texture, _get_array, _get_pos, _get_index)
@@ -35,6 +35,92 @@ from phylib.utils.geometry import _get_data_bounds
 #------------------------------------------------------------------------------
 
 DEFAULT_COLOR = (0.03, 0.57, 0.98, .75)
+# Maximum width of the color table textures, the minimum GL_MAX_TEXTURE_SIZE since OpenGL 3.0.
+COLOR_TABLE_WIDTH = 1024
+
+
+def _color_lookup_shader(vertex_shader):
+    """Replace the per-vertex color attribute of a vertex shader by a lookup in a color table
+    stored in a texture, using a per-vertex color index."""
+    assert 'v_color = a_color;' in vertex_shader
+    vertex_shader = vertex_shader.replace(
+        'attribute vec4 a_color;',
+        'attribute float a_color_index;\n'
+        'uniform sampler2D u_color_table;\n'
+        'uniform float n_colors;\n'
+        'uniform float n_color_cols;')
+    vertex_shader = vertex_shader.replace(
+        'v_color = a_color;',
+        'v_color = fetch_table(a_color_index, u_color_table, n_colors, n_color_cols);')
+    return '#include "utils.glsl"\n' + vertex_shader
+
+
+def _get_color_table(color, default):
+    """Validate a color table, with one RGBA row per color index."""
+    n = len(color) if color is not None else 1
+    return _get_array(color, (n, 4), default, dtype=np.float32)
+
+
+def _set_color_table(program, color, default):
+    """Upload a color table to a program using a color lookup vertex shader.
+
+    The table is wrapped in a 2D texture with at most `COLOR_TABLE_WIDTH` columns, so that the
+    texture size does not exceed `GL_MAX_TEXTURE_SIZE` with many clusters.
+
+    """
+    color = _get_color_table(color, default)
+    # NOTE: the table has at least two colors, like the other lookup textures.
+    if len(color) == 1:
+        color = np.tile(color, (2, 1))
+    n = len(color)
+    n_cols = min(n, COLOR_TABLE_WIDTH)
+    n_rows = -(-n // n_cols)
+    table = np.zeros((n_rows * n_cols, 4), dtype=np.float32)
+    table[:n] = color
+    texture = _get_texture(table, default, n_rows * n_cols, [0, 1])
+    program['u_color_table'] = texture.reshape((n_rows, n_cols, 4)).astype(np.float32)
+    program['n_colors'] = n
+    program['n_color_cols'] = n_cols
+
+
+def _uniform_bounds(data_bounds):
+    """Return the bounds shared by all rows of a data bounds array, or None."""
+    if len(data_bounds) and np.all(data_bounds == data_bounds[:1]):
+        return data_bounds[0]
+
+
+def _gpu_normalizable(data_bounds, max_offset=1e2):
+    """Whether data with some bounds can be sent to the GPU as float32 and normalized in the
+    vertex shader without a visible loss of precision, that is, when the bounds are not too
+    far away from the origin compared to their extent.
+
+    The float32 quantization step is about `6e-8 * offset`, that is, at most `6e-6` times the
+    extent of the bounds here, well below a pixel even when zooming in.
+
+    """
+    extent = data_bounds[:, 2:] - data_bounds[:, :2]
+    offset = np.maximum(np.abs(data_bounds[:, :2]), np.abs(data_bounds[:, 2:]))
+    return bool(np.all(offset <= max_offset * extent))
+
+
+def _set_signal_bounds(program, data_bounds=None):
+    """Upload the bounds used to normalize the signals in the plot vertex shader: either a
+    single rectangle shared by all signals, or one rectangle per signal in a float texture,
+    wrapped like the color table in rows of at most `COLOR_TABLE_WIDTH` texels."""
+    bounds = _uniform_bounds(data_bounds) if data_bounds is not None and len(data_bounds) \
+        else NDC
+    if bounds is not None:
+        program['u_data_bounds'] = np.asarray(bounds, dtype=np.float32)
+        program['n_signal_bounds'] = 0
+        return
+    n = len(data_bounds)
+    n_cols = min(n, COLOR_TABLE_WIDTH)
+    n_rows = -(-n // n_cols)
+    texture = np.zeros((n_rows * n_cols, 4), dtype=np.float32)
+    texture[:n] = data_bounds
+    program['u_signal_bounds'] = texture.reshape((n_rows, n_cols, 4)).view(TextureFloat2D)
+    program['n_signal_bounds'] = n
+    program['n_signal_bounds_cols'] = n_cols
 
 
 #------------------------------------------------------------------------------
@@ -133,6 +219,9 @@ class ScatterVisual(BaseVisual):
     marker : string (used for all points in the scatter visual)
         Default: disc. Can be one of: arrow, asterisk, chevron, clover, club, cross, diamond,
         disc, ellipse, hbar, heart, infinity, pin, ring, spade, square, tag, triangle, vbar
+    color_lookup : boolean
+        Whether the colors are looked up in a color table on the GPU, using a color index per
+        point. Changing the colors then only requires uploading the color table.
 
     Parameters
     ----------
@@ -141,6 +230,9 @@ class ScatterVisual(BaseVisual):
     y : array-like (1D)
     pos : array-like (2D)
     color : array-like (2D, shape[1] == 4)
+        The color of every point, or the color table with the `color_lookup` option.
+    color_index : array-like (1D)
+        The index of every point in the color table, with the `color_lookup` option.
     size : array-like (1D)
         Marker sizes, in pixels
     depth : array-like (1D)
@@ -173,14 +265,17 @@ class ScatterVisual(BaseVisual):
         'vbar',
     )
 
-    def __init__(self, marker=None, marker_scaling=None):
+    def __init__(self, marker=None, marker_scaling=None, color_lookup=False):
         super(ScatterVisual, self).__init__()
 
         # Set the marker type.
         self.marker = marker or self.default_marker
         assert self.marker in self._supported_markers
+        self.color_lookup = color_lookup
 
         self.set_shader('scatter')
+        if color_lookup:
+            self.vertex_shader = _color_lookup_shader(self.vertex_shader)
         marker_scaling = marker_scaling or 'float marker_size = v_size;'
         self.fragment_shader = self.fragment_shader.replace('%MARKER_SCALING', marker_scaling)
         self.fragment_shader = self.fragment_shader.replace('%MARKER', self.marker)
@@ -192,7 +287,7 @@ class ScatterVisual(BaseVisual):
         return y.size if y is not None else len(pos)
 
     def validate(
-            self, x=None, y=None, pos=None, color=None, size=None, depth=None,
+            self, x=None, y=None, pos=None, color=None, color_index=None, size=None, depth=None,
             data_bounds=None, **kwargs):
         """Validate the requested data before passing it to set_data()."""
         if pos is None:
@@ -204,7 +299,12 @@ class ScatterVisual(BaseVisual):
         n = pos.shape[0]
 
         # Validate the data.
-        color = _get_array(color, (n, 4), ScatterVisual.default_color, dtype=np.float32)
+        if self.color_lookup:
+            color = _get_color_table(color, ScatterVisual.default_color)
+            color_index = _get_array(color_index, (n, 1), 0)
+            assert np.all((0 <= color_index) & (color_index < len(color)))
+        else:
+            color = _get_array(color, (n, 4), ScatterVisual.default_color, dtype=np.float32)
         size = _get_array(size, (n, 1), ScatterVisual.default_marker_size)
         depth = _get_array(depth, (n, 1), 0)
         if data_bounds is not None:
@@ -212,30 +312,49 @@ class ScatterVisual(BaseVisual):
             assert data_bounds.shape[0] == n
 
         return Bunch(
-            pos=pos, color=color, size=size, depth=depth, data_bounds=data_bounds,
-            _n_items=n, _n_vertices=n)
+            pos=pos, color=color, color_index=color_index, size=size, depth=depth,
+            data_bounds=data_bounds, _n_items=n, _n_vertices=n)
 
     def set_data(self, *args, **kwargs):
         """Update the visual data."""
         data = self.validate(*args, **kwargs)
         self.n_vertices = self.vertex_count(**data)
-        if data.data_bounds is not None:
-            self.data_range.from_bounds = data.data_bounds
-            pos_tr = self.transforms.apply(data.pos)
+        pos = np.empty((self.n_vertices, 3), dtype=np.float32)
+        # The raw positions are normalized in the vertex shader when all points have the same
+        # bounds, otherwise they are normalized on the CPU.
+        bounds = data.data_bounds
+        if bounds is not None and _uniform_bounds(bounds) is not None and \
+                _gpu_normalizable(bounds[:1]):
+            bounds, pos[:, :2] = bounds[0], data.pos
+        elif bounds is not None:
+            self.data_range.from_bounds = bounds
+            bounds, pos[:, :2] = NDC, self.transforms.apply(data.pos)
         else:
-            pos_tr = data.pos
-        pos_tr = np.c_[pos_tr, data.depth]
-        self.program['a_position'] = pos_tr.astype(np.float32)
+            bounds, pos[:, :2] = NDC, data.pos
+        pos[:, 2] = data.depth[:, 0]
+        self.program['a_position'] = pos
+        self.program['u_data_bounds'] = np.asarray(bounds, dtype=np.float32)
         self.program['a_size'] = data.size.astype(np.float32)
-        self.program['a_color'] = data.color.astype(np.float32)
+        if self.color_lookup:
+            self.program['a_color_index'] = data.color_index.astype(np.float32)
+            self.set_color_table(data.color)
+        else:
+            self.program['a_color'] = data.color.astype(np.float32)
         self.emit_visual_set_data()
         return data
 
     def set_color(self, color):
         """Change the color of the markers."""
+        if self.color_lookup:
+            return self.set_color_table(color)
         color = _get_array(color, (self.n_vertices, 4), ScatterVisual.default_color)
         self.program['a_color'] = color.astype(np.float32)
 
+    def set_color_table(self, color):
+        """Change the color table, with the `color_lookup` option."""
+        assert self.color_lookup
+        _set_color_table(self.program, color, ScatterVisual.default_color)
+
     def set_marker_size(self, marker_size):
         """Change the size of the markers."""
         size = _get_array(marker_size, (self.n_vertices, 1))
@@ -383,12 +502,23 @@ def _max(arr):
 class PlotVisual(BaseVisual):
     """Plot visual, with multiple line plots of various sizes and colors.
 
+    Constructor
+    -----------
+
+    color_lookup : boolean
+        Whether the colors are looked up in a color table on the GPU, using a color index per
+        plot. Changing the colors then only requires uploading the color table.
+
     Parameters
     ----------
 
     x : array-like (1D), or list of 1D arrays for different plots
-    y : array-like (1D), or list of 1D arrays, for different plots
+    y : array-like (1D), or list of 1D arrays, for different plots. A 2D array with one plot
+        per row is kept as a single array, which is much faster with many plots.
     color : array-like (2D, shape[-1] == 4)
+        The color of every plot, or the color table with the `color_lookup` option.
+    color_index : array-like (1D)
+        The index of every plot in the color table, with the `color_lookup` option.
     depth : array-like (1D)
     masks : array-like (1D)
         Similar to an alpha channel, but for color saturation instead of transparency.
@@ -397,30 +527,43 @@ class PlotVisual(BaseVisual):
     """
 
     default_color = DEFAULT_COLOR
+    # Maximum number of per-signal bounds stored in a texture for the normalization on the GPU.
+    max_signal_bounds = 4096
     _noconcat = ('x', 'y')
 
-    def __init__(self):
+    def __init__(self, color_lookup=False):
         super(PlotVisual, self).__init__()
+        self.color_lookup = color_lookup
 
         self.set_shader('plot')
+        if color_lookup:
+            self.vertex_shader = _color_lookup_shader(self.vertex_shader)
         self.set_primitive_type('line_strip')
         self.set_data_range(NDC)
 
     def validate(
-            self, x=None, y=None, color=None, depth=None, masks=None, data_bounds=None, **kwargs):
+            self, x=None, y=None, color=None, color_index=None, depth=None, masks=None,
+            data_bounds=None, **kwargs):
         """Validate the requested data before passing it to set_data()."""
 
         assert y is not None
-        y = _as_list(y)
+        if isinstance(y, np.ndarray) and y.ndim == 2:
+            # All plots have the same number of points: keep the 2D arrays.
+            if x is None:
+                x = np.tile(np.linspace(-1., 1., y.shape[1]), (y.shape[0], 1))
+            x = np.asarray(x)
+            assert x.shape == y.shape
+        else:
+            y = _as_list(y)
 
-        if x is None:
-            x = [np.linspace(-1., 1., len(_)) for _ in y]
-        x = _as_list(x)
+            if x is None:
+                x = [np.linspace(-1., 1., len(_)) for _ in y]
+            x = _as_list(x)
 
-        # Remove empty elements.
-        assert len(x) == len(y)
+            # Remove empty elements.
+            assert len(x) == len(y)
 
-        assert [len(_) for _ in x] == [len(_) for _ in y]
+            assert [len(_) for _ in x] == [len(_) for _ in y]
 
         n_signals = len(x)
 
@@ -431,11 +574,15 @@ class PlotVisual(BaseVisual):
             ymax = [_max(_) for _ in y]
             data_bounds = np.c_[xmin, ymin, xmax, ymax]
 
-        color = _get_array(color, (n_signals, 4),
-                           PlotVisual.default_color,
-                           dtype=np.float32,
-                           )
-        assert color.shape == (n_signals, 4)
+        if self.color_lookup:
+            color = _get_color_table(color, PlotVisual.default_color)
+            color_index = _get_array(color_index, (n_signals, 1), 0)
+        else:
+            color = _get_array(color, (n_signals, 4),
+                               PlotVisual.default_color,
+                               dtype=np.float32,
+                               )
+            assert color.shape == (n_signals, 4)
 
         masks = _get_array(masks, (n_signals, 1), 1., np.float32)
         # The mask is clu_idx + fractional mask
@@ -451,14 +598,36 @@ class PlotVisual(BaseVisual):
             assert data_bounds.shape == (n_signals, 4)
 
         return Bunch(
-            x=x, y=y, color=color, depth=depth, data_bounds=data_bounds, masks=masks,
+            x=x, y=y, color=color, color_index=color_index, depth=depth,
+            data_bounds=data_bounds, masks=masks,
             _n_items=n_signals, _n_vertices=self.vertex_count(y=y))
 
     def set_color(self, color):
-        """Update the visual's color."""
+        """Update the visual's color, given either for every vertex or for every signal.
+
+        Only the colors that have changed are uploaded to the GPU. With the `color_lookup`
+        option, the color table is updated instead.
+
+        """
+        if self.color_lookup:
+            return self.set_color_table(color)
+        n_signals = getattr(self, 'n_signals', None)
+        if color.shape == (n_signals, 4) and n_signals != self.n_vertices:
+            color = np.repeat(color, self.n_samples, axis=0)
         assert color.shape == (self.n_vertices, 4)
         self.program['a_color'] = color.astype(np.float32)
 
+    def set_color_table(self, color):
+        """Change the color table, with the `color_lookup` option."""
+        assert self.color_lookup
+        _set_color_table(self.program, color, PlotVisual.default_color)
+
+    def set_masks(self, masks):
+        """Update the masks of the signals, without changing the other attributes."""
+        masks = _get_array(masks, (self.n_signals, 1))
+        self.program['a_mask'] = np.repeat(masks, self.n_samples, axis=0).astype(np.float32)
+        self.program['u_mask_max'] = _max(masks)
+
     def vertex_count(self, y=None, **kwargs):
         """Number of vertices for the requested data."""
         """Take the output of validate() as input."""
@@ -469,51 +638,63 @@ class PlotVisual(BaseVisual):
         data = self.validate(*args, **kwargs)
         self.n_vertices = self.vertex_count(**data)
 
-        assert isinstance(data.y, list)
         n_signals = len(data.y)
-        n_samples = [len(_) for _ in data.y]
+        if isinstance(data.y, np.ndarray):
+            n_samples = [data.y.shape[1]] * n_signals
+            x, y = data.x.ravel(), data.y.ravel()
+        else:
+            assert isinstance(data.y, list)
+            n_samples = [len(_) for _ in data.y]
+            x = np.concatenate(data.x) if len(data.x) else np.array([])
+            y = np.concatenate(data.y) if len(data.y) else np.array([])
 
         self.n_signals = n_signals
         self.n_samples = n_samples
 
         n = sum(n_samples)
-        x = np.concatenate(data.x) if len(data.x) else np.array([])
-        y = np.concatenate(data.y) if len(data.y) else np.array([])
 
-        # Generate the position array.
-        pos = np.empty((n, 2), dtype=np.float64)
-        pos[:, 0] = x.ravel()
-        pos[:, 1] = y.ravel()
-        assert pos.shape == (n, 2)
+        # Generate the position array, with the raw float32 data and the depth.
+        pos = np.empty((n, 3), dtype=np.float32)
+        pos[:, 0] = x
+        pos[:, 1] = y
+        pos[:, 2] = np.repeat(data.depth[:, 0], n_samples)
 
         # Generate the color attribute.
-        color = data.color
-        assert color.shape == (n_signals, 4)
-        color = np.repeat(color, n_samples, axis=0)
-        assert color.shape == (n, 4)
+        if self.color_lookup:
+            color_index = np.repeat(data.color_index, n_samples, axis=0)
+            assert color_index.shape == (n, 1)
+        else:
+            color = data.color
+            assert color.shape == (n_signals, 4)
+            color = np.repeat(color, n_samples, axis=0)
+            assert color.shape == (n, 4)
 
         # Generate signal index.
-        signal_index = np.repeat(np.arange(n_signals), n_samples)
-        signal_index = _get_array(signal_index, (n, 1))
-        assert signal_index.shape == (n, 1)
+        signal_index = np.repeat(np.arange(n_signals, dtype=np.float32), n_samples)
 
-        # Transform the positions.
-        if data.data_bounds is not None:
-            data_bounds = np.repeat(data.data_bounds, n_samples, axis=0)
-            self.data_range.from_bounds = data_bounds
-            pos = self.transforms.apply(pos)
+        # The positions are normalized in the vertex shader, with the bounds of every signal.
+        # They are normalized on the CPU when they would lose too much precision as float32.
+        data_bounds = data.data_bounds
+        if data_bounds is not None and (
+                not _gpu_normalizable(data_bounds) or (
+                    len(data_bounds) > self.max_signal_bounds and
+                    _uniform_bounds(data_bounds) is None)):
+            self.data_range.from_bounds = np.repeat(data_bounds, n_samples, axis=0)
+            pos[:, :2] = self.transforms.apply(np.c_[x, y])
+            data_bounds = None
+        _set_signal_bounds(self.program, data_bounds)
 
         # Masks.
         masks = np.repeat(data.masks, n_samples, axis=0)
         assert masks.shape == (n, 1)
 
-        # Position and depth.
-        depth = np.repeat(data.depth, n_samples, axis=0)
-        pos_depth = np.c_[pos, depth]
-
-        self.program['a_position'] = pos_depth.astype(np.float32)
-        self.program['a_color'] = color.astype(np.float32)
-        self.program['a_signal_index'] = signal_index.astype(np.float32)
+        self.program['a_position'] = pos
+        if self.color_lookup:
+            self.program['a_color_index'] = color_index.astype(np.float32)
+            self.set_color_table(data.color)
+        else:
+            self.program['a_color'] = color.astype(np.float32)
+        self.program['a_signal_index'] = signal_index
         self.program['a_mask'] = masks.astype(np.float32)
         self.program['u_mask_max'] = _max(masks)
 
@@ -1034,6 +1215,11 @@ class LineVisual(BaseVisual):
         self.emit_visual_set_data()
         return data
 
+    def set_color(self, color):
+        """Change the color of the lines, without changing their positions."""
+        color = _get_array(color, (self.n_vertices // 2, 4), LineVisual.default_color)
+        self.program['a_color'] = np.repeat(color, 2, axis=0).astype(np.float32)
+
 
 #------------------------------------------------------------------------------
 # Agg line visual
@@ -1437,6 +1623,87 @@ class ImageVisual(BaseVisual):
         return data
 
 
+#------------------------------------------------------------------------------
+# Density visual
+#------------------------------------------------------------------------------
+
+class DensityVisual(BaseVisual):
+    """Display the rows of a density image, every row in the same rectangle of its own box
+    (for example in a stacked layout), with its own color and an opacity given by the density.
+
+    Parameters
+    ----------
+
+    density : array-like (2D)
+        An `(n_rows, n_bins)` array with values in [0, 1]. Zero values are not displayed.
+    rect : array-like (1D, 4)
+        The rectangle `(x0, y0, x1, y1)` where every row is displayed.
+    color : array-like (2D, shape[1] == 4)
+        The color of every row.
+    data_bounds : array-like (1D, 4)
+
+    """
+    default_color = DEFAULT_COLOR
+
+    def __init__(self):
+        super(DensityVisual, self).__init__()
+
+        self.set_shader('density')
+        self.set_primitive_type('triangles')
+        self.set_data_range(NDC)
+
+    def validate(self, density=None, rect=None, color=None, data_bounds=None, **kwargs):
+        """Validate the requested data before passing it to set_data()."""
+        assert density is not None
+        density = np.asarray(density, dtype=np.float32)
+        if density.ndim == 1:
+            density = density[np.newaxis, :]
+        assert density.ndim == 2
+        n_rows = density.shape[0]
+        rect = np.asarray(rect if rect is not None else NDC, dtype=np.float64)
+        assert rect.shape == (4,)
+        color = _get_array(color, (n_rows, 4), DensityVisual.default_color, dtype=np.float32)
+        if data_bounds is not None:
+            data_bounds = _get_data_bounds(data_bounds, length=6 * n_rows)
+        return Bunch(
+            density=density, rect=rect, color=color, data_bounds=data_bounds,
+            _n_items=n_rows, _n_vertices=self.vertex_count(density))
+
+    def vertex_count(self, density=None, **kwargs):
+        """Number of vertices for the requested data."""
+        return 6 * np.atleast_2d(density).shape[0]
+
+    def set_data(self, *args, **kwargs):
+        """Update the visual data."""
+        data = self.validate(*args, **kwargs)
+        self.n_vertices = self.vertex_count(**data)
+        n_rows = data.density.shape[0]
+
+        # Two triangles per row.
+        x0, y0, x1, y1 = data.rect
+        pos = np.array([[x0, y0], [x0, y1], [x1, y0], [x0, y1], [x1, y1], [x1, y0]])
+        pos = np.tile(pos, (n_rows, 1))
+        if data.data_bounds is not None:
+            self.data_range.from_bounds = data.data_bounds
+            pos = self.transforms.apply(pos)
+        tex_x = np.tile([0, 0, 1, 0, 1, 1], n_rows)
+        row = np.repeat(np.arange(n_rows), 6)
+
+        self.program['a_position'] = pos.astype(np.float32)
+        self.program['a_tex_x'] = tex_x.astype(np.float32)
+        self.program['a_row'] = row.astype(np.float32)
+        self.program['u_density'] = np.clip(data.density, 0, 1)[..., np.newaxis]
+        self.program['n_rows'] = n_rows
+        self.set_color(data.color)
+
+        self.emit_visual_set_data()
+        return data
+
+    def set_color(self, color):
+        """Change the colors of the rows, uploading only one color per row."""
+        _set_color_table(self.program, color, DensityVisual.default_color)
+
+
 #------------------------------------------------------------------------------
 # Polygon visual
 #------------------------------------------------------------------------------
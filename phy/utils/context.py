@@ -6,13 +6,19 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
 from functools import wraps
 import inspect
 import logging
 import os
 from pathlib import Path
 from pickle import dump, load
+import sys
+from threading import RLock
 
+import numpy as np
+
+from phylib.utils import Bunch
 from phylib.utils._misc import save_json, load_json, load_pickle, save_pickle, _fullname
 from .config import phy_config_dir, ensure_dir_exists
 
@@ -23,23 +29,228 @@ logger = logging.getLogger(__name__)
 # Context
 #------------------------------------------------------------------------------
 
-def _cache_methods(obj, memcached, cached):  # pragma: no cover
+def _cache_methods(obj, memcached, cached, per_cluster=None):  # pragma: no cover
+    per_cluster = per_cluster or {}
     for name in memcached:
         f = getattr(obj, name)
-        setattr(obj, name, obj.context.memcache(f))
+        kwargs = {}
+        if name in per_cluster:
+            merge = per_cluster[name]
+            # The merge function may be given as the name of a method of the object.
+            if isinstance(merge, str):
+                merge = getattr(obj, merge)
+            kwargs = dict(per_cluster=True, merge=merge)
+        setattr(obj, name, obj.context.memcache(f, **kwargs))
 
     for name in cached:
         f = getattr(obj, name)
         setattr(obj, name, obj.context.cache(f))
 
 
+def merge_sum(cluster_id, values, weights):
+    """Merge function for additive cluster quantities, like spike counts or firing rates: the
+    value of the merged cluster is the sum of the values of the merged clusters."""
+    out = values[0]
+    for value in values[1:]:
+        out = out + value
+    return out
+
+
+def merge_weighted_mean(cluster_id, values, weights):
+    """Merge function for mean waveforms, returned as Bunch instances with `data` and
+    `channel_ids` fields: the mean waveforms of the merged cluster are the mean of the
+    mean waveforms of the merged clusters, weighted by their number of spikes.
+
+    Return None if the merged clusters have different channels.
+
+    """
+    channel_ids = values[0].channel_ids
+    if any(not np.array_equal(value.channel_ids, channel_ids) for value in values[1:]):
+        return
+    if any(value.data is None for value in values):
+        return
+    out = values[0].copy()
+    out.data = np.average(np.stack([value.data for value in values]), axis=0, weights=weights)
+    return out
+
+
+def _nbytes(obj):
+    """Approximate size in memory of an object returned by a memcached function."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class MemCache(object):
+    """In-memory cache of the outputs of a function, with least-recently-used eviction.
+
+    The cache keeps track of the approximate size in bytes of every entry, of the number of
+    hits, misses, and evictions, and of the entries that have not been persisted to disk yet.
+
+    The cache may be accessed from several threads, for example when memcached functions are
+    called in the thread pool of the views or of the prefetcher: all accesses are protected
+    by a lock.
+
+    Constructor
+    -----------
+
+    name : str
+        Name of the cached function.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = RLock()
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._dirty = set()
+        # Number of entries written to the disk file, used to decide when to compact it.
+        self._n_saved = 0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        """Return a cached value and mark it as the most recently used."""
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, dirty=True):
+        """Add a value to the cache."""
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._sizes[key]
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self.nbytes += size
+            if dirty:
+                self._dirty.add(key)
+
+    __setitem__ = set
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def pop(self, key, default=None):
+        """Remove an entry from the cache."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            self.nbytes -= self._sizes.pop(key)
+            self._dirty.discard(key)
+            return self._data.pop(key)
+
+    def evict(self):
+        """Remove the least recently used entry."""
+        with self._lock:
+            if not self._data:
+                return
+            key = next(iter(self._data))
+            self.pop(key)
+            self.evictions += 1
+
+    def items(self):
+        """Return a list of the `(key, value)` entries."""
+        with self._lock:
+            return list(self._data.items())
+
+    def keys(self):
+        """Return a list of the keys."""
+        with self._lock:
+            return list(self._data.keys())
+
+    @property
+    def stats(self):
+        """Bunch with the cache statistics."""
+        return Bunch(
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+            n_entries=len(self._data), nbytes=self.nbytes)
+
+    def load(self, path):
+        """Load the cache from a file.
+
+        The file contains successive pickled dictionaries, the last ones taking precedence.
+
+        """
+        n = 0
+        with open(str(path), 'rb') as fd:
+            while True:
+                try:
+                    d = load(fd)
+                except EOFError:
+                    break
+                for key, value in d.items():
+                    self.set(key, value, dirty=False)
+                n += len(d)
+        self._n_saved = n
+
+    def save(self, path):
+        """Persist the cache to a file.
+
+        Only the entries added since the last save are appended to the file, unless the file
+        contains too many obsolete entries, in which case it is rewritten.
+
+        """
+        path = Path(path)
+        with self._lock:
+            rewrite = not path.exists() or self._n_saved > 2 * len(self._data)
+            if rewrite:
+                data = dict(self._data)
+            else:
+                data = {key: self._data[key] for key in self._dirty if key in self._data}
+            if not data and not rewrite:
+                return
+            with open(str(path), 'wb' if rewrite else 'ab') as fd:
+                dump(data, fd)
+            self._n_saved = len(data) + (0 if rewrite else self._n_saved)
+            self._dirty.clear()
+
+
 class Context(object):
     """Handle function disk and memory caching with joblib.
 
     Memcaching a function is used to save *in memory* the output of the function for all
     passed inputs. Input should be hashable. NumPy arrays are supported. The contents of the
     memcache in memory can be persisted to disk with `context.save_memcache()` and
-    `context.load_memcache()`.
+    `context.load_memcache()`. The total size of the memcache is bounded by `memcache_limit`:
+    when it is exceeded, the least recently used entries of the largest function caches are
+    evicted.
+
+    Functions whose first argument is a cluster id can be memcached with `per_cluster=True`.
+    When clusters are merged, `context.update_memcache(up)` derives the entries of the new
+    cluster from those of the merged clusters with the `merge` function of the memcached
+    function, if there is one. The entries of the deleted clusters are kept: a cluster id
+    always refers to the same spikes, and undoing an action brings the deleted clusters back.
+    They are evicted like the other entries when the memcache is full.
 
     Caching a function is used to save *on disk* the output of the function for all passed
     inputs. Input should be hashable. NumPy arrays are supported. This is to be preferred
@@ -72,6 +283,9 @@ class Context(object):
     """Maximum cache size, in bytes."""
     cache_limit = 2 * 1024 ** 3  # 2 GB
 
+    """Maximum memcache size, in bytes."""
+    memcache_limit = 1024 ** 3  # 1 GB
+
     def __init__(self, cache_dir, verbose=0):
         self.verbose = verbose
         # Make sure the cache directory exists.
@@ -87,6 +301,8 @@ class Context(object):
 
         self._set_memory(self.cache_dir)
         self._memcache = {}
+        # Merge functions of the memcached functions taking a cluster id as first argument.
+        self._per_cluster = {}
 
     def _set_memory(self, cache_dir):
         """Create the joblib Memory instance."""
@@ -122,37 +338,119 @@ class Context(object):
     def load_memcache(self, name):
         """Load the memcache from disk (pickle file), if it exists."""
         path = self.cache_dir / 'memcache' / (name + '.pkl')
+        cache = MemCache(name)
         if path.exists():
             logger.debug("Load memcache for `%s`.", name)
-            with open(str(path), 'rb') as fd:
-                cache = load(fd)
-        else:
-            cache = {}
+            cache.load(path)
         self._memcache[name] = cache
+        self._reduce_memcache()
         return cache
 
     def save_memcache(self):
-        """Save the memcache to disk using pickle."""
+        """Save the memcache to disk using pickle.
+
+        Only the entries that were not saved yet are written.
+
+        """
         for name, cache in self._memcache.items():
             path = self.cache_dir / 'memcache' / (name + '.pkl')
             logger.debug("Save memcache for `%s`.", name)
-            with open(str(path), 'wb') as fd:
-                dump(cache, fd)
+            cache.save(path)
+
+    def memcache_stats(self):
+        """Return a dictionary `{name: stats}` with the hits, misses, evictions, number of
+        entries and size of the memcache of every function."""
+        return {name: cache.stats for name, cache in self._memcache.items()}
+
+    def _reduce_memcache(self):
+        """Evict memcache entries until the total size is below the limit."""
+        caches = list(self._memcache.values())
+        total = sum(cache.nbytes for cache in caches)
+        while total > self.memcache_limit:
+            # Evict the least recently used entry of the largest cache.
+            cache = max(caches, key=lambda c: c.nbytes)
+            if not len(cache):  # pragma: no cover
+                break
+            total -= cache.nbytes
+            cache.evict()
+            total += cache.nbytes
+
+    def update_memcache(self, up):
+        """Update the entries of the per-cluster memcached functions after a clustering action.
+
+        Parameters
+        ----------
+
+        up : UpdateInfo
+            The object returned by the clustering action. The `deleted_spike_counts` field,
+            when present, is used to weight the values of the merged clusters.
+
+        """
+        added = up.get('added', [])
+        is_merge = up.get('description', None) == 'merge' and len(added) == 1
+        if not is_merge or not up.get('deleted', []):
+            return
+        weights = dict(zip(up.get('deleted', []), up.get('deleted_spike_counts', [])))
+        for name, merge in self._per_cluster.items():
+            cache = self._memcache.get(name, None)
+            if cache is None or merge is None:
+                continue
+            # Derive the values of the merged cluster from the values of the merged clusters.
+            # NOTE: the cache may be accessed by memcached functions running in other threads.
+            with cache._lock:
+                self._merge_entries(cache, merge, up.deleted, added[0], weights)
+
+    def _merge_entries(self, cache, merge, parents, child, weights):
+        # Group the entries of the parent clusters by their other arguments.
+        groups = {}
+        for key, value in cache.items():
+            if key and key[0] in parents:
+                groups.setdefault(key[1:], {})[key[0]] = value
+        for rest, values in groups.items():
+            if len(values) < len(parents) or (child,) + rest in cache:
+                continue
+            w = [weights.get(clu, 1) for clu in parents]
+            try:
+                value = merge(child, [values[clu] for clu in parents], w)
+            except Exception as e:  # pragma: no cover
+                logger.debug("Unable to merge the memcache entries of %s: %s.", cache.name, e)
+                continue
+            if value is not None:
+                cache[(child,) + rest] = value
+
+    def memcache(self, f, per_cluster=False, merge=None):
+        """Cache a function in memory using an internal dictionary.
+
+        Parameters
+        ----------
+
+        f : function
+            The function to memcache.
+        per_cluster : boolean
+            Whether the first argument of the function is a cluster id. The entries of merged
+            clusters are derived by `update_memcache()`.
+        merge : function
+            Only with `per_cluster=True`. Function `(cluster_id, values, weights) => value`
+            deriving the value of a merged cluster from the values of the merged clusters and
+            their number of spikes. It may return None if the value cannot be derived.
 
-    def memcache(self, f):
-        """Cache a function in memory using an internal dictionary."""
+        """
         name = _fullname(f)
-        cache = self.load_memcache(name)
+        self.load_memcache(name)
+        if per_cluster:
+            self._per_cluster[name] = merge
 
         @wraps(f)
         def memcached(*args, **kwargs):
             """Cache the function in memory."""
+            cache = self._memcache[name]
             # The arguments need to be hashable. Much faster than using hash().
             h = args
             out = cache.get(h, None)
             if out is None:
                 out = f(*args, **kwargs)
                 cache[h] = out
+                self._reduce_memcache()
             return out
         return memcached
 
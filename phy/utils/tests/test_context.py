@@ -7,13 +7,16 @@
 #------------------------------------------------------------------------------
 
 from pickle import dump, load
+from threading import Thread
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
 from pytest import fixture
 
 from phylib.io.array import write_array, read_array
-from ..context import Context, _fullname
+from phylib.utils import Bunch
+from ..context import (
+    Context, MemCache, _fullname, _nbytes, merge_sum, merge_weighted_mean)
 
 
 #------------------------------------------------------------------------------
@@ -145,6 +148,174 @@ def test_context_memcache(tempdir, context):
     assert len(_res) == 1
 
 
+def test_nbytes():
+    from phylib.utils import Bunch
+    x = np.zeros(10)
+    assert _nbytes(x) == 80
+    assert _nbytes(Bunch(a=x, b=[x, x])) == 240
+    assert _nbytes(3) > 0
+
+
+def test_memcache_lru(tempdir):
+    cache = MemCache('f')
+    cache[1] = np.zeros(10)
+    cache[2] = np.zeros(20)
+    assert cache.nbytes == 240
+    assert cache.get(1) is not None
+    assert cache.get(3) is None
+
+    # The least recently used entry is 2.
+    cache.evict()
+    assert 2 not in cache
+    assert 1 in cache
+    assert cache.nbytes == 80
+
+    stats = cache.stats
+    assert (stats.hits, stats.misses, stats.evictions, stats.n_entries) == (1, 1, 1, 1)
+
+
+def test_memcache_incremental_save(tempdir):
+    path = tempdir / 'f.pkl'
+
+    cache = MemCache('f')
+    cache[1] = 1
+    cache.save(path)
+    size = path.stat().st_size
+
+    # Nothing new: the file is not modified.
+    cache.save(path)
+    assert path.stat().st_size == size
+
+    # Only the new entry is appended.
+    cache[2] = 2
+    cache.save(path)
+    assert size < path.stat().st_size < 2 * size + 8
+
+    cache = MemCache('f')
+    cache.load(path)
+    assert dict(cache.items()) == {1: 1, 2: 2}
+
+    # Old format: a single pickled dictionary.
+    with open(tempdir / 'g.pkl', 'wb') as f:
+        dump({(3,): 9}, f)
+    cache = MemCache('g')
+    cache.load(tempdir / 'g.pkl')
+    assert cache[(3,)] == 9
+
+
+def test_context_memcache_limit(tempdir, context):
+    context.memcache_limit = 1000
+
+    @context.memcache
+    def f(x):
+        return np.zeros(x)
+
+    @context.memcache
+    def g(x):
+        return np.zeros(x)
+
+    # 800 bytes.
+    f(100)
+    g(10)
+    # This evicts f(100), the only entry of the largest cache.
+    g(20)
+    stats = context.memcache_stats()
+    assert stats[_fullname(f)].evictions == 1
+    assert stats[_fullname(f)].n_entries == 0
+    assert stats[_fullname(g)].n_entries == 2
+    assert sum(s.nbytes for s in stats.values()) <= 1000
+
+
+def test_context_update_memcache(context):
+    _calls = []
+
+    def f(cluster_id):
+        _calls.append(cluster_id)
+        return cluster_id * 10
+    f = context.memcache(f, per_cluster=True, merge=merge_sum)
+
+    @context.memcache
+    def g(cluster_id):
+        return cluster_id
+
+    assert f(1) == 10
+    assert f(2) == 20
+    assert f(3) == 30
+    g(1)
+
+    # Merge 1 and 2 into 4: the value of 4 is derived without calling the function.
+    up = Bunch(description='merge', added=[4], deleted=[1, 2], deleted_spike_counts=[5, 6])
+    context.update_memcache(up)
+    assert f(4) == 30
+    assert _calls == [1, 2, 3]
+    # The entries of the deleted clusters are kept, for undo.
+    assert list(context._memcache[_fullname(f)].keys()) == [(1,), (2,), (3,), (4,)]
+    # The other memcached functions are left untouched.
+    assert list(context._memcache[_fullname(g)].keys()) == [(1,)]
+
+    # Split 4: no derivation.
+    up = Bunch(description='assign', added=[5, 6], deleted=[4], deleted_spike_counts=[11])
+    context.update_memcache(up)
+    assert list(context._memcache[_fullname(f)].keys()) == [(1,), (2,), (3,), (4,)]
+
+    # Undo the merge: the values of the restored clusters are still in the memcache.
+    up = Bunch(description='merge', history='undo', added=[1, 2], deleted=[4])
+    context.update_memcache(up)
+    assert f(1) == 10
+    assert f(2) == 20
+    assert _calls == [1, 2, 3]
+
+
+def test_context_memcache_threads(context):
+    def f(cluster_id):
+        return np.zeros(10) + cluster_id
+    f = context.memcache(f, per_cluster=True, merge=merge_sum)
+    context.memcache_limit = 20 * 80
+    errors = []
+
+    def _worker(offset):
+        try:
+            for i in range(2000):
+                f((i * 7 + offset) % 100)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    # Memcached functions called from several threads, while the main thread updates the
+    # memcache after clustering actions.
+    threads = [Thread(target=_worker, args=(k,)) for k in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(200):
+        up = Bunch(description='merge', added=[1000 + i], deleted=[i % 100, (i + 1) % 100])
+        context.update_memcache(up)
+    for t in threads:
+        t.join()
+    assert not errors
+    cache = context._memcache[_fullname(f)]
+    assert cache.nbytes == sum(v.nbytes for _, v in cache.items())
+
+
+def test_context_update_memcache_weighted_mean(context):
+    def f(cluster_id):
+        return Bunch(
+            data=np.full((1, 2, 3), float(cluster_id)), channel_ids=[cluster_id % 2, 2])
+    f = context.memcache(f, per_cluster=True, merge=merge_weighted_mean)
+
+    f(1)
+    f(3)
+    f(2)
+    context.update_memcache(
+        Bunch(description='merge', added=[10], deleted=[1, 3], deleted_spike_counts=[3, 1]))
+    b = context._memcache[_fullname(f)][(10,)]
+    ae(b.data, np.full((1, 2, 3), 1.5))
+    assert b.channel_ids == [1, 2]
+
+    # Different channels: no derivation.
+    context.update_memcache(
+        Bunch(description='merge', added=[11], deleted=[10, 2], deleted_spike_counts=[4, 1]))
+    assert (11,) not in context._memcache[_fullname(f)]
+
+
 def test_pickle_cache(tempdir, context):
     """Make sure the Context is picklable."""
     with open(tempdir / 'test.pkl', 'wb') as f: